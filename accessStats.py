@@ -0,0 +1,91 @@
+"""
+per model access stats for cache eviction (see compactCache.py): when each cached document was
+last used & how many times. The database commit process keeps them in memory, fed by the index
+writes & the hits workers report (MSG_TOUCH), and saves them to accessStats.bin in the model's
+directory every ACCESS_STATS_SAVE_SECS & on shutdown. Stats are best effort: touches still
+buffered in a worker when it stops are lost
+"""
+import logging
+import numpy as np
+import os
+
+from threading import Lock
+from time import time
+
+# digest, last access (secs since the epoch), number of accesses
+RECORD = np.dtype([("digest", "V32"), ("last_access", "<u4"), ("count", "<u4")])
+COUNT_MAX = 2**32 - 1
+
+
+class AccessStats:
+    FILENAME = "accessStats.bin"
+
+    def __init__(self, dirpath: str):
+        self.filepath = os.path.join(dirpath, self.FILENAME)
+        # digest -> last access << 32 | count, 1 int per document keeps millions of them small
+        self.stats = {}
+        self.lock = Lock()
+        self.dirty = False
+        records = self.load(dirpath)
+        self.stats = dict(zip((digest.tobytes() for digest in records["digest"]),
+                              ((records["last_access"].astype(np.uint64) << np.uint64(32))
+                               | records["count"]).tolist()))
+
+    # -------------------------------------------------------------------------
+    def touch(self, document_hashes: list[bytes], now: int | None = None) -> None:
+        "counts 1 access of each digest @ now"
+        now = int(time()) if now is None else now
+        with self.lock:
+            for document_hash in document_hashes:
+                count = self.stats.get(document_hash, 0) & COUNT_MAX
+                self.stats[document_hash] = now << 32 | min(count + 1, COUNT_MAX)
+            self.dirty = True
+
+    def forget(self, document_hashes: list[bytes]) -> None:
+        "drops the stats of evicted documents"
+        with self.lock:
+            for document_hash in document_hashes:
+                self.stats.pop(document_hash, None)
+            self.dirty = True
+
+    def lookup(self, digests: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        "last access & number of accesses of each digest ((n, 32) uint8), 0 & 0 without stats"
+        with self.lock:
+            packed = np.fromiter((self.stats.get(digest.tobytes(), 0) for digest in digests),
+                                 dtype=np.uint64, count=len(digests))
+        return ((packed >> np.uint64(32)).astype(np.int64),
+                (packed & np.uint64(COUNT_MAX)).astype(np.int64))
+
+    # -------------------------------------------------------------------------
+    def save(self) -> None:
+        "writes the stats to a new file & atomically replaces the old one, if they changed"
+        with self.lock:
+            if not self.dirty:
+                return
+            records = np.empty(len(self.stats), dtype=RECORD)
+            packed = np.fromiter(self.stats.values(), dtype=np.uint64, count=len(self.stats))
+            records["digest"] = np.frombuffer(b"".join(self.stats.keys()), dtype="V32")
+            self.dirty = False
+        records["last_access"] = packed >> np.uint64(32)
+        records["count"] = packed & np.uint64(COUNT_MAX)
+        self.write(self.filepath, records)
+
+    @staticmethod
+    def write(filepath: str, records: np.ndarray) -> None:
+        temp_filepath = f"{filepath}.tmp"
+        with open(temp_filepath, "wb") as f:
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filepath, filepath)
+        logging.debug(f'access stats: saved {len(records)} records to "{filepath}"')
+
+    @classmethod
+    def load(cls, dirpath: str) -> np.ndarray:
+        "the saved stats of the model in dirpath as an array of RECORDs, empty if there are none"
+        try:
+            with open(os.path.join(dirpath, cls.FILENAME), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return np.empty(0, dtype=RECORD)
+        return np.frombuffer(data[:len(data) - len(data) % RECORD.itemsize], dtype=RECORD)
@@ -0,0 +1,126 @@
+"""
+dynamic micro-batching of concurrent requests to a model (1 scheduler per model per worker).
+Documents submitted while the model is busy, or within max_wait_ms of each other, are encoded
+together with a single call to the model, then each embedding is handed back to its requester.
+Up to max_concurrent batches (the size of the encode pool) are encoded at once.
+"""
+import asyncio
+import logging
+
+from concurrent.futures import Executor
+from numpy import ndarray
+from time import perf_counter
+from typing import Callable
+
+import metrics
+
+DEFAULT_MAX_BATCH_SIZE = 32
+DEFAULT_MAX_WAIT_MS = 5.0
+
+
+class BatchScheduler:
+    def __init__(self, encode: Callable[[list[str]], ndarray],
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_wait_ms: float = DEFAULT_MAX_WAIT_MS, executor: Executor | None = None,
+                 model_name: str = "", max_concurrent: int = 1):
+        self.encode = encode    # blocking, takes a list of documents, returns a (n, dim) matrix
+        self.model_name = model_name    # labels its metrics
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.executor = executor    # None: the event loop's default executor
+        self.max_concurrent = max(1, max_concurrent)    # batches in flight, 1 per executor worker
+        self.me = self.__class__.__name__
+        self.pending = []   # [(document, future, arrival time)], oldest first
+        self.has_pending = None
+        self.is_full = None
+        self.slots = None   # semaphore of max_concurrent batches
+        self.encoding = set()   # tasks of the batches in flight
+        self.task = None
+
+    # -------------------------------------------------------------------------
+    async def submit(self, document: str) -> ndarray:
+        "queues document for the next batch, returns its embedding once that batch is encoded"
+        loop = asyncio.get_running_loop()
+        if self.task is None:   # events & task must be created on the running loop
+            self.has_pending = asyncio.Event()
+            self.is_full = asyncio.Event()
+            self.slots = asyncio.Semaphore(self.max_concurrent)
+            self.task = loop.create_task(self._run())
+        future = loop.create_future()
+        self.pending.append((document, future, loop.time()))
+        self.has_pending.set()
+        if len(self.pending) >= self.max_batch_size:
+            self.is_full.set()
+        return await future
+
+    # -------------------------------------------------------------------------
+    async def _run(self) -> None:
+        """
+        main loop: wait for the 1st document.. for a free slot.. for a full batch or max_wait..
+        encode in its own task
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.has_pending.wait()
+            # documents keep queuing-up while all slots are busy, so the next batch is fuller
+            await self.slots.acquire()
+            # the wait is counted from the oldest request, so documents which queued-up while
+            # the previous batch was encoding are flushed right away
+            timeout = self.pending[0][2] + self.max_wait - loop.time()
+            if len(self.pending) < self.max_batch_size and timeout > 0:
+                self.is_full.clear()
+                try:
+                    await asyncio.wait_for(self.is_full.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self.pending[:self.max_batch_size]
+            del self.pending[:self.max_batch_size]
+            if not len(self.pending):
+                self.has_pending.clear()
+            task = loop.create_task(self._encode_batch(batch))
+            self.encoding.add(task)
+            task.add_done_callback(self._encoded)
+
+    def _encoded(self, task: asyncio.Task) -> None:
+        self.encoding.discard(task)
+        self.slots.release()
+
+    # -------------------------------------------------------------------------
+    async def _encode_batch(self, batch: list[tuple]) -> None:
+        batch = [item for item in batch if not item[1].cancelled()]  # client went away
+        if not len(batch):
+            return
+        documents = [item[0] for item in batch]
+        metrics.observe_batch(self.model_name, "encode", len(documents))
+        started = perf_counter()
+        try:
+            embeddings = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.encode, documents)
+            metrics.observe_stage(self.model_name, "encode", started)
+        except asyncio.CancelledError:
+            for _, future, _ in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            logging.error(f"{self.me}: encoding batch of {len(documents)} failed: {str(e)}")
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+    # -------------------------------------------------------------------------
+    async def close(self) -> None:
+        "stops the scheduler, requests still waiting for a batch or being encoded are cancelled"
+        if self.task is None:
+            return
+        self.task.cancel()
+        for task in list(self.encoding):
+            task.cancel()
+        await asyncio.gather(self.task, *self.encoding, return_exceptions=True)
+        for _, future, _ in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.task = None
@@ -0,0 +1,383 @@
+"""
+load-generation benchmark: drives a running server (--url) or the library in-process (--library:
+an EmbeddingService & its database commit process, like a 1 worker server) with 1 or more
+scenarios, each swept over batch sizes x concurrencies, & prints 1 JSON line per run (throughput,
+p50/p95/p99 latency, ...) to compare across commits, e.g. appended to a file with --output.
+Scenarios, of the documents requested:
+* all-hit: --docs documents cached by a warm-up pass b4 the runs
+* all-miss: new documents
+* mixed: each document is 1 of the warmed ones with probability --hit-ratio, else new
+* zipf: drawn from --docs documents (new to each run) with Zipfian popularity (--zipf-s), so the
+  popular ones are computed once & hit afterwards
+Run the server with (or pass) --stub-model to benchmark the cache & index paths without torch.
+A request of 1 document goes to '/', of more to '/batch'. Latency is the request's, the writes
+of its misses run after it (as the server's background tasks)
+"""
+import argparse
+import asyncio
+import json
+import logging
+import numpy as np
+import os
+import subprocess
+
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count, product
+from signal import default_int_handler, SIGINT, signal
+from sys import stderr
+from time import perf_counter, sleep
+from urllib.parse import urlencode, urlsplit
+from uuid import uuid4
+
+SCENARIOS = ["all-hit", "all-miss", "mixed", "zipf"]
+DOCUMENT = "The paper was made in Bohemia, I said."     # without --corpus
+WARM_BATCH_CNT = 256    # documents per request of the warm-up pass
+STOP_COMMIT_PROCESS_TIMEOUT = 5     # secs, then it's killed
+WAIT_COMMIT_PROCESS_TIMEOUT = 10    # secs, for it to wait for this process' registration
+
+
+def get_commit() -> str | None:
+    "the checked-out commit of this repo, 'dirty' if it has changes, None outside git"
+    dirpath = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=dirpath,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                 cwd=dirpath, capture_output=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if changes.strip() else commit
+
+def load_corpus(corpus_path: str | None) -> list[str]:
+    "the corpus' non-empty lines, documents are made unique by a suffix"
+    if corpus_path is None:
+        return [DOCUMENT]
+    with open(corpus_path, "r", encoding="utf-8", errors="replace") as f:
+        corpus = [line.rstrip("\r\n") for line in f if line.strip()]
+    if not len(corpus):
+        raise ValueError(f'"{corpus_path}" has no documents')
+    return corpus
+
+# -----------------------------------------------------------------------------
+class Workload:
+    "the documents requested by 1 run of a scenario"
+    def __init__(self, scenario: str, corpus: list[str], warm_documents: list[str],
+                 docs_cnt: int, hit_ratio: float, zipf_s: float, seed: int):
+        self.scenario = scenario
+        self.corpus = corpus
+        self.warm_documents = warm_documents
+        self.hit_ratio = hit_ratio
+        self.rng = np.random.default_rng(seed)
+        self.prefix = uuid4().hex[:12]  # new documents are new to the caches of previous runs
+        self.misses = count()
+        if scenario == "zipf":
+            # P(rank k) ~ 1 / k^s, drawn by inverting the cdf
+            weights = 1 / np.arange(1, docs_cnt + 1, dtype=np.float64) ** zipf_s
+            self.cdf = np.cumsum(weights) / weights.sum()
+
+    def get_document(self, kind: str, i: int) -> str:
+        return f"{self.corpus[i % len(self.corpus)]} [{self.prefix}{kind}{i}]"
+
+    def next_batch(self, cnt: int) -> list[str]:
+        if self.scenario == "all-hit":
+            return [self.warm_documents[i]
+                    for i in self.rng.integers(len(self.warm_documents), size=cnt)]
+        if self.scenario == "all-miss":
+            return [self.get_document("m", next(self.misses)) for _ in range(cnt)]
+        if self.scenario == "mixed":
+            return [self.warm_documents[self.rng.integers(len(self.warm_documents))] if hit
+                    else self.get_document("m", next(self.misses))
+                    for hit in self.rng.random(cnt) < self.hit_ratio]
+        ranks = np.minimum(np.searchsorted(self.cdf, self.rng.random(cnt)), len(self.cdf) - 1)
+        return [self.get_document("z", rank) for rank in ranks.tolist()]
+
+# -----------------------------------------------------------------------------
+class HttpTarget:
+    """
+    a running server, over HTTP/1.1 keep-alive connections (1 per concurrent request, reused by
+    the next ones), read whole: the benchmark measures the server, not a client library
+    """
+    def __init__(self, url: str, model_name: str | None):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 80
+        self.path = parts.path.rstrip("/")
+        self.query = f"?{urlencode({'model_name': model_name})}" if model_name else ""
+        self.connections = []   # idle (reader, writer)
+
+    async def embed(self, documents: list[str]) -> None:
+        if len(documents) == 1:
+            path, body = "/", urlencode({"document": documents[0]})
+        else:
+            path, body = "/batch", urlencode([("documents", document) for document in documents])
+        body = body.encode("utf-8")
+        if len(self.connections):
+            reader, writer = self.connections.pop()
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(f"POST {self.path}{path}{self.query} HTTP/1.1\r\n"
+                         f"Host: {self.host}:{self.port}\r\n"
+                         "Content-Type: application/x-www-form-urlencoded\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError("connection closed by the server")
+            status = int(status_line.split()[1])
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            await reader.readexactly(int(headers.get("content-length", 0)))
+        except BaseException:
+            writer.close()
+            raise
+        if headers.get("connection", "").lower() == "close":
+            writer.close()
+        else:
+            self.connections.append((reader, writer))
+        if status != 200:
+            raise RuntimeError(f"HTTP {status}")
+
+    async def drain(self) -> None:
+        "the server writes in the background, nothing to wait for"
+
+    async def close(self) -> None:
+        for _, writer in self.connections:
+            writer.close()
+        self.connections = []
+
+
+class LibraryTarget:
+    """
+    the library in-process: an EmbeddingService & its database commit process, which this process
+    registers with as its only worker. Requests run get_embeddings_batch in a thread pool, the
+    writes of their misses run after them in another
+    """
+    def __init__(self, args: argparse.Namespace, max_concurrency: int):
+        # importing databaseCommitProcess 1st (circular import), only for --library
+        from databaseCommitProcess import DatabaseCommitProcess
+        from embeddingService import EmbeddingService
+        service_args = Namespace(data_dir=args.data_dir, db_type=args.db_type, workers=1,
+                                 hot_cache_mb=args.hot_cache_mb, cache_shards=args.cache_shards,
+                                 stub_model=args.stub_model, stub_encode_ms=args.stub_encode_ms)
+        EmbeddingService.setup_models_dirs(EmbeddingService.get_models_cfg(args.data_dir))
+        # the commit process truncates the pids file, registering b4 that would be lost
+        try:
+            os.remove(DatabaseCommitProcess.WORKER_PIDS_FILE)
+        except FileNotFoundError:
+            pass
+        self.commit_process = DatabaseCommitProcess(service_args)
+        self.commit_process.start()
+        deadline = perf_counter() + WAIT_COMMIT_PROCESS_TIMEOUT
+        while not os.path.exists(DatabaseCommitProcess.WORKER_PIDS_FILE):
+            if perf_counter() > deadline or not self.commit_process.is_alive():
+                self.stop_commit_process()
+                raise TimeoutError("the database commit process didn't start")
+            sleep(0.05)
+        if not DatabaseCommitProcess.register_worker(os.getpid()):
+            self.stop_commit_process()
+            raise TimeoutError("timed-out registering with the database commit process")
+        self.es = EmbeddingService(service_args)
+        # Model's handlers only close the link to the commit process, Ctrl-C should stop a run
+        signal(SIGINT, default_int_handler)
+        self.model_name = args.model or next(iter(self.es.models), None)
+        if self.model_name not in self.es.models:
+            self.close_link()
+            self.stop_commit_process()
+            raise ValueError(f'model "{self.model_name}" is not loaded, see models.txt')
+        self.executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix="request")
+        self.write_executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix="write")
+        self.writes = []
+
+    async def embed(self, documents: list[str]) -> None:
+        loop = asyncio.get_running_loop()
+        _, to_write = await loop.run_in_executor(self.executor, self.es.get_embeddings_batch,
+                                                 documents, self.model_name)
+        if to_write is not None:
+            self.writes.append(loop.run_in_executor(self.write_executor,
+                                                    self.es.write_embeddings_batch, *to_write))
+
+    async def drain(self) -> None:
+        "waits for the writes of the requests so far"
+        writes, self.writes = self.writes, []
+        await asyncio.gather(*writes)
+
+    async def close(self) -> None:
+        await self.drain()
+        self.executor.shutdown()
+        self.write_executor.shutdown()
+        self.close_link()
+        self.stop_commit_process()
+
+    def close_link(self) -> None:
+        for model in self.es.models.values():
+            model.clean_up()
+
+    def stop_commit_process(self) -> None:
+        "SIGINT lets it unlink its shared memory"
+        if self.commit_process.is_alive():
+            os.kill(self.commit_process.pid, SIGINT)
+            self.commit_process.join(STOP_COMMIT_PROCESS_TIMEOUT)
+            if self.commit_process.is_alive():
+                self.commit_process.kill()
+                self.commit_process.join()
+
+# -----------------------------------------------------------------------------
+async def warm_up(target, documents: list[str], settle_secs: float) -> None:
+    "caches documents, then waits settle_secs for the index commits"
+    for i in range(0, len(documents), WARM_BATCH_CNT):
+        await target.embed(documents[i:i + WARM_BATCH_CNT])
+    await target.drain()
+    await asyncio.sleep(settle_secs)
+
+async def run(target, workload: Workload, batch_cnt: int, concurrency: int, requests_cnt: int
+) -> dict:
+    "sends requests_cnt requests of batch_cnt documents, concurrency @ a time"
+    latencies = []
+    errors = []
+    remaining = iter(range(requests_cnt))   # shared by the clients
+
+    async def client() -> None:
+        for _ in remaining:
+            documents = workload.next_batch(batch_cnt)
+            started = perf_counter()
+            try:
+                await target.embed(documents)
+            except Exception as e:
+                if not len(errors):
+                    logging.warning(f"request failed: {e!r}")
+                errors.append(e)
+            else:
+                latencies.append(perf_counter() - started)
+
+    started = perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    secs = perf_counter() - started
+    await target.drain()
+    latencies_ms = np.array(latencies) * 1000
+    stats = {"p50": 50, "p95": 95, "p99": 99}
+    return {"requests": len(latencies), "documents": len(latencies) * batch_cnt,
+            "errors": len(errors), "secs": round(secs, 4),
+            "requests_per_sec": round(len(latencies) / secs, 2),
+            "documents_per_sec": round(len(latencies) * batch_cnt / secs, 2),
+            "latency_ms": ({name: round(float(np.percentile(latencies_ms, q)), 3)
+                            for name, q in stats.items()}
+                           | {"mean": round(float(latencies_ms.mean()), 3),
+                              "max": round(float(latencies_ms.max()), 3)})
+                          if len(latencies) else None}
+
+def get_target(args: argparse.Namespace) -> HttpTarget | LibraryTarget:
+    "b4 the event loop: the commit process of --library mustn't inherit asyncio's SIGINT handler"
+    if args.library:
+        return LibraryTarget(args, max(args.concurrency))
+    return HttpTarget(args.url, args.model)
+
+async def benchmark(args: argparse.Namespace, target: HttpTarget | LibraryTarget) -> list[dict]:
+    "all runs: scenarios x batch sizes x concurrencies, returns their reports & closes target"
+    settings = {"target": "library" if args.library else args.url, "commit": get_commit()}
+    if args.library:
+        settings |= {"model": target.model_name, "db_type": args.db_type,
+                     "stub_model": args.stub_model, "stub_encode_ms": args.stub_encode_ms}
+    reports = []
+    try:
+        corpus = load_corpus(args.corpus)
+        warm_documents = []
+        if any(scenario in ("all-hit", "mixed") for scenario in args.scenarios):
+            warm_prefix = uuid4().hex[:12]
+            warm_documents = [f"{corpus[i % len(corpus)]} [{warm_prefix}w{i}]"
+                              for i in range(args.docs)]
+            logging.info(f"warming-up {len(warm_documents)} documents")
+            await warm_up(target, warm_documents, args.settle_secs)
+        seeds = count(args.seed)
+        for scenario, batch_cnt, concurrency in product(args.scenarios, args.batch,
+                                                        args.concurrency):
+            workload = Workload(scenario, corpus, warm_documents, args.docs, args.hit_ratio,
+                                args.zipf_s, next(seeds))
+            params = {"batch": batch_cnt, "concurrency": concurrency}
+            if scenario == "mixed":
+                params["hit_ratio"] = args.hit_ratio
+            elif scenario == "zipf":
+                params |= {"docs": args.docs, "zipf_s": args.zipf_s}
+            logging.info(f"running {scenario} {params}")
+            report = {"scenario": scenario} | params | await run(
+                    target, workload, batch_cnt, concurrency, args.requests) | settings
+            print(json.dumps(report), flush=True)
+            if args.output is not None:
+                with open(args.output, "a", encoding="utf-8") as f:
+                    print(json.dumps(report), file=f)
+            reports.append(report)
+    finally:
+        await target.close()
+    return reports
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument("--url",
+            help="benchmark the server running @ this url, e.g. 'http://127.0.0.1:8009'")
+    target_group.add_argument("--library",
+            action="store_true",
+            help="benchmark the library in-process (the server must not be running on the same"
+                 " data directory)")
+    parser.add_argument("-b", "--batch",
+            nargs="+", default=[1], type=int,
+            help="optional: documents per request, 1 or more (1 run each), default: 1")
+    parser.add_argument("-c", "--concurrency",
+            nargs="+", default=[1], type=int,
+            help="optional: requests in flight, 1 or more (1 run each), default: 1")
+    parser.add_argument("--corpus",
+            help="optional: text file, 1 document per line, of the documents' text (made unique"
+                 " by a suffix), default: 1 sentence")
+    parser.add_argument("--docs",
+            help="optional: documents warmed-up (all-hit & mixed) or drawn from (zipf),"
+                 " default: 10000",
+            default=10000, type=int)
+    parser.add_argument("--hit-ratio",
+            help="optional: mixed's probability that a document is a warmed-up one, default: 0.9",
+            default=0.9, type=float)
+    parser.add_argument("-m", "--model",
+            help="optional: model name, default: the server's default model (--url) or the 1st"
+                 " model loaded (--library)")
+    parser.add_argument("-n", "--requests",
+            help="optional: requests per run, default: 1000",
+            default=1000, type=int)
+    parser.add_argument("-o", "--output",
+            help="optional: also append the reports (JSON lines) to this file")
+    parser.add_argument("-s", "--scenarios",
+            nargs="+", choices=SCENARIOS, default=SCENARIOS,
+            help="optional: 1 or more scenarios, default: all")
+    parser.add_argument("--seed",
+            help="optional: seed of the 1st run's random draws, default: 0",
+            default=0, type=int)
+    parser.add_argument("--settle-secs",
+            help="optional: wait after the warm-up for the index commits, default: 1",
+            default=1, type=float)
+    parser.add_argument("--zipf-s",
+            help="optional: zipf's exponent, larger concentrates requests on fewer documents,"
+                 " default: 1.1",
+            default=1.1, type=float)
+    library_group = parser.add_argument_group("--library options, as the server's")
+    library_group.add_argument("--cache-shards",
+            default=1, type=int)
+    library_group.add_argument("-d", "--data-dir",
+            default="data")
+    library_group.add_argument("--hot-cache-mb",
+            default=64, type=float)
+    library_group.add_argument("--stub-model",
+            action="store_true")
+    library_group.add_argument("--stub-encode-ms",
+            default=0, type=float)
+    library_group.add_argument("-t", "--db-type",
+            choices=["duckdb", "hashtable", "leveldb", "sqlite"],
+            default="sqlite")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO, stream=stderr)
+    if min(args.batch + args.concurrency + [args.docs, args.requests]) < 1:
+        parser.error("--batch, --concurrency, --docs & --requests must be at least 1")
+
+    asyncio.run(benchmark(args, get_target(args)))
@@ -0,0 +1,303 @@
+"""
+a model's cache file (embeddings.bin) of fixed-size embedding vectors.
+Reads are served from 1 persistent read-only memory map of the file, the file is only remapped
+when an offset past the mapped length is requested (i.e. the file has grown since it was mapped).
+Writes go through 1 persistent append handle, serialized across processes with a FileLock.
+Vectors are stored as float32, float16 or int8 (+ 1 float32 scale per vector), see STORAGE_DTYPES,
+all reads return float32. The storage dtype is recorded next to the file (embeddings.json).
+With write_ahead, each append first records the digests of its vectors & their offsets in a
+write-ahead log (embeddings.wal), so that start-up recovery can index vectors which were written
+but whose index rows were lost (see recoverCache.py). Once the database commit process has
+committed the index rows of a prefix of the log, it records the log's position past them (the
+mark, embeddings.walmark) & empties the log when that's all of it (see trim_write_ahead).
+A sealed file can be retired (deleted) by the database commit process's eviction while serving
+(see CacheShards.retire): appends to it then return FILE_FULL & reads past its mapping miss
+"""
+import json
+import logging
+import mmap
+import numpy as np
+import os
+
+from filelock import Timeout, FileLock
+from collections.abc import Iterator
+from struct import Struct
+from threading import Lock
+from time import perf_counter
+
+import metrics
+
+STORAGE_DTYPES = ["float32", "float16", "int8"]
+INT8_MAX = 127
+FILE_FULL = -1  # returned by append when the data would grow the file past its size cap
+WAL_RECORD = Struct("<32sq")    # digest, offset
+WAL_DTYPE = np.dtype([("digest", "V32"), ("offset", "<i8")])   # WAL_RECORD as an array
+WAL_MARK = Struct("<q")     # position in the log before which all records are indexed
+
+
+class CacheFile:
+    def __init__(self, path: str, embedding_dimension: int, lock_path: str, lock_timeout: float,
+                 storage_dtype: str = "float32", write_ahead: bool = False):
+        self.path = path
+        self.wal_path = os.path.splitext(path)[0] + ".wal"
+        self.wal_mark_path = os.path.splitext(path)[0] + ".walmark"
+        self.write_ahead = write_ahead
+        self.embedding_dimension = embedding_dimension
+        self.storage_dtype = self._check_storage_dtype(storage_dtype)
+        self.dtype = self.get_dtype(self.storage_dtype, embedding_dimension)
+        self.vector_nbytes = self.dtype.itemsize   # bytes per stored vector
+        self.mapping = (None, 0)    # (mmap, mapped length), replaced as 1 attribute by _remap
+        self.remap_lock = Lock()
+        self.append_file = None     # opened on 1st append
+        self.wal_file = None
+        self.lock = FileLock(lock_path, timeout=lock_timeout)
+        self.me = self.__class__.__name__
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_dtype(storage_dtype: str, embedding_dimension: int) -> np.dtype:
+        "numpy dtype of 1 stored vector"
+        if storage_dtype == "int8":     # scale, then the quantized values
+            return np.dtype([("scale", "<f4"), ("values", "i1", (embedding_dimension,))])
+        return np.dtype((f"<f{4 if storage_dtype == 'float32' else 2}", (embedding_dimension,)))
+
+    def _check_storage_dtype(self, storage_dtype: str) -> str:
+        """
+        the storage dtype recorded for the file wins over the configured one, a file without a
+        record was written before storage dtypes (float32) unless it's empty
+        """
+        if storage_dtype not in STORAGE_DTYPES:
+            raise ValueError(f"storage dtype must be one of {STORAGE_DTYPES}, "
+                             f'got "{storage_dtype}"')
+        meta_path = os.path.splitext(self.path)[0] + ".json"
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                recorded = json.load(f)["storage_dtype"]
+        except FileNotFoundError:
+            recorded = None
+            if os.path.exists(self.path) and os.path.getsize(self.path):
+                recorded = "float32"
+        if recorded is not None and recorded != storage_dtype:
+            logging.error(f'"{self.path}" stores {recorded} vectors, not {storage_dtype} as '
+                          f"configured, using {recorded} (compact it into a new file to convert)")
+            storage_dtype = recorded
+        if not os.path.exists(meta_path):
+            temp_path = f"{meta_path}.{os.getpid()}"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"storage_dtype": storage_dtype,
+                           "embedding_dimension": self.embedding_dimension}, f)
+            os.replace(temp_path, meta_path)
+        return storage_dtype
+
+    # -------------------------------------------------------------------------
+    def encode(self, embeddings: np.ndarray) -> np.ndarray:
+        "(n, dim) float32 embeddings -> n vectors in the storage dtype (tobytes() to write them)"
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.embedding_dimension)
+        if self.storage_dtype == "float32":
+            return embeddings
+        if self.storage_dtype == "float16":
+            return embeddings.astype("<f2")
+        # symmetric per vector: the largest magnitude maps to +-127
+        scales = np.abs(embeddings).max(axis=1) / INT8_MAX
+        scales[scales == 0] = 1
+        records = np.empty(len(embeddings), dtype=self.dtype)
+        records["scale"] = scales
+        records["values"] = np.rint(embeddings / scales[:, None]).clip(-INT8_MAX, INT8_MAX)
+        return records
+
+    def decode(self, vectors: np.ndarray) -> np.ndarray:
+        "stored vectors (as returned by encode or read from the file) -> (n, dim) float32"
+        if self.storage_dtype == "int8":
+            return vectors["values"].astype(np.float32) * vectors["scale"][:, None]
+        return vectors.astype(np.float32, copy=False)
+
+    # -------------------------------------------------------------------------
+    def _remap(self, min_length: int) -> tuple[mmap.mmap, int]:
+        with self.remap_lock:
+            if self.mapping[1] >= min_length:   # another thread already remapped
+                return self.mapping
+            try:
+                f = open(self.path, "rb")
+            except FileNotFoundError:   # retired
+                raise EOFError(f'{self.me}: "{self.path}" was retired')
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                if size < min_length:
+                    raise EOFError(f"{self.me}: {min_length} bytes needed, "
+                                   f'"{self.path}" has {size}')
+                # the previous map is not closed, views of it which were handed out stay valid
+                # & it's released once the last of them is garbage collected
+                self.mapping = (mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ), size)
+            return self.mapping
+
+    def _get_mapping(self, min_length: int) -> tuple[mmap.mmap, int]:
+        mapping = self.mapping
+        return mapping if mapping[1] >= min_length else self._remap(min_length)
+
+    # -------------------------------------------------------------------------
+    def read(self, offset: int) -> np.ndarray | None:
+        """
+        the float32 vector @ offset (bytes), None if it's past EOF: a zero-copy, read-only view
+        of the file for float32 storage, else a dequantized copy
+        """
+        try:
+            buffer, _ = self._get_mapping(offset + self.vector_nbytes)
+        except EOFError as e:
+            logging.error(f"read: offset {offset}: {str(e)}")
+            return None
+        return self.decode(np.frombuffer(buffer, dtype=self.dtype, count=1, offset=offset))[0]
+
+    # -------------------------------------------------------------------------
+    def read_many(self, offsets: list[int]) -> np.ndarray | None:
+        """
+        gathers the vectors @ offsets into a new (len(offsets), dim) float32 matrix with 1
+        vectorized copy (& dequantization), None if any of them is past EOF
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if not len(offsets):
+            return np.empty((0, self.embedding_dimension), dtype=np.float32)
+        try:
+            buffer, length = self._get_mapping(int(offsets.max()) + self.vector_nbytes)
+        except EOFError as e:
+            logging.error(f"read_many: {str(e)}")
+            return None
+        if (offsets % self.vector_nbytes).any():    # not vector-aligned, can't view as an array
+            return self.decode(np.concatenate([
+                    np.frombuffer(buffer, dtype=self.dtype, count=1, offset=offset)
+                    for offset in offsets.tolist()]))
+        vectors = np.frombuffer(buffer, dtype=self.dtype, count=length // self.vector_nbytes)
+        return self.decode(vectors[offsets // self.vector_nbytes])
+
+    def read_rows(self, start: int, cnt: int) -> np.ndarray | None:
+        """
+        the cnt adjacent vectors from the start-th one as a (cnt, dim) float32 matrix, None if
+        they're past EOF: a zero-copy view of the file for float32 storage (see exactSearch.py)
+        """
+        try:
+            buffer, _ = self._get_mapping((start + cnt) * self.vector_nbytes)
+        except EOFError as e:
+            logging.error(f"read_rows: {str(e)}")
+            return None
+        return self.decode(np.frombuffer(buffer, dtype=self.dtype, count=cnt,
+                                         offset=start * self.vector_nbytes))
+
+    # -------------------------------------------------------------------------
+    def append(self, data: bytes, max_nbytes: int = 0, document_hashes: list[bytes] | None = None
+    ) -> int | None:
+        """
+        appends data (1 or more whole vectors) to the end of the file while holding the
+        cross-process lock, returns the offset it was written @ or None if the lock timed-out.
+        max_nbytes > 0 caps the file's size: returns FILE_FULL instead of growing a non-empty
+        file past it (or appending to a retired file). document_hashes (1 per vector) go to the
+        write-ahead log 1st
+        """
+        if self.append_file is None:
+            self.append_file = open(self.path, "ab", buffering=0)
+        if self.write_ahead and self.wal_file is None:
+            self.wal_file = open(self.wal_path, "ab", buffering=0)
+        started = perf_counter()
+        try:
+            self.lock.acquire()
+        except Timeout:
+            logging.error(f'timed-out acquiring lockfile to write to "{self.path}", giving up...')
+            return None
+        metrics.observe_lock_wait(self.lock.lock_file, started)
+        try:
+            stat = os.fstat(self.append_file.fileno())
+            offset = stat.st_size
+            if stat.st_nlink == 0:  # retired, the vectors would be unreachable
+                return FILE_FULL
+            if max_nbytes > 0 and offset > 0 and offset + len(data) > max_nbytes:
+                return FILE_FULL
+            logged = self.write_ahead and document_hashes is not None
+            wal_size = os.fstat(self.wal_file.fileno()).st_size if logged else 0
+            try:
+                if logged:
+                    self.wal_file.write(b"".join(
+                            WAL_RECORD.pack(document_hash, offset + i * self.vector_nbytes)
+                            for i, document_hash in enumerate(document_hashes)))
+                self.append_file.write(data)
+            except BaseException:
+                # e.g. ENOSPC: both files back to their sizes b4 this append, else the log
+                # would hold records of vectors which the next append writes other vectors over
+                self._undo_append(offset, wal_size if logged else None)
+                raise
+        finally:
+            self.lock.release()
+        return offset
+
+    def _undo_append(self, offset: int, wal_size: int | None) -> None:
+        "call with the lock held"
+        try:
+            if wal_size is not None:
+                os.ftruncate(self.wal_file.fileno(), wal_size)
+            os.ftruncate(self.append_file.fileno(), offset)
+        except OSError as e:    # records left of vectors written over are skipped by recovery
+            logging.error(f'failed to undo a failed append to "{self.path}": {e!r}')
+
+    # -------------------------------------------------------------------------
+    def get_write_ahead_mark(self) -> int:
+        """
+        the log's position before which all records are indexed, 0 if there's no mark or it's
+        past the log's end (the log was emptied by hand), i.e. the whole log is checked
+        """
+        try:
+            with open(self.wal_mark_path, "rb") as f:
+                pos = WAL_MARK.unpack(f.read(WAL_MARK.size))[0]
+            return pos if 0 <= pos <= os.path.getsize(self.wal_path) else 0
+        except FileNotFoundError:
+            return 0
+        except Exception as e:  # e.g. a torn mark
+            logging.error(f'"{self.wal_mark_path}": {e!r}')
+            return 0
+
+    def _set_write_ahead_mark(self, pos: int) -> None:
+        temp_path = f"{self.wal_mark_path}.{os.getpid()}"
+        with open(temp_path, "wb") as f:
+            f.write(WAL_MARK.pack(pos))
+        os.replace(temp_path, self.wal_mark_path)
+
+    def read_write_ahead(self, start: int, cnt: int) -> Iterator[tuple[int, np.ndarray]]:
+        """
+        the log's whole records from position start on, in chunks of up to cnt records: yields
+        (position of the chunk, its records as a WAL_DTYPE array)
+        """
+        if not os.path.exists(self.wal_path):
+            return
+        with open(self.wal_path, "rb") as f:
+            pos = start
+            while True:
+                f.seek(pos)
+                records = np.fromfile(f, dtype=WAL_DTYPE, count=cnt)
+                if not len(records):
+                    return
+                yield pos, records
+                pos += len(records) * WAL_RECORD.size
+
+    def trim_write_ahead(self, pos: int, lock_timeout: float) -> bool:
+        """
+        the records before position pos of the log are indexed & committed: empties the log if
+        that's all of it, else moves the mark to pos. False if the lock timed-out (try later)
+        """
+        try:
+            self.lock.acquire(timeout=lock_timeout)
+        except Timeout:
+            return False
+        try:    # appends to the log are held while the lock is
+            if os.path.getsize(self.wal_path) > pos:
+                self._set_write_ahead_mark(pos)
+            else:   # the mark 1st: a crash in between leaves the whole log to check, not none
+                self._set_write_ahead_mark(0)
+                os.truncate(self.wal_path, 0)
+        finally:
+            self.lock.release()
+        return True
+
+    # -------------------------------------------------------------------------
+    def close(self) -> None:
+        if self.append_file is not None:
+            self.append_file.close()
+            self.append_file = None
+        if self.wal_file is not None:
+            self.wal_file.close()
+            self.wal_file = None
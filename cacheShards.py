@@ -0,0 +1,214 @@
+"""
+a model's cache split over several cache files, so that writers in different workers don't all
+queue on 1 file lock: a document's shard is picked by its digest's prefix, each shard appends to
+its own file (own lock & append handle). A shard's file which reached the size cap is sealed &
+the shard continues in a new file, file ids of shard k are k, k + shards, k + 2 * shards...
+The index stores a location, the file id & the offset in that file packed into 1 int64, file 0
+is embeddings.bin, so locations of an unsharded cache are plain offsets.
+To cap the cache while serving, the database commit process retires (deletes) a shard's oldest
+sealed files once their rows are moved or evicted (see compactCache.evict_files): a file id is
+never used again, so a location read from an index which hasn't caught up is a miss, never
+another document's vector
+"""
+import numpy as np
+import os
+import re
+
+from contextlib import suppress
+from filelock import Timeout
+from threading import Lock
+from time import monotonic
+
+from cacheFile import CacheFile, FILE_FULL
+
+LOCATION_SHIFT = 40     # bits of the offset in a location, i.e. up to 1 TiB per file
+OFFSET_MASK = (1 << LOCATION_SHIFT) - 1
+CACHE_FILENAME_RE = re.compile(r"embeddings(?:\.(\d+))?\.bin$")
+RETIRED_CHECK_SECS = 10     # open files which were retired are let go this often
+
+
+class CacheShards:
+    def __init__(self, dirpath: str, embedding_dimension: int, lock_path: str,
+                 lock_timeout: float, storage_dtype: str = "float32", cnt_shards: int = 1,
+                 max_shard_nbytes: int = 0, write_ahead: bool = False):
+        self.dirpath = dirpath
+        self.embedding_dimension = embedding_dimension
+        self.lock_path = lock_path  # of file 0, other files' locks are named after it
+        self.lock_timeout = lock_timeout
+        self.storage_dtype = storage_dtype  # of files created from now on
+        self.cnt_shards = max(cnt_shards, 1)
+        self.max_shard_nbytes = max_shard_nbytes    # per file, 0: no cap
+        self.write_ahead = write_ahead  # see CacheFile
+        self.files = {}     # file id -> CacheFile, opened on 1st use
+        self.files_lock = Lock()
+        self.retired_checked = monotonic()
+        # newest file of each shard, moves on (in append) when it's full
+        self.active_ids = self.get_newest_ids()
+        # the dtype of the file a shard appends to can differ (e.g. an older embeddings.bin),
+        # "stored" responses use shard 0's
+        self.storage_dtype = self.get_file(self.active_ids[0], create=True).storage_dtype
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_filename(file_id: int) -> str:
+        return "embeddings.bin" if file_id == 0 else f"embeddings.{file_id:03d}.bin"
+
+    def get_file_ids(self) -> list[int]:
+        "ids of the cache files in the model's directory"
+        file_ids = []
+        for filename in os.listdir(self.dirpath):
+            match = CACHE_FILENAME_RE.match(filename)
+            if match is not None:
+                file_ids.append(int(match.group(1) or 0))
+        return sorted(file_ids)
+
+    def get_newest_ids(self) -> list[int]:
+        "id of the newest file of each shard, the shard's 1st id if it has none"
+        file_ids = self.get_file_ids()
+        return [max([file_id for file_id in file_ids if file_id % self.cnt_shards == shard],
+                    default=shard)
+                for shard in range(self.cnt_shards)]
+
+    def get_file(self, file_id: int, create: bool = False) -> CacheFile | None:
+        "None if the file doesn't exist & create is False"
+        if monotonic() - self.retired_checked > RETIRED_CHECK_SECS:
+            self._drop_retired()
+        cache_file = self.files.get(file_id)
+        if cache_file is not None:
+            return cache_file
+        with self.files_lock:
+            cache_file = self.files.get(file_id)
+            if cache_file is not None:
+                return cache_file
+            path = os.path.join(self.dirpath, self.get_filename(file_id))
+            if not os.path.exists(path):
+                if not create:
+                    return None
+                with open(path, "ab"):
+                    pass
+            lock_path = (self.lock_path if file_id == 0 else
+                         f"{os.path.splitext(self.lock_path)[0]}.{file_id:03d}.lock")
+            cache_file = self.files[file_id] = CacheFile(path, self.embedding_dimension,
+                    lock_path, self.lock_timeout, self.storage_dtype, self.write_ahead)
+            return cache_file
+
+    def _drop_retired(self) -> None:
+        """
+        lets go of the open files which were retired: their handles & maps are closed once the
+        threads still using them are done (garbage collected), only then is their space freed
+        """
+        with self.files_lock:
+            self.retired_checked = monotonic()
+            for file_id in [file_id for file_id, cache_file in self.files.items()
+                            if not os.path.exists(cache_file.path)]:
+                del self.files[file_id]
+
+    def retire(self, file_id: int) -> bool:
+        """
+        deletes a sealed file (& its log) whose rows were dropped from the index, False if its
+        lock timed-out. Appends to it which were waiting on the lock return FILE_FULL
+        """
+        cache_file = self.get_file(file_id)
+        if cache_file is None:
+            return True
+        try:
+            cache_file.lock.acquire()
+        except Timeout:
+            return False
+        try:
+            for path in (cache_file.path, os.path.splitext(cache_file.path)[0] + ".json",
+                         cache_file.wal_path, cache_file.wal_mark_path):
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+        finally:
+            cache_file.lock.release()
+        with self.files_lock:
+            self.files.pop(file_id, None)
+        return True
+
+    def is_sealed(self, file_id: int) -> bool:
+        "the shard of the file continues in a newer one (or the file was retired)"
+        return (os.path.exists(os.path.join(self.dirpath,
+                                            self.get_filename(file_id + self.cnt_shards)))
+                or not os.path.exists(os.path.join(self.dirpath, self.get_filename(file_id))))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def pack_location(file_id: int, offset: int) -> int:
+        return (file_id << LOCATION_SHIFT) | offset
+
+    @staticmethod
+    def unpack_location(location: int) -> tuple[int, int]:
+        return location >> LOCATION_SHIFT, location & OFFSET_MASK
+
+    def get_shard(self, document_hash: bytes) -> int:
+        "documents are spread over the shards by the 1st bytes of their digest (uniform)"
+        return int.from_bytes(document_hash[:4], "little") % self.cnt_shards
+
+    # -------------------------------------------------------------------------
+    def encode(self, embeddings: np.ndarray) -> np.ndarray:
+        "embeddings in the storage dtype of shard 0's file, see CacheFile.encode"
+        return self.get_file(self.active_ids[0], create=True).encode(embeddings)
+
+    # -------------------------------------------------------------------------
+    def append(self, shard: int, embeddings: np.ndarray,
+               document_hashes: list[bytes] | None = None) -> list[int] | None:
+        """
+        appends the rows of embeddings (float32) to the shard's file with 1 locked write,
+        returns their locations or None if the file's lock timed-out.
+        document_hashes: of the rows, for the write-ahead log
+        """
+        while True:
+            file_id = self.active_ids[shard]
+            if self.is_sealed(file_id):
+                # another worker moved on (& the file may be retired by now): the newest file,
+                # a retired id must not be created again
+                self.active_ids[shard] = file_id = max(file_id, self.get_newest_ids()[shard])
+            cache_file = self.get_file(file_id, create=True)
+            offset = cache_file.append(cache_file.encode(embeddings).tobytes(),
+                                       self.max_shard_nbytes, document_hashes)
+            if offset is None:
+                return None
+            if offset != FILE_FULL:
+                break
+            # full: this shard's next file, which another worker may already have started
+            if self.active_ids[shard] == file_id:
+                self.active_ids[shard] = max(file_id + self.cnt_shards,
+                                             self.get_newest_ids()[shard])
+        location = self.pack_location(file_id, offset)
+        return list(range(location, location + len(embeddings) * cache_file.vector_nbytes,
+                          cache_file.vector_nbytes))
+
+    # -------------------------------------------------------------------------
+    def read(self, location: int) -> np.ndarray | None:
+        "the float32 vector @ location, None if there's no such vector, see CacheFile.read"
+        file_id, offset = self.unpack_location(location)
+        cache_file = self.get_file(file_id)
+        return None if cache_file is None else cache_file.read(offset)
+
+    def read_many(self, locations: list[int]) -> np.ndarray | None:
+        """
+        gathers the vectors @ locations into a new (len(locations), dim) float32 matrix, 1
+        vectorized read per file, None if any of them doesn't exist
+        """
+        locations = np.asarray(locations, dtype=np.int64)
+        file_ids = locations >> LOCATION_SHIFT
+        offsets = locations & OFFSET_MASK
+        unique_ids = np.unique(file_ids)
+        if len(unique_ids) == 1:   # e.g. an unsharded cache
+            cache_file = self.get_file(int(unique_ids[0]))
+            return None if cache_file is None else cache_file.read_many(offsets)
+        vectors = np.empty((len(locations), self.embedding_dimension), dtype=np.float32)
+        for file_id in unique_ids.tolist():
+            cache_file = self.get_file(file_id)
+            rows = file_ids == file_id
+            file_vectors = None if cache_file is None else cache_file.read_many(offsets[rows])
+            if file_vectors is None:
+                return None
+            vectors[rows] = file_vectors
+        return vectors
+
+    # -------------------------------------------------------------------------
+    def close(self) -> None:
+        for cache_file in self.files.values():
+            cache_file.close()
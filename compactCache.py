@@ -0,0 +1,427 @@
+"""
+compacts a model's cache: vectors which no index row points to (left by a crash between the cache
+write & the index insert, by writes the database commit process dropped or by 2 workers caching
+the same document at once) are dropped, the live ones are copied (in runs of adjacent vectors)
+into new dense cache files & a new index is built for them. Can also convert the cache to another
+storage dtype & evict the least recently (or frequently) used documents to cap the cache's size,
+or those not used for a while, based on the access stats (see --track-access & accessStats.py).
+The compacted model directory is built next to the old one & swapped in with
+renames, an interrupted run is finished (or discarded) by the next one. What compaction doesn't
+rebuild (e.g. the token cache, precompute.py's progress) is hard-linked into it as is.
+Stop the server before running this, it rewrites the cache files & the index. The server can
+enforce the size caps itself (--max-cache-mb, --max-cache-vectors): its database commit process
+retires whole sealed cache files instead (see evict_files)
+"""
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import shutil
+import sqlite3
+
+from contextlib import closing
+from sys import stderr
+from tempfile import gettempdir
+from time import time
+
+from accessStats import AccessStats, RECORD as ACCESS_STATS_RECORD
+from cacheFile import CacheFile, STORAGE_DTYPES
+from cacheShards import CACHE_FILENAME_RE, CacheShards, LOCATION_SHIFT, OFFSET_MASK
+from documentStore import DocumentStore
+from indexDatabase import IndexDatabase
+
+COPY_CHUNK_NBYTES = 64 * 2**20  # max bytes read & written per copy step
+INDEX_CHUNK = 100000    # rows per index insert
+LOCK_PATH = os.path.join(gettempdir(), "compactCache.lock")    # the new files aren't shared
+EVICTION_POLICIES = ["lfu", "lru"]
+# model directory entries compaction rebuilds (cache files, index, access stats, stored documents)
+# or drops (write-ahead logs, the search index, other database types' indexes), any other entry
+# is carried over to the compacted directory
+REBUILT_PREFIXES = ("embeddings.", "indexDatabase", "hashIndex.", "accessStats.", "documents.db",
+                    "searchIndex.")
+
+
+def open_index(db_type: str, model_dirpath: str, readonly: bool) -> IndexDatabase:
+    if db_type == "sqlite":
+        from indexSQLite import IndexSQLite
+        return IndexSQLite(model_dirpath, readonly=readonly)
+    if db_type == "leveldb":
+        from indexLevelDB import IndexLevelDB
+        return IndexLevelDB(model_dirpath)
+    if db_type == "duckdb":
+        from indexDuckDB import IndexDuckDB
+        return IndexDuckDB(model_dirpath, readonly=readonly)
+    from indexHashTable import IndexHashTable
+    return IndexHashTable(model_dirpath, readonly=readonly)
+
+# -----------------------------------------------------------------------------
+def read_index(db_type: str, model_dirpath: str) -> tuple[np.ndarray, np.ndarray]:
+    "all rows of the model's index as (n, 32) uint8 digests & n int64 locations"
+    index = open_index(db_type, model_dirpath, readonly=True)
+    rows = read_rows(index)
+    del index
+    return rows
+
+def read_rows(index: IndexDatabase) -> tuple[np.ndarray, np.ndarray]:
+    "see read_index"
+    digests, locations = [], []
+    for document_hash, location in index.iter_rows():
+        digests.append(document_hash)
+        locations.append(location)
+    return (np.frombuffer(b"".join(digests), dtype=np.uint8).reshape(-1, 32),
+            np.array(locations, dtype=np.int64))
+
+def get_cache_files(model_dirpath: str, dimension: int | None) -> dict[int, CacheFile]:
+    "file id -> CacheFile of the model's cache files"
+    cache_files = {}
+    for filename in os.listdir(model_dirpath):
+        match = CACHE_FILENAME_RE.match(filename)
+        if match is None:
+            continue
+        path = os.path.join(model_dirpath, filename)
+        meta_path = os.path.splitext(path)[0] + ".json"
+        storage_dtype, file_dimension = "float32", dimension
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            storage_dtype, file_dimension = meta["storage_dtype"], meta["embedding_dimension"]
+        elif file_dimension is None:
+            raise ValueError(f'"{meta_path}" not found, pass the dimension with --dimension')
+        cache_files[int(match.group(1) or 0)] = CacheFile(path, file_dimension, LOCK_PATH, 0,
+                                                           storage_dtype)
+    return cache_files
+
+def get_runs(offsets: np.ndarray, vector_nbytes: int) -> list[tuple[int, int]]:
+    "sorted unique offsets -> (1st offset, number of vectors) of each run of adjacent vectors"
+    if not len(offsets):
+        return []
+    starts = np.flatnonzero(np.diff(offsets) != vector_nbytes) + 1
+    bounds = np.concatenate([[0], starts, [len(offsets)]])
+    return [(int(offsets[start]), int(end - start)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+# -----------------------------------------------------------------------------
+def copy_runs(cache_file: CacheFile, runs: list[tuple[int, int]], new_file: CacheFile) -> None:
+    """
+    appends the vectors of runs to new_file with sequential reads & writes of up to
+    COPY_CHUNK_NBYTES, converted if new_file has another storage dtype
+    """
+    convert = new_file.storage_dtype != cache_file.storage_dtype
+    chunk_cnt = max(COPY_CHUNK_NBYTES // cache_file.vector_nbytes, 1)
+    with open(cache_file.path, "rb") as src, open(new_file.path, "ab") as dst:
+        for offset, cnt in runs:
+            for start in range(0, cnt, chunk_cnt):
+                n = min(chunk_cnt, cnt - start)
+                data = os.pread(src.fileno(), n * cache_file.vector_nbytes,
+                                offset + start * cache_file.vector_nbytes)
+                if convert:
+                    vectors = np.frombuffer(data, dtype=cache_file.dtype)
+                    data = new_file.encode(cache_file.decode(vectors)).tobytes()
+                dst.write(data)
+        dst.flush()
+        os.fsync(dst.fileno())
+
+# -----------------------------------------------------------------------------
+def link_or_copy(src: str, dst: str) -> None:
+    "a hard link takes no space & no time, a copy if the filesystem can't"
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def carry_over(model_dirpath: str, building: str) -> list[str]:
+    "puts the model directory's entries which compaction doesn't rebuild in building, their names"
+    carried = []
+    for name in sorted(os.listdir(model_dirpath)):
+        if name.startswith(REBUILT_PREFIXES) or os.path.exists(os.path.join(building, name)):
+            continue
+        src = os.path.join(model_dirpath, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(building, name), copy_function=link_or_copy)
+        else:
+            link_or_copy(src, os.path.join(building, name))
+        carried.append(name)
+    return carried
+
+def finish_swap(model_dirpath: str) -> None:
+    """
+    completes (or discards) a compaction interrupted while building (.compacting) or swapping in
+    (.compacted) the new model directory
+    """
+    building, built, old = (f"{model_dirpath}.{suffix}"
+                            for suffix in ("compacting", "compacted", "old"))
+    if os.path.exists(building):
+        logging.warning(f'"{building}": discarding an incomplete compaction')
+        shutil.rmtree(building)
+    if os.path.exists(built):
+        if os.path.exists(model_dirpath) and not os.path.exists(old):
+            os.rename(model_dirpath, old)
+        os.rename(built, model_dirpath)
+    if os.path.exists(old) and os.path.exists(model_dirpath):
+        shutil.rmtree(old)
+
+def get_cache_nbytes(model_dirpath: str) -> int:
+    return sum(os.path.getsize(os.path.join(model_dirpath, filename))
+               for filename in os.listdir(model_dirpath) if CACHE_FILENAME_RE.match(filename))
+
+# -----------------------------------------------------------------------------
+def get_access_stats(model_dirpath: str, digests: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    "last access & number of accesses of each digest, 0 & 0 for those without stats"
+    return AccessStats(model_dirpath).lookup(digests)
+
+def evict(keep: np.ndarray, row_nbytes: np.ndarray, locations: np.ndarray,
+          last_access: np.ndarray, count: np.ndarray, policy: str = "lru",
+          max_vectors: int = 0, max_nbytes: int = 0, max_age_secs: int = 0) -> np.ndarray:
+    """
+    drops rows from keep (mask of the index rows) by age, then least recently (lru) or least
+    frequently (lfu) used 1st until at most max_vectors rows & max_nbytes bytes are left, 0: no
+    limit. Rows without stats (written before access was tracked) are never too old & are the
+    1st to go over a limit, oldest (lowest location) 1st
+    """
+    keep = keep.copy()
+    if max_age_secs > 0:
+        keep &= (last_access == 0) | (last_access >= time() - max_age_secs)
+    rows = np.flatnonzero(keep)
+    if policy == "lfu":
+        order = np.lexsort((locations[rows], last_access[rows], count[rows]))
+    else:
+        order = np.lexsort((locations[rows], last_access[rows]))
+    rows = rows[order]  # the next to evict 1st
+    cnt_evict = 0
+    if max_vectors > 0:
+        cnt_evict = max(cnt_evict, len(rows) - max_vectors)
+    if max_nbytes > 0:
+        # the most used rows which fit in max_nbytes stay
+        fits = np.cumsum(row_nbytes[rows][::-1]) <= max_nbytes
+        cnt_evict = max(cnt_evict, len(rows) - int(fits.sum()))
+    keep[rows[:cnt_evict]] = False
+    return keep
+
+def evict_files(index: IndexDatabase, cache: CacheShards, stats: AccessStats | None,
+                policy: str = "lru", max_vectors: int = 0, max_nbytes: int = 0
+) -> tuple[dict, list[tuple[bytes, int]]]:
+    """
+    run by the database commit process while serving: once the model's cache files hold more
+    than max_vectors vectors or max_nbytes bytes, retires its oldest sealed files (see
+    CacheShards.retire) until it fits. The rows of a retired file which evict keeps are copied
+    to its shard's active file 1st, the others are dropped from the index. The active files
+    aren't touched, the cache exceeds the caps by up to 1 file per shard. Returns a report &
+    the rows moved (digest, new location)
+    """
+    cache.active_ids = cache.get_newest_ids()   # the workers may have moved on
+    cache_files = {file_id: cache.get_file(file_id) for file_id in cache.get_file_ids()}
+    sizes = {file_id: os.path.getsize(cache_file.path)
+             for file_id, cache_file in cache_files.items()}
+    nbytes = sum(sizes.values())
+    cnt_vectors = sum(size // cache_files[file_id].vector_nbytes
+                      for file_id, size in sizes.items())
+    report = {"nbytes_before": nbytes, "nbytes_after": nbytes, "retired_files": 0,
+              "evicted_rows": 0, "moved_rows": 0}
+
+    def over_cap(nbytes: int, cnt_vectors: int) -> bool:
+        return ((max_nbytes > 0 and nbytes > max_nbytes)
+                or (max_vectors > 0 and cnt_vectors > max_vectors))
+
+    sealed = sorted(set(cache_files) - set(cache.active_ids))
+    if not over_cap(nbytes, cnt_vectors) or not len(sealed):
+        return report, []
+    digests, locations = read_rows(index)
+    file_ids, offsets = locations >> LOCATION_SHIFT, locations & OFFSET_MASK
+    keep = np.zeros(len(locations), dtype=bool)  # rows pointing to a vector in a cache file
+    row_nbytes = np.zeros(len(locations), dtype=np.int64)
+    for file_id, cache_file in cache_files.items():
+        rows = np.flatnonzero(file_ids == file_id)
+        keep[rows] = ((offsets[rows] % cache_file.vector_nbytes == 0)
+                      & (offsets[rows] + cache_file.vector_nbytes <= sizes[file_id]))
+        row_nbytes[rows] = cache_file.vector_nbytes
+    if stats is None:
+        last_access = count = np.zeros(len(locations), dtype=np.int64)
+    else:
+        last_access, count = stats.lookup(digests)
+    keep = evict(keep, row_nbytes, locations, last_access, count, policy, max_vectors,
+                 max_nbytes)
+
+    moved = []
+    for file_id in sealed:
+        if not over_cap(nbytes, cnt_vectors):
+            break
+        cache_file = cache_files[file_id]
+        rows = np.flatnonzero(file_ids == file_id)
+        kept_rows = rows[keep[rows]]
+        file_moved = []
+        chunk_cnt = max(COPY_CHUNK_NBYTES // cache_file.vector_nbytes, 1)
+        for start in range(0, len(kept_rows), chunk_cnt):
+            chunk = kept_rows[start:start + chunk_cnt]
+            chunk_locations = cache.append(file_id % cache.cnt_shards,
+                                           cache_file.read_many(offsets[chunk]))
+            if chunk_locations is None:  # the copies are left dangling, the file for next pass
+                logging.warning(f'"{cache_file.path}": timed-out copying its rows, not retired')
+                report["nbytes_after"] = get_cache_nbytes(cache.dirpath)
+                return report, moved
+            file_moved.extend(zip((digest.tobytes() for digest in digests[chunk]),
+                                  chunk_locations))
+        index.delete_rows([digest.tobytes() for digest in digests[rows]])
+        index.add_rows(file_moved)
+        index.flush()
+        evicted = rows[~keep[rows]]
+        if stats is not None:
+            stats.forget([digest.tobytes() for digest in digests[evicted]])
+        if not cache.retire(file_id):   # its rows are gone, retired next pass
+            logging.warning(f'"{cache_file.path}": timed-out acquiring its lock, not retired')
+        moved.extend(file_moved)
+        nbytes += int(row_nbytes[kept_rows].sum()) - sizes[file_id]
+        cnt_vectors += len(kept_rows) - sizes[file_id] // cache_file.vector_nbytes
+        report["retired_files"] += 1
+        report["evicted_rows"] += len(evicted)
+        report["moved_rows"] += len(file_moved)
+    report["nbytes_after"] = get_cache_nbytes(cache.dirpath)
+    return report, moved
+
+# -----------------------------------------------------------------------------
+def compact(model_dirpath: str, db_type: str, storage_dtype: str | None = None,
+            dimension: int | None = None, dry_run: bool = False, policy: str = "lru",
+            max_vectors: int = 0, max_nbytes: int = 0, max_age_secs: int = 0) -> dict:
+    """
+    returns a report: vectors & index rows kept, dropped & the cache's size before & after.
+    See evict for policy & the max_* limits
+    """
+    model_dirpath = os.path.normpath(model_dirpath)
+    if not dry_run:
+        finish_swap(model_dirpath)
+    digests, locations = read_index(db_type, model_dirpath)
+    cache_files = get_cache_files(model_dirpath, dimension)
+    report = {"rows": len(locations), "dangling_rows": 0, "evicted_rows": 0,
+              "vectors_before": 0, "vectors_after": 0,
+              "nbytes_before": get_cache_nbytes(model_dirpath), "nbytes_after": 0}
+    file_ids, offsets = locations >> LOCATION_SHIFT, locations & OFFSET_MASK
+    keep = np.zeros(len(locations), dtype=bool)  # rows pointing to a vector in a cache file
+    row_nbytes = np.zeros(len(locations), dtype=np.int64)    # of their vector once compacted
+    new_nbytes = {}     # file id -> bytes per vector of the compacted file
+    for file_id, cache_file in cache_files.items():
+        size = os.path.getsize(cache_file.path)
+        report["vectors_before"] += size // cache_file.vector_nbytes
+        rows = np.flatnonzero(file_ids == file_id)
+        keep[rows] = ((offsets[rows] % cache_file.vector_nbytes == 0)
+                      & (offsets[rows] + cache_file.vector_nbytes <= size))
+        new_nbytes[file_id] = CacheFile.get_dtype(storage_dtype or cache_file.storage_dtype,
+                                                  cache_file.embedding_dimension).itemsize
+        row_nbytes[rows] = new_nbytes[file_id]
+    report["dangling_rows"] = int((~keep).sum())
+    last_access, count = get_access_stats(model_dirpath, digests)
+    if max_vectors > 0 or max_nbytes > 0 or max_age_secs > 0:
+        evicted = keep & ~evict(keep, row_nbytes, locations, last_access, count, policy,
+                                max_vectors, max_nbytes, max_age_secs)
+        keep &= ~evicted
+        report["evicted_rows"] = int(evicted.sum())
+
+    new_locations = np.full(len(locations), -1, dtype=np.int64)
+    plans = {}  # file id -> runs of live vectors to copy
+    for file_id, cache_file in sorted(cache_files.items()):
+        rows = np.flatnonzero(keep & (file_ids == file_id))
+        # several rows can point to the same vector, they keep sharing it
+        live_offsets, ranks = np.unique(offsets[rows], return_inverse=True)
+        new_locations[rows] = CacheShards.pack_location(file_id, ranks * new_nbytes[file_id])
+        plans[file_id] = get_runs(live_offsets, cache_file.vector_nbytes)
+        report["vectors_after"] += len(live_offsets)
+        report["nbytes_after"] += len(live_offsets) * new_nbytes[file_id]
+    if dry_run:
+        return report
+
+    building = f"{model_dirpath}.compacting"
+    os.makedirs(building)
+    for file_id, runs in plans.items():
+        if not len(runs) and file_id != 0:   # embeddings.bin is kept, even if empty
+            continue
+        cache_file = cache_files[file_id]
+        path = os.path.join(building, CacheShards.get_filename(file_id))
+        with open(path, "wb"):
+            pass
+        new_file = CacheFile(path, cache_file.embedding_dimension, LOCK_PATH, 0,
+                             storage_dtype or cache_file.storage_dtype)
+        copy_runs(cache_file, runs, new_file)
+        logging.info(f'"{cache_file.path}": copied {sum(cnt for _, cnt in runs)} vectors in '
+                     f"{len(runs)} runs")
+
+    index = open_index(db_type, building, readonly=False)
+    kept_rows = np.flatnonzero(keep)
+    for start in range(0, len(kept_rows), INDEX_CHUNK):
+        rows = kept_rows[start:start + INDEX_CHUNK]
+        index.add_rows(list(zip((digest.tobytes() for digest in digests[rows]),
+                                new_locations[rows].tolist())))
+    index.flush()
+    del index
+    tracked_rows = kept_rows[last_access[kept_rows] > 0]   # the evicted rows' stats are dropped
+    if len(tracked_rows):
+        records = np.empty(len(tracked_rows), dtype=ACCESS_STATS_RECORD)
+        records["digest"] = digests[tracked_rows].reshape(-1).view("V32")
+        records["last_access"] = last_access[tracked_rows]
+        records["count"] = count[tracked_rows]
+        AccessStats.write(os.path.join(building, AccessStats.FILENAME), records)
+    # the stored documents are carried as is (evicted ones are unreachable), the search index
+    # isn't: the server rebuilds it on its next start with --search-index
+    if os.path.exists(os.path.join(model_dirpath, DocumentStore.DB_FILE)):
+        with closing(sqlite3.connect(os.path.join(model_dirpath, DocumentStore.DB_FILE))) as src, \
+             closing(sqlite3.connect(os.path.join(building, DocumentStore.DB_FILE))) as dst:
+            src.backup(dst)
+    carried = carry_over(model_dirpath, building)
+    if len(carried):
+        logging.info(f'"{model_dirpath}": carried over {carried}')
+
+    # the new directory is complete once it has its final name, finish_swap takes it from there
+    os.rename(building, f"{model_dirpath}.compacted")
+    finish_swap(model_dirpath)
+    report["nbytes_after"] = get_cache_nbytes(model_dirpath)
+    return report
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model_dirs",
+            nargs="+",
+            help="1 or more model data directories, e.g. 'data/sentence-transformers_...'")
+    parser.add_argument("--dimension",
+            help="optional: embedding dimension, only needed for cache files written before the"
+                 " storage dtype was recorded (no embeddings.json)",
+            type=int)
+    parser.add_argument("--max-age-days",
+            help="optional: evict documents not used for this many days (needs access stats)",
+            default=0, type=float)
+    parser.add_argument("--max-mb",
+            help="optional: per model, evict documents (see --policy) until the cache fits in"
+                 " this many MiB",
+            default=0, type=float)
+    parser.add_argument("--max-vectors",
+            help="optional: per model, evict documents (see --policy) until at most this many"
+                 " are left",
+            default=0, type=int)
+    parser.add_argument("-n", "--dry-run",
+            action="store_true",
+            help="optional: only report how much space compaction would reclaim")
+    parser.add_argument("-p", "--policy",
+            choices=EVICTION_POLICIES,
+            help="optional: evict the least recently (lru) or least frequently (lfu) used"
+                 " documents 1st, default: 'lru'",
+            default="lru")
+    parser.add_argument("-s", "--storage-dtype",
+            choices=STORAGE_DTYPES,
+            help="optional: convert the cache to this storage dtype, default: keep it")
+    parser.add_argument("-t", "--db-type",
+            choices=["duckdb", "hashtable", "leveldb", "sqlite"],
+            help="optional: database type of the indexes, default: 'sqlite'",
+            default="sqlite")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO, stream=stderr)
+
+    for model_dirpath in args.model_dirs:
+        if not os.path.isdir(model_dirpath):
+            logging.error(f'"{model_dirpath}" not found, skipping')
+            continue
+        report = compact(model_dirpath, args.db_type, args.storage_dtype, args.dimension,
+                         args.dry_run, args.policy, args.max_vectors, int(args.max_mb * 2**20),
+                         int(args.max_age_days * 86400))
+        reclaimed = report["nbytes_before"] - report["nbytes_after"]
+        logging.info(f'"{model_dirpath}": {report["vectors_after"]} of {report["vectors_before"]}'
+                     f' vectors live, {report["dangling_rows"]} of {report["rows"]} index rows'
+                     f' dangling, {report["evicted_rows"]} evicted, {report["nbytes_before"]} ->'
+                     f' {report["nbytes_after"]} bytes, '
+                     f"{'would reclaim' if args.dry_run else 'reclaimed'} {reclaimed} bytes")
@@ -4,84 +4,138 @@ import requests
 from argparse import Namespace
 from filelock import Timeout, FileLock
 from multiprocessing import Process
-from multiprocessing.managers import SharedMemoryManager
-from multiprocessing.shared_memory import ShareableList
-from os import getpid, path, remove
-from pickle import dumps
+from os import getpid, makedirs, path, remove
 from psutil import pid_exists
 from signal import signal, SIGINT, SIGTERM, SIG_IGN
 from sys import exit, stderr
 from tempfile import gettempdir
-from threading import Thread
-from time import sleep
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter, sleep
 
+import metrics
+
+from accessStats import AccessStats
+from cacheShards import CacheShards
+from compactCache import evict_files
 from embeddingService import ACQUIRE_LOCK_TIMEOUT, EmbeddingService
 from indexDatabase import IndexDatabase
+from indexDuckDB import IndexDuckDB
+from indexHashTable import IndexHashTable
 from indexSQLite import IndexSQLite
 from indexLevelDB import IndexLevelDB
+from recoverCache import trim_write_ahead
+from searchIndex import SearchIndex
+from shmRingBuffer import ShmChannel
+from tokenCache import TOKENS_DIRNAME, TOKENS_MODEL_ID
 
-DCP_BUSY_WAIT_SLEEP_SECS = 0.005 # arbitrary & tunable, less: more responsive, more: busier CPU
+FLUSH_LINGER_SECS = 0.02    # once idle, wait this long for more writes before committing
 WAIT_UVICORN_UP_TIMEOUT_SECS = 20   # time needed for workers to report their PIDs
-WAIT_SHMS_UP = 30   # also arbitrary, but less important, just don't set too low
+CLAIM_TTL_SECS = 10 # a worker's claim on a document expires if its write doesn't arrive by then
+CLAIMS_PURGE_CNT = 10000    # purge expired claims once there are this many
+ACCESS_STATS_SAVE_SECS = 60 # when idle, save the models' access stats (if any changed) this often
+SEARCH_INDEX_SECS = 2   # the rows written are filed in the models' search indexes this often
+STOP_THREADS_TIMEOUT = 5    # secs, @ clean-up for the db_threads to finish their last batch
+WAL_TRIM_SECS = 10  # the write-ahead logs of models written to are trimmed this often
+CACHE_LOCK_TIMEOUT = 1  # secs, for a cache file's lock (to trim its log, copy rows), else next pass
+EVICT_SECS = 60     # the caches of models written to are checked against their caps this often
 
 
-class SHMPayload:   # a ShareableList item
-    "[-------------------digest-------------|---offset---]"
-    DUMMY_DIGEST = EmbeddingService.get_hash("a")
-    DUMMY_OFFSET = hex(2**63 - 1)# 64-bit integer
-    DUMMY_PAYLOAD = DUMMY_DIGEST + DUMMY_OFFSET # "init" ShareableList item to max len it can store
+class ClaimTable:
+    """
+    documents being computed by some worker (cross-worker request coalescing): the 1st worker to
+    claim a digest computes it, others wait for it to appear in the index. A claim is released
+    when the index write of its digest arrives, when its worker releases it (it won't write it,
+    e.g. its encode failed) or after CLAIM_TTL_SECS (e.g. worker died)
+    """
+    def __init__(self):
+        self.claims = {}    # (model id, digest) -> (monotonic time claimed, worker pid)
+        self.lock = Lock()
 
-    def __init__(self, digest: str = None, offset: int = None, string: str = None):
-        self.digest = digest
-        self.offset = offset
-        self.string = string
-        self.me = self.__class__.__name__
-    def pack(self) -> str | None:
-        if self.digest is None or self.offset is None:
-            logging.error(f"{self.me}: cannot pack({self.digest},{self.offset})")
-            return None
-        self.string = self.digest + hex(self.offset) # this assumes digest will always be same len
-        return self.string
-    def unpack(self) -> tuple[str,int]:
-        error_msg = f"{self.me}: cannot unpack({self.string})"
-        if (self.string is None or
-                len(self.string) < len(self.DUMMY_DIGEST) + 3):    # "+3" because len("0x[0-9]")
-            logging.error(error_msg)
-            return None
-        hash_len = len(self.DUMMY_DIGEST)
-        try:
-            return (self.string[:hash_len], int(self.string[hash_len:], 16))
-        except ValueError as e:
-            logging.error(error_msg + ": " + str(e))
-            return None
+    def claim(self, digest: tuple[int, bytes], worker: int) -> bool:
+        now = monotonic()
+        with self.lock:
+            claimed_at, _ = self.claims.get(digest, (None, None))
+            if claimed_at is not None and now - claimed_at < CLAIM_TTL_SECS:
+                return False
+            if len(self.claims) >= CLAIMS_PURGE_CNT:
+                self.claims = {d: c for d, c in self.claims.items()
+                               if now - c[0] < CLAIM_TTL_SECS}
+            self.claims[digest] = (now, worker)
+            return True
+
+    def release(self, digests: list[tuple[int, bytes]], worker: int | None = None) -> None:
+        "worker: only its own claims, else any (the digests were written)"
+        with self.lock:
+            for digest in digests:
+                _, claimed_by = self.claims.get(digest, (None, None))
+                if worker is None or claimed_by == worker:
+                    self.claims.pop(digest, None)
 
 
 class DatabaseCommitProcess(Process):
-    SUPPORTED_DB_TYPES = ["leveldb", "sqlite"]
+    SUPPORTED_DB_TYPES = ["duckdb", "hashtable", "leveldb", "sqlite"]
+    DCP_READ_DB_TYPES = ["duckdb", "leveldb"]   # workers can't open these, their reads go via DCP
     SHM_NAME_PREFIX = "DatabaseCommitProcessSHM"
-    WORKER_SHM_SIZE = 15 # length of ShareableList per worker (named: SHM_NAME_PREFIX + pid)
+    WORKER_RING_CAPACITY = 4096 # records per ring per worker (named: SHM_NAME_PREFIX + pid)
     WORKER_PIDS_FILE = path.join(gettempdir(), "DatabaseCommitProcess_pids")
     WORKER_PIDS_LOCK = WORKER_PIDS_FILE + ".lock"
-    SENTINEL_OFFSET = int(SHMPayload.DUMMY_OFFSET, 16)
-    SENTINEL_DIGEST = len(SHMPayload.DUMMY_DIGEST) * "\x15"
-    elapsed = 0
+    # kinds of records (msgs) sent by workers, replies are sent with the same kind & seq number
+    MSG_WRITE = 0   # add (digest, offset) to the index, no reply
+    MSG_READ = 1    # reply offset: the digest's offset or NOT_FOUND_OFFSET
+    MSG_CLAIM = 2   # reply offset: CLAIM_GRANTED or CLAIM_DENIED
+    MSG_TOUCH = 3   # count an access of the digest in the model's access stats, no reply
+    MSG_RELEASE = 4 # the worker won't write the digest it claimed, no reply
+    NOT_FOUND_OFFSET = -1
+    CLAIM_GRANTED = 1
+    CLAIM_DENIED = 0
 
     def __init__(self, args: Namespace):
         super().__init__()
         self.me = self.__class__.__name__
         self.cnt_workers = args.workers
-        self.shm_lists = {}
-        self.shm_mgr = SharedMemoryManager()
-        self.shm_mgr.start()
-        model_dirpath = EmbeddingService.get_model_dirpath(args.data_dir, args.model)
+        self.channels = {}  # keyed on worker pid
+        self.threads = []   # db_threads, 1 per worker
+        self.stopping = Event() # set @ clean-up, the db_threads exit b4 their channels are closed
         self.db_type = args.db_type
         if self.db_type not in self.SUPPORTED_DB_TYPES:
             logging.error(f'cannot use "{self.db_type}", for now only support: {self.SUPPORTED_DB_TYPES}')
             raise ValueError
-        if self.db_type == "sqlite":
-            self.database_rw = IndexSQLite(model_dirpath, readonly = False)
-        elif self.db_type == "leveldb":
-            self.database_rw = IndexLevelDB(model_dirpath)
+        # msgs carry the model id: the model's position in models.txt, as in the workers
+        models_cfg = EmbeddingService.get_models_cfg(args.data_dir)
+        self.models_cfg = list(models_cfg.values())
+        self.model_names = list(models_cfg)     # label the metrics
+        self.indexes = {}   # model id -> read-write index, opened on its 1st msg
+        self.indexes_lock = Lock()
+        # model id -> access stats for eviction, only kept with --track-access
+        self.track_access = getattr(args, "track_access", False)
+        self.access_stats = {}
+        self.access_stats_saved = monotonic()
+        # model id -> (search index, cache to read its vectors), only kept with --search-index
+        self.search_index = getattr(args, "search_index", False)
+        self.search_indexes = {}
+        self.search_rows = {}   # model id -> rows written since search_indexer's last pass
+        self.search_rows_lock = Lock()
+        # with --write-ahead, logs are trimmed as rows are committed, with --max-cache-mb or
+        # --max-cache-vectors, the oldest cache files are retired once a model's cache is too big
+        self.write_ahead = getattr(args, "write_ahead", False)
+        self.max_cache_nbytes = int(getattr(args, "max_cache_mb", 0) * 2**20)
+        self.max_cache_vectors = getattr(args, "max_cache_vectors", 0)
+        self.eviction_policy = getattr(args, "eviction_policy", "lru")
+        self.evict = self.max_cache_nbytes > 0 or self.max_cache_vectors > 0
+        self.cnt_shards = getattr(args, "cache_shards", 1)
+        self.max_shard_nbytes = int(getattr(args, "max_shard_mb", 0) * 2**20)
+        self.caches = {}    # model id -> cache files, as the workers' (shards, locks)
+        # model ids written to since wal_trimmer's & cache_evictor's last pass
+        self.wal_models = set()
+        self.evict_models = set()
+        self.written_models_lock = Lock()
+        # workers open their read-only indexes on start-up, they must exist by then
+        if self.db_type not in self.DCP_READ_DB_TYPES:
+            for cfg in self.models_cfg:
+                if cfg["autoload"]:
+                    EmbeddingService.setup_model_dir(cfg)
+                    self._open_index(cfg["data_dirpath"])   # & closes it
+                    self._open_index(self.get_data_dirpath(cfg["model_id"] | TOKENS_MODEL_ID))
 
     # --------------------------------------------------------------------------
     @staticmethod
@@ -89,6 +143,141 @@ class DatabaseCommitProcess(Process):
         return DatabaseCommitProcess.SHM_NAME_PREFIX + str(pid) # TODO: is this unique enough?
 
     # --------------------------------------------------------------------------
+    def get_data_dirpath(self, model_id: int) -> str | None:
+        "the model's directory, or its tokens cache's (TOKENS_MODEL_ID), None for an unknown id"
+        cfg_id = model_id & ~TOKENS_MODEL_ID
+        if cfg_id >= len(self.models_cfg):
+            return None
+        dirpath = self.models_cfg[cfg_id]["data_dirpath"]
+        if model_id & TOKENS_MODEL_ID:
+            dirpath = path.join(dirpath, TOKENS_DIRNAME)
+            makedirs(dirpath, exist_ok=True)
+        return dirpath
+
+    def _open_index(self, model_dirpath: str) -> IndexDatabase:
+        if self.db_type == "sqlite":
+            return IndexSQLite(model_dirpath, readonly = False)
+        if self.db_type == "leveldb":
+            return IndexLevelDB(model_dirpath)
+        if self.db_type == "duckdb":
+            return IndexDuckDB(model_dirpath)
+        return IndexHashTable(model_dirpath, readonly = False)
+
+    def get_model_name(self, model_id: int) -> str:
+        "for the metrics: the model's name (+ /tokens for its tokens index), its id if unknown"
+        cfg_id = model_id & ~TOKENS_MODEL_ID
+        if cfg_id >= len(self.model_names):
+            return str(model_id)
+        return self.model_names[cfg_id] + ("/tokens" if model_id & TOKENS_MODEL_ID else "")
+
+    def get_index(self, model_id: int) -> IndexDatabase | None:
+        "the model's read-write index (shared by all db_threads), None for an unknown model id"
+        with self.indexes_lock:
+            index = self.indexes.get(model_id)
+            if index is None:
+                if (model_id & ~TOKENS_MODEL_ID) >= len(self.models_cfg):
+                    logging.error(f"{self.me}: unknown model id {model_id}")
+                    return None
+                EmbeddingService.setup_model_dir(self.models_cfg[model_id & ~TOKENS_MODEL_ID])
+                dirpath = self.get_data_dirpath(model_id)
+                index = self.indexes[model_id] = self._open_index(dirpath)
+                logging.info(f'{self.me}: opened index in "{dirpath}"')
+            return index
+
+    def get_access_stats(self, model_id: int) -> AccessStats | None:
+        "None unless access is tracked or for an unknown model id"
+        if not self.track_access or model_id >= len(self.models_cfg):
+            return None
+        with self.indexes_lock:
+            stats = self.access_stats.get(model_id)
+            if stats is None:
+                stats = self.access_stats[model_id] = AccessStats(
+                        self.models_cfg[model_id]["data_dirpath"])
+            return stats
+
+    def save_access_stats(self, force: bool = False) -> None:
+        "saves the models' access stats every ACCESS_STATS_SAVE_SECS (or now if force)"
+        with self.indexes_lock:
+            if not force and monotonic() - self.access_stats_saved < ACCESS_STATS_SAVE_SECS:
+                return
+            self.access_stats_saved = monotonic()
+            access_stats = list(self.access_stats.values())
+        for stats in access_stats:
+            stats.save()
+
+    def get_search_index(self, model_id: int
+    ) -> tuple[SearchIndex | None, CacheShards | None, bool]:
+        """
+        opens the model's search index on its 1st call, builds it from the whole index if it has
+        none yet (e.g. not prepared @ start-up). The bool: it was just built
+        """
+        with self.indexes_lock:
+            search_index, cache = self.search_indexes.get(model_id, (None, None))
+        if search_index is not None or model_id >= len(self.models_cfg):
+            return search_index, cache, False
+        cfg = self.models_cfg[model_id]
+        lock_filepath = path.join(EmbeddingService.get_lock_dirpath(), f"search{model_id}.lock")
+        cache = CacheShards(cfg["data_dirpath"], cfg["embedding_dimension"], lock_filepath,
+                            ACQUIRE_LOCK_TIMEOUT, cfg["storage_dtype"])
+        search_index = SearchIndex(cfg["data_dirpath"], readonly=False)
+        built = search_index.centroids is None
+        if built:
+            search_index = SearchIndex.build(cfg["data_dirpath"],
+                                             self.get_index(model_id).iter_rows(), cache)
+        with self.indexes_lock:
+            self.search_indexes[model_id] = (search_index, cache)
+        return search_index, cache, built
+
+    def add_search_rows(self, model_id: int, rows: list[tuple[bytes, int]]) -> None:
+        "queues rows written to the index for search_indexer"
+        with self.search_rows_lock:
+            self.search_rows.setdefault(model_id, []).extend(rows)
+
+    def add_written_model(self, model_id: int) -> None:
+        "the model's index has new rows, for wal_trimmer & cache_evictor (not token caches)"
+        if model_id & TOKENS_MODEL_ID:
+            return
+        with self.written_models_lock:
+            if self.write_ahead:
+                self.wal_models.add(model_id)
+            if self.evict:
+                self.evict_models.add(model_id)
+
+    def get_cache(self, model_id: int) -> CacheShards:
+        """
+        the model's cache files, with the workers' locks (a log is emptied, rows are copied to
+        an active file while holding them) & shards
+        """
+        with self.indexes_lock:
+            cache = self.caches.get(model_id)
+            if cache is None:
+                cfg = self.models_cfg[model_id]
+                cache = self.caches[model_id] = CacheShards(
+                        cfg["data_dirpath"], cfg["embedding_dimension"],
+                        EmbeddingService.get_lock_filepath(self.model_names[model_id]),
+                        CACHE_LOCK_TIMEOUT, cfg["storage_dtype"], self.cnt_shards,
+                        self.max_shard_nbytes)
+            return cache
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def register_worker(pid: int) -> bool:
+        """
+        run by each worker b4 its 1st Model: once all are registered, the DCP creates their rings.
+        False if WORKER_PIDS_LOCK timed-out
+        """
+        lawk = FileLock(DatabaseCommitProcess.WORKER_PIDS_LOCK, timeout = ACQUIRE_LOCK_TIMEOUT)
+        try:
+            lawk.acquire()
+        except Timeout:
+            logging.error(f"worker {pid}: acquire WORKER_PIDS_LOCK timed-out after "
+                    f"{ACQUIRE_LOCK_TIMEOUT}s")
+            return False
+        with open(DatabaseCommitProcess.WORKER_PIDS_FILE, "a") as wfp:
+            print(pid, file=wfp)
+        lawk.release()
+        return True
+
     def _get_worker_pids(self) -> list[int]:
         with open(self.WORKER_PIDS_FILE, "w"):
             pass
@@ -118,91 +307,239 @@ class DatabaseCommitProcess(Process):
     # --------------------------------------------------------------------------
     def run(self):
         logging.info(f"starting database commit process {getpid()}")
-        temp_shms = {}
         for pid in self._get_worker_pids():
-            self.shm_lists[pid] = self.shm_mgr.ShareableList(
-                    [SHMPayload.DUMMY_PAYLOAD] * self.WORKER_SHM_SIZE)
-            temp_shms[pid] = ShareableList(
-                    [dumps(self.shm_lists[pid])], name=self.get_shm_name(pid))
-
-        logging.info(f"{self.me}: waiting for workers to rcv shm location "
-                f"(timeout={WAIT_SHMS_UP}s)")
-        sleep_interval = 0.01
-        elapsed = 0
-        while elapsed < WAIT_SHMS_UP:
-            for p in list(temp_shms.keys()):
-                if not len(self.shm_lists[p][0]):
-                    temp_shms[p].shm.close()
-                    temp_shms[p].shm.unlink()
-                    del temp_shms[p]
-            if len(temp_shms) == 0:
-                break
-            elapsed += sleep_interval
-            sleep(sleep_interval)
-        if len(temp_shms):
-            for p in list(temp_shms.keys()):
-                temp_shms[p].shm.close()
-                temp_shms[p].shm.unlink()
-            logging.error(f"{self.me}: timed-out wait_shms_up after {WAIT_SHMS_UP}s, au revoir...")
-            self.clean_up()
-            raise TimeoutError
+            self.channels[pid] = ShmChannel(
+                    self.get_shm_name(pid), self.WORKER_RING_CAPACITY, create=True)
 
-        threads = []
-        for pid, shm in self.shm_lists.items():
-            if self.db_type == "leveldb":
-                db_obj = IndexLevelDB(connection=self.database_rw.connection)
-            else:
-                db_obj = self.database_rw
-            t = Thread(target=db_thread, args=[pid, shm, db_obj])
+        # SystemExit in the main thread, like Ctrl-C: cleans-up in finally
+        signal(SIGTERM, lambda signum, frame: exit(0))
+        claims = ClaimTable()   # shared by all workers' threads
+        for pid, channel in self.channels.items():
+            # daemon: a thread stuck on a dead worker's full replies ring doesn't hold the exit
+            t = Thread(target=db_thread, args=[pid, channel, self, claims], daemon=True)
             t.start()
-            threads.append(t)
+            self.threads.append(t)
+        if self.search_index:
+            Thread(target=search_indexer, args=[self], daemon=True).start()
+        if self.write_ahead:
+            Thread(target=wal_trimmer, args=[self], daemon=True).start()
+        if self.evict:
+            Thread(target=cache_evictor, args=[self], daemon=True).start()
 
         try:
-            for t in threads:
+            for t in self.threads:
                 t.join()
+        except KeyboardInterrupt:   # Ctrl-C, or stopped by benchmark.py --library
+            pass
         finally:
             self.clean_up()
 
     # --------------------------------------------------------------------------
     def clean_up(self):
-        if len(self.shm_lists) == 0:    # nothing todo
+        if len(self.channels) == 0:    # nothing todo
             return
         # avoid exiting until resources cleaned-up
         signal(SIGINT, SIG_IGN)
         signal(SIGTERM, SIG_IGN)
 
-        for shm in self.shm_lists.values():
-            shm.shm.close()
-        # manager will handle cleaning-up shmem
-        self.shm_mgr.shutdown()
+        self.stopping.set()
+        for channel in self.channels.values():
+            channel.request_bell.ring()     # wakes-up its db_thread
+        deadline = monotonic() + STOP_THREADS_TIMEOUT
+        for t in self.threads:
+            t.join(max(0, deadline - monotonic()))
+            if t.is_alive():
+                logging.warning(f"{self.me}: a db_thread didn't stop after "
+                                f"{STOP_THREADS_TIMEOUT}s, closing its channel anyway")
+        self.threads = []
+        for channel in self.channels.values():
+            channel.close()     # unlinks the shared memory & FIFOs
+        self.channels = {}
+        self.save_access_stats(force=True)
 
 # --------------------------------------------------------------------------
-def db_thread(pid: int, shm: ShareableList, db_obj: IndexDatabase) -> None:
-    # main loop: wait.. rcv.. process..
-    while True:
-        msg_ind = None
-        for i in range(DatabaseCommitProcess.WORKER_SHM_SIZE):
-            if len(shm[i]):
-                msg_ind = i
-                break
-        if msg_ind is None:
-            sleep(DCP_BUSY_WAIT_SLEEP_SECS)
-            continue
-
-        digest, offset = SHMPayload(string = shm[msg_ind]).unpack()
-        # if shm msg is type "read"
-        if isinstance(db_obj, IndexLevelDB) and offset == DatabaseCommitProcess.SENTINEL_OFFSET:
-            val = db_obj.read_offset(digest)
-            if val is None:
-                reply = SHMPayload(
-                        DatabaseCommitProcess.SENTINEL_DIGEST,
-                        DatabaseCommitProcess.SENTINEL_OFFSET).pack()
+def db_thread(pid: int, channel: ShmChannel, dcp: DatabaseCommitProcess, claims: ClaimTable
+) -> None:
+    # main loop: wait (blocked until the worker rings).. rcv.. process..
+    db_objs = {}    # model id -> this thread's index object
+    pending_flush = set()   # model ids of indexes which may hold back rows
+
+    def get_db_obj(model_id: int) -> IndexDatabase | None:
+        db_obj = db_objs.get(model_id)
+        if db_obj is None:
+            db_obj = dcp.get_index(model_id)
+            if dcp.db_type == "leveldb" and db_obj is not None:
+                db_obj = IndexLevelDB(connection=db_obj.connection)     # 1 per thread
+            db_objs[model_id] = db_obj
+        return db_obj
+
+    def read_offset(model_id: int, digest: bytes) -> int | None:
+        "None also on errors: answered as a miss, the worker computes it"
+        db_obj = get_db_obj(model_id)
+        try:
+            return None if db_obj is None else db_obj.read_offset(digest)
+        except Exception as e:
+            logging.error(f"db_thread {pid}: read from model id {model_id} failed: {e!r}")
+            return None
+
+    def read_offsets(model_id: int, digests: list[bytes]) -> dict[bytes, int]:
+        "read_offset for several digests in 1 pass, errors answer them all as misses"
+        db_obj = get_db_obj(model_id)
+        try:
+            return {} if db_obj is None else db_obj.read_offsets(digests)
+        except Exception as e:
+            logging.error(f"db_thread {pid}: read of {len(digests)} digests from model id "
+                          f"{model_id} failed: {e!r}")
+            return {}
+
+    def handle_records(records: list[tuple]) -> None:
+        metrics.set_ring_occupancy(pid, len(records))
+        if not len(records):
+            if not len(pending_flush):
+                if not channel.request_bell.wait(ACCESS_STATS_SAVE_SECS if dcp.track_access
+                                                 else None):
+                    dcp.save_access_stats()
+            elif not channel.request_bell.wait(FLUSH_LINGER_SECS):
+                # idle: commit what's held back so readers & waiters see it
+                for model_id in pending_flush:
+                    db_objs[model_id].flush()
+                pending_flush.clear()
+                dcp.save_access_stats()
+            return
+
+        rows = {}   # model id -> rows, all writes popped in this pass are inserted as 1 batch
+        touched = {}    # model id -> digests written or hit, for the access stats
+        reads = {}  # model id -> (digest, seq) of its MSG_READs, answered with 1 look-up each
+        replies = []
+        for digest, offset, seq, kind, model_id in records:
+            if kind == dcp.MSG_WRITE:
+                rows.setdefault(model_id, []).append((digest, offset))
+                touched.setdefault(model_id, []).append(digest)
+            elif kind == dcp.MSG_TOUCH:
+                touched.setdefault(model_id, []).append(digest)
+            elif kind == dcp.MSG_READ:
+                reads.setdefault(model_id, []).append((digest, seq))
+            elif kind == dcp.MSG_CLAIM:
+                # a written claim is released b4 its commit: while the workers can't read it yet
+                # (this index sees it) claims are denied, so that waiters wait instead of
+                # computing it again
+                granted = (read_offset(model_id, digest) is None
+                           and claims.claim((model_id, digest), pid))
+                replies.append((digest, dcp.CLAIM_GRANTED if granted else dcp.CLAIM_DENIED,
+                                seq, kind, model_id))
+            elif kind == dcp.MSG_RELEASE:   # in order: a later claim of the digest is granted
+                claims.release([(model_id, digest)], pid)
             else:
-                reply = SHMPayload(DatabaseCommitProcess.SENTINEL_DIGEST, val).pack()
-        else:
-            val = db_obj.add_row(digest, offset)
-            reply = ""
-        #print(f"========= add_row returned {val}:\n\t{msg}", file=stderr)
+                logging.error(f"db_thread {pid}: unknown msg kind {kind}, dropping it")
+        for model_id, model_reads in reads.items():
+            offsets = read_offsets(model_id, [digest for digest, _ in model_reads])
+            replies.extend((digest, offsets.get(digest, dcp.NOT_FOUND_OFFSET), seq, dcp.MSG_READ,
+                            model_id) for digest, seq in model_reads)
+        for model_id, model_rows in rows.items():
+            db_obj = get_db_obj(model_id)
+            if db_obj is None:
+                logging.error(f"db_thread {pid}: dropping {len(model_rows)} rows of unknown "
+                              f"model id {model_id}")
+                metrics.count_dropped_writes(str(model_id), "unknown_model", len(model_rows))
+                continue
+            started = perf_counter()
+            try:
+                db_obj.add_rows(model_rows)
+            except Exception as e:  # the other models' rows & the replies still go through
+                logging.error(f"db_thread {pid}: dropping {len(model_rows)} rows of model id "
+                              f"{model_id}, insert failed: {e!r}")
+                metrics.count_dropped_writes(dcp.get_model_name(model_id), "index_error",
+                                             len(model_rows))
+                # waiters on these claims compute the documents rather than wait for the TTL
+                claims.release([(model_id, digest) for digest, _ in model_rows])
+                continue
+            metrics.observe_stage(dcp.get_model_name(model_id), "commit", started)
+            metrics.observe_batch(dcp.get_model_name(model_id), "index", len(model_rows))
+            claims.release([(model_id, digest) for digest, _ in model_rows])
+            pending_flush.add(model_id)
+            dcp.add_written_model(model_id)
+            if dcp.search_index and not model_id & TOKENS_MODEL_ID:
+                dcp.add_search_rows(model_id, model_rows)
+        for model_id, digests in touched.items():
+            stats = dcp.get_access_stats(model_id)
+            if stats is not None:
+                stats.touch(digests)
+        if len(replies):
+            channel.send_replies(replies)
 
-        shm[msg_ind] = reply
+    while not dcp.stopping.is_set():
+        try:
+            handle_records(channel.pop_requests())
+        except Exception as e:  # the worker's writes & requests hang if this thread dies
+            logging.error(f"db_thread {pid}: failed to handle a batch of msgs: {e!r}")
+    for model_id in pending_flush:  # commit what's held back
+        try:
+            db_objs[model_id].flush()
+        except Exception as e:
+            logging.error(f"db_thread {pid}: flush of model id {model_id} failed: {e!r}")
 
+# --------------------------------------------------------------------------
+def search_indexer(dcp: DatabaseCommitProcess) -> None:
+    "files the rows written since its last pass in the models' search indexes"
+    while True:
+        sleep(SEARCH_INDEX_SECS)
+        with dcp.search_rows_lock:
+            search_rows, dcp.search_rows = dcp.search_rows, {}
+        for model_id, rows in search_rows.items():
+            try:
+                # a search index built from the whole index has these rows already
+                search_index, cache, built = dcp.get_search_index(model_id)
+                if search_index is not None and not built:
+                    search_index.add(rows, cache)
+            except Exception as e:  # rebuilt @ the next start-up, keep filing the other models
+                logging.error(f"search_indexer: failed to file {len(rows)} rows of model id "
+                              f"{model_id}: {str(e)}")
+
+# --------------------------------------------------------------------------
+def wal_trimmer(dcp: DatabaseCommitProcess) -> None:
+    """
+    trims the write-ahead logs of the models written to since its last pass, so that they only
+    hold the records of rows not committed yet (see recoverCache.trim_write_ahead)
+    """
+    while True:
+        sleep(WAL_TRIM_SECS)
+        with dcp.written_models_lock:
+            model_ids, dcp.wal_models = dcp.wal_models, set()
+        for model_id in model_ids:
+            try:
+                index = dcp.get_index(model_id)
+                cache = dcp.get_cache(model_id)
+                for file_id in cache.get_file_ids():
+                    cache_file = cache.get_file(file_id)
+                    if cache_file is not None:  # else retired by cache_evictor meanwhile
+                        trim_write_ahead(index, cache_file, CACHE_LOCK_TIMEOUT)
+            except Exception as e:  # the logs are only longer, start-up recovery still works
+                logging.error(f"wal_trimmer: failed to trim the logs of model id {model_id}: "
+                              f"{e!r}")
+
+# --------------------------------------------------------------------------
+def cache_evictor(dcp: DatabaseCommitProcess) -> None:
+    """
+    keeps the caches of the models written to since its last pass under --max-cache-mb &
+    --max-cache-vectors: retires their oldest cache files, moving the rows the eviction policy
+    keeps (see compactCache.evict_files)
+    """
+    while True:
+        sleep(EVICT_SECS)
+        with dcp.written_models_lock:
+            model_ids, dcp.evict_models = dcp.evict_models, set()
+        for model_id in model_ids:
+            try:
+                report, moved = evict_files(dcp.get_index(model_id), dcp.get_cache(model_id),
+                                            dcp.get_access_stats(model_id), dcp.eviction_policy,
+                                            dcp.max_cache_vectors, dcp.max_cache_nbytes)
+                if dcp.search_index and len(moved):    # filed again @ their new locations
+                    dcp.add_search_rows(model_id, moved)
+            except Exception as e:  # the cache only grows until the next pass
+                logging.error(f"cache_evictor: failed to evict from model id {model_id}: {e!r}")
+                continue
+            if report["retired_files"]:
+                logging.info(f"cache_evictor: model id {model_id}: retired "
+                             f'{report["retired_files"]} cache files, evicted '
+                             f'{report["evicted_rows"]} & moved {report["moved_rows"]} rows, '
+                             f'{report["nbytes_before"]} -> {report["nbytes_after"]} bytes')
@@ -0,0 +1,59 @@
+"""
+opt-in (--store-documents) storage of the documents' text, keyed on digest, so that search results
+(see searchIndex.py) can return the documents they found, not only their digests. 1 SQLite
+database per model (documents.db) which every worker writes to directly: documents are stored in
+the background after the response was sent & SQLite serializes the writers
+"""
+import logging
+import sqlite3
+
+from os import path
+from threading import local
+
+READ_MANY_CHUNK = 500   # max host params per "IN" query (older sqlite limit is 999)
+BUSY_TIMEOUT = 30   # secs a writer waits for another worker's transaction
+
+
+class DocumentStore:
+    DB_FILE = "documents.db"
+    TABLE = "Documents"
+
+    def __init__(self, dirpath: str):
+        self.db_filepath = path.join(dirpath, self.DB_FILE)
+        self.thread_local = local()     # 1 connection per thread (requests & background tasks)
+        connection = self._get_connection()
+        connection.execute("PRAGMA journal_mode=WAL")   # readers don't wait for writers
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {self.TABLE} "
+                           "(documentHash BLOB PRIMARY KEY, document TEXT) WITHOUT ROWID")
+        connection.commit()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self.thread_local, "connection", None)
+        if connection is None:
+            connection = self.thread_local.connection = sqlite3.connect(
+                    self.db_filepath, timeout=BUSY_TIMEOUT)
+        return connection
+
+    # -------------------------------------------------------------------------
+    def put_many(self, document_hashes: list[bytes], documents: list[str]) -> None:
+        connection = self._get_connection()
+        try:
+            connection.executemany(f"INSERT OR IGNORE INTO {self.TABLE} (documentHash, document) "
+                                   "VALUES (?, ?)", zip(document_hashes, documents))
+            connection.commit()
+        except sqlite3.OperationalError as e:
+            logging.error(f'failed to store {len(documents)} documents in "{self.db_filepath}": '
+                          f'"{str(e)}"')
+            connection.rollback()
+
+    def get_many(self, document_hashes: list[bytes]) -> dict[bytes, str]:
+        "document hash -> document, only for hashes which were found"
+        connection = self._get_connection()
+        unique_hashes = list(dict.fromkeys(document_hashes))
+        documents = {}
+        for i in range(0, len(unique_hashes), READ_MANY_CHUNK):
+            chunk = unique_hashes[i:i + READ_MANY_CHUNK]
+            documents.update(connection.execute(
+                    f"SELECT documentHash, document FROM {self.TABLE} WHERE documentHash IN "
+                    f'({",".join("?" * len(chunk))})', chunk).fetchall())
+        return documents
@@ -6,27 +6,59 @@ import argparse
 import logging
 import numpy as np
 import os
-from struct import pack, unpack
 
-from filelock import Timeout, FileLock
+from collections import deque
+from concurrent.futures import Future
 from hashlib import sha256
 from tempfile import gettempdir
+from threading import Lock
+from time import monotonic, perf_counter, sleep
 
+import metrics
+
+from cacheShards import CacheShards
+from documentStore import DocumentStore
 from model import Model
+from requestCoalescer import RECLAIM, RequestCoalescer
+from searchIndex import SearchIndex
+from tokenCache import TOKENS_DIRNAME, TOKENS_MODEL_ID, TokenCache, split_tokens
 
 _SCRIPT_NAME_ = os.path.basename(__file__)
 ACQUIRE_LOCK_TIMEOUT = 59  # secs
+DEFAULT_HOT_CACHE_MB = 64   # per model, see HotVectorCache
+CLAIM_WAIT_TIMEOUT = 10     # secs, for another worker to cache a document it claimed
+CLAIM_POLL_INTERVAL = 0.005 # 1st wait between index look-ups, doubles up to the max below
+CLAIM_POLL_MAX_INTERVAL = 0.1
 MODELS_CFG_FILENAME = "models.txt"
 EMBEDDINGS_FILENAME = "embeddings.bin"
 
 
 class EmbeddingService:
     def __init__(self, args: argparse.Namespace):
-        # models & locks are keyed on full model name
+        # models, cache files (CacheShards), write queues & locks are keyed on full model name
         self.models = dict()
-        self.locks = dict()
+        self.cache_files = dict()
+        self.write_queues = dict()
+        self.write_locks = dict()
         self.datadir = args.data_dir
         self.db_type = args.db_type
+        self.hot_cache_bytes = int(getattr(args, "hot_cache_mb", DEFAULT_HOT_CACHE_MB) * 2**20)
+        self.coalesce_across_workers = getattr(args, "coalesce_across_workers", False)
+        self.cache_shards = getattr(args, "cache_shards", 1)
+        self.max_shard_bytes = int(getattr(args, "max_shard_mb", 0) * 2**20)
+        self.track_access = getattr(args, "track_access", False)
+        self.write_ahead = getattr(args, "write_ahead", False)
+        self.store_documents = getattr(args, "store_documents", False)
+        # --stub-model: fake embeddings, see Model.compute_embeddings_batch
+        self.stub_model = getattr(args, "stub_model", False)
+        self.stub_encode_ms = getattr(args, "stub_encode_ms", 0)
+        self.document_stores = dict()   # with --store-documents
+        self.search_indexes = dict()    # opened on a model's 1st search
+        # emb_type=word: per model, the token cache & a Model of its own (no transformer) for
+        # the tokens index
+        self.token_caches = dict()
+        self.token_models = dict()
+        self.coalescer = RequestCoalescer()     # keyed on (model name, document hash)
         self.models_cfg = None
         self.load_models()
 
@@ -34,6 +66,15 @@ class EmbeddingService:
     def get_lock_dirpath() -> str:
         return os.path.join(gettempdir(), _SCRIPT_NAME_)
 
+    @staticmethod
+    def setup_lock_dir() -> None:
+        lock_dir = EmbeddingService.get_lock_dirpath()
+        if not os.path.exists(lock_dir):
+            try:
+                os.mkdir(lock_dir)
+            except FileExistsError:
+                pass    # lost the race to another worker?
+
     @staticmethod
     def get_model_dirpath(data_dirpath: str, model_name: str) -> str:
         return os.path.join(data_dirpath, EmbeddingService.normalize_model_dirname(model_name))
@@ -43,7 +84,8 @@ class EmbeddingService:
         "replaces filesystem path sep with underscore in-case model 'name' has a path of its own"
         return model_name.replace(os.path.sep, "_")
 
-    def get_lock_filepath(self, model_name: str) -> str:
+    @staticmethod
+    def get_lock_filepath(model_name: str) -> str:
         lock_name = EmbeddingService.normalize_model_dirname(model_name)
         return os.path.join(EmbeddingService.get_lock_dirpath(), f"{lock_name}.lock")
 
@@ -57,6 +99,11 @@ class EmbeddingService:
         # print(document)
         return sha256(bytes(document, encoding="utf-8")).hexdigest()
 
+    @staticmethod
+    def get_digest(document: str) -> bytes:
+        "raw 32 byte get_hash, the key of the document's embeddings in indexes & caches"
+        return sha256(bytes(document, encoding="utf-8")).digest()
+
     # -------------------------------------------------------------------------
     @staticmethod
     def get_models_cfg(data_dirpath: str) -> dict:
@@ -75,6 +122,10 @@ class EmbeddingService:
                 models_cfg[name] = {
                         "embedding_dimension": embedding_dimension, "data_dirpath": model_data_dir,
                         "autoload": parts[2] != "0",
+                        # optional 4th column: how the cache file stores vectors
+                        "storage_dtype": parts[3] if len(parts) > 3 else "float32",
+                        # identifies the model in msgs to the database commit process
+                        "model_id": len(models_cfg),
                         }
         return models_cfg
 
@@ -104,80 +155,461 @@ class EmbeddingService:
     # -------------------------------------------------------------------------
     def load_model(self, name: str, cfg: dict) -> None:
         EmbeddingService.setup_model_dir(cfg)
-        cache_file_path = self.get_binpath(name)
-        if not os.path.exists(cache_file_path):
-            with open(cache_file_path, "wb") as f:
-                pass
         self.models[name] = Model(name, cfg["embedding_dimension"],
-                                  cfg["data_dirpath"], self.db_type)
+                                  cfg["data_dirpath"], self.db_type,
+                                  load_transformers=not self.stub_model,
+                                  hot_cache_bytes=self.hot_cache_bytes, model_id=cfg["model_id"],
+                                  track_access=self.track_access,
+                                  stub_encode_ms=self.stub_encode_ms)
+        EmbeddingService.setup_lock_dir()
+        self.cache_files[name] = CacheShards(cfg["data_dirpath"], cfg["embedding_dimension"],
+                                             self.get_lock_filepath(name), ACQUIRE_LOCK_TIMEOUT,
+                                             cfg["storage_dtype"], self.cache_shards,
+                                             self.max_shard_bytes, self.write_ahead)
+        self.write_queues[name] = deque()
+        self.write_locks[name] = Lock()
+        if self.store_documents:
+            self.document_stores[name] = DocumentStore(cfg["data_dirpath"])
+        tokens_dirpath = os.path.join(cfg["data_dirpath"], TOKENS_DIRNAME)
+        token_dimension = self.models[name].get_token_dimension()
+        self.token_caches[name] = TokenCache(
+                tokens_dirpath, token_dimension,
+                f"{os.path.splitext(self.get_lock_filepath(name))[0]}.tokens.lock",
+                ACQUIRE_LOCK_TIMEOUT, cfg["storage_dtype"])
+        self.token_models[name] = Model(name, token_dimension, tokens_dirpath, self.db_type,
+                                        load_transformers=False,
+                                        model_id=cfg["model_id"] | TOKENS_MODEL_ID)
 
     # -------------------------------------------------------------------------
     def get_embeddings(self, document: str, model_name: str, read_cache: bool = True
     ) -> tuple[np.ndarray, list | None]:
-        document_hash = EmbeddingService.get_hash(document)
+        document_hash = EmbeddingService.get_digest(document)
         model = self.models[model_name]
 
         to_write = None
         if read_cache:
-            offset = model.read_offset(document_hash)
-            if offset is not None:
-                # return np.array([0])
-                return self.read_embeddings(offset, model, self.get_binpath(model_name)), to_write
-
-        embeddings = model.compute_embeddings(document)
-        # the to_write list is used by caller to write_embeddings in the BG after the response
-        # has been sent
-        to_write = [embeddings, document_hash, model]
+            embeddings = self.get_cached_embeddings(document_hash, model_name)
+            if embeddings is not None:
+                return embeddings, to_write
+
+        future, owner = self.claim(document_hash, model_name)
+        if not owner:   # identical document in flight, its owner computes & writes it
+            embeddings = future.result()
+            if embeddings is not RECLAIM:
+                return embeddings, to_write
+            # its owner was cancelled: claimed again (& computed, unless another request was 1st)
+            return self.get_embeddings(document, model_name, read_cache)
+        across_workers = read_cache and self.coalesce_across_workers
+        try:
+            embeddings = None
+            if across_workers:
+                embeddings = self.claim_across_workers([document_hash], model_name).get(
+                        document_hash)
+            if embeddings is None:
+                embeddings = model.compute_embeddings(document)
+                # the to_write list is used by caller to write_embeddings in the BG after the
+                # response has been sent
+                to_write = [embeddings, document_hash, model]
+        except BaseException as e:
+            if across_workers:
+                model.release([document_hash])
+            self.fail(document_hash, model_name, e)
+            raise
+        self.publish(document_hash, model_name, embeddings)
         return embeddings, to_write
 
     # -------------------------------------------------------------------------
-    def _write_embeddings(self, packed_data: bytes, document_hash: str, model: Model) -> int:
-        offset = -1
-        with open(self.get_binpath(model.name), "rb+") as f:
-            f.seek(0, 2)        # move file pointer to end of file
-            offset = f.tell()
-            f.write(packed_data)
-        return offset
+    def claim(self, document_hash: bytes, model_name: str) -> tuple[Future, bool]:
+        """
+        in-worker request coalescing, call on a cache miss: returns (future, True) if the caller
+        must compute the embeddings, then publish (or fail) them, or (future, False) if the same
+        document is already being computed, the caller waits on future (result() or awaited via
+        asyncio.wrap_future) & doesn't write the embeddings
+        """
+        return self.coalescer.claim((model_name, document_hash))
+
+    def publish(self, document_hash: bytes, model_name: str, embeddings: np.ndarray) -> None:
+        "hands claimed & computed embeddings to waiting requests & the model's hot cache"
+        # hot cache 1st: requests that miss it after the claim is released would compute again
+        self.models[model_name].hot_cache.put(document_hash, embeddings)
+        self.coalescer.resolve((model_name, document_hash), embeddings)
+
+    def fail(self, document_hash: bytes, model_name: str, exception: BaseException) -> None:
+        self.coalescer.fail((model_name, document_hash), exception)
+
+    # -------------------------------------------------------------------------
+    def claim_across_workers(self, document_hashes: list[bytes], model_name: str
+    ) -> dict[bytes, np.ndarray]:
+        """
+        cross-worker request coalescing through the database commit process, for misses this
+        worker owns (see claim) & will write: claims them all in 1 round trip, waits for those
+        claimed by other workers to be cached & returns their embeddings. This worker computes
+        the others, then writes them or, if it won't (failed, cancelled), Model.release them.
+        While waiting, misses are claimed again: a claim released by its worker (or expired) is
+        granted to this one. Gives up waiting after CLAIM_WAIT_TIMEOUT (the rest is computed)
+        """
+        model = self.models[model_name]
+        waiting = [document_hash for document_hash, granted
+                   in zip(document_hashes, model.claim_many(document_hashes)) if not granted]
+        found = {}
+        deadline = monotonic() + CLAIM_WAIT_TIMEOUT
+        interval = CLAIM_POLL_INTERVAL
+        while len(waiting) and monotonic() < deadline:
+            sleep(interval)
+            for document_hash, location in model.read_offsets(waiting).items():
+                embeddings = self.read_embeddings(location, model)
+                if embeddings is not None:
+                    model.hot_cache.put(document_hash, embeddings)
+                    found[document_hash] = embeddings
+            waiting = [document_hash for document_hash in waiting if document_hash not in found]
+            waiting = [document_hash for document_hash, granted
+                       in zip(waiting, model.claim_many(waiting)) if not granted]
+            interval = min(2 * interval, CLAIM_POLL_MAX_INTERVAL)
+        if len(waiting):
+            logging.warning(f"claim_across_workers: {len(waiting)} documents not cached after "
+                            f"{CLAIM_WAIT_TIMEOUT}s, computing them")
+        return found
+
+    def claim_misses_across_workers(self, model_name: str, embeddings: np.ndarray,
+                                    owned: dict) -> dict:
+        """
+        claim_across_workers for the owned misses of claim_misses: fills & publishes the rows of
+        those cached by other workers, returns the rest ({document hash: rows}) to compute
+        """
+        found = self.claim_across_workers(list(owned), model_name)
+        for document_hash, document_embeddings in found.items():
+            embeddings[owned[document_hash]] = document_embeddings
+            self.publish(document_hash, model_name, document_embeddings)
+        return {document_hash: rows for document_hash, rows in owned.items()
+                if document_hash not in found}
+
+    # -------------------------------------------------------------------------
+    def get_cached_embeddings(self, document_hash: bytes, model_name: str, hot_cache: bool = True
+    ) -> np.ndarray | None:
+        """
+        gets the embeddings of an already hashed document from the model's hot (in-memory) cache
+        or reads them from the cache file, None on a miss.
+        hot_cache=False skips the hot cache look-up (e.g. caller already missed there)
+        """
+        model = self.models[model_name]
+        if hot_cache:
+            embeddings = model.hot_cache.get(document_hash)
+            if embeddings is not None:
+                model.touch([document_hash])
+                return embeddings
+        started = perf_counter()
+        location = model.read_offset(document_hash)
+        metrics.observe_stage(model_name, "lookup", started)
+        if location is None:
+            return None
+        started = perf_counter()
+        embeddings = self.read_embeddings(location, model)
+        metrics.observe_stage(model_name, "read", started)
+        if embeddings is not None:
+            model.hot_cache.put(document_hash, embeddings)
+            model.touch([document_hash])
+        return embeddings
+
+    # -------------------------------------------------------------------------
+    def get_embeddings_batch(self, documents: list[str], model_name: str, read_cache: bool = True
+    ) -> tuple[np.ndarray, list | None]:
+        """
+        batched get_embeddings: all documents are hashed & looked-up in the index in 1 pass, then
+        only the misses are computed with a single (batched) call to the model. Duplicate
+        documents within the batch are computed once.
+        returns a contiguous (len(documents), dim) float32 matrix in request order, and a
+        to_write list (None if nothing was computed) for write_embeddings_batch
+        """
+        embeddings, miss_rows = self.lookup_embeddings_batch(documents, model_name, read_cache)
+        if not len(miss_rows):
+            return embeddings, None
+        owned, in_flight = self.claim_misses(model_name, miss_rows)
+        across_workers = read_cache and self.coalesce_across_workers
+        to_write = None
+        if len(owned):
+            try:
+                if across_workers:
+                    owned = self.claim_misses_across_workers(model_name, embeddings, owned)
+                if len(owned):
+                    computed = self.models[model_name].compute_embeddings_batch(
+                            EmbeddingService.get_miss_documents(documents, owned))
+            except BaseException as e:
+                if across_workers:
+                    self.models[model_name].release(list(owned))
+                self.fail_misses(model_name, owned, e)
+                raise
+        if len(owned):
+            to_write = self.fill_misses(model_name, embeddings, owned, computed)
+        reclaimed = {}  # misses whose owners were cancelled, claimed again
+        for document_hash, (rows, future) in in_flight.items():
+            result = future.result()
+            if result is RECLAIM:
+                reclaimed[document_hash] = rows
+            else:
+                embeddings[rows] = result
+        if len(reclaimed):
+            computed, reclaimed_write = self.get_embeddings_batch(
+                    EmbeddingService.get_miss_documents(documents, reclaimed), model_name,
+                    read_cache)
+            for rows, embedding in zip(reclaimed.values(), computed):
+                embeddings[rows] = embedding
+            to_write = EmbeddingService.join_writes(to_write, reclaimed_write)
+        return embeddings, to_write
+
+    @staticmethod
+    def join_writes(to_write: list | None, other: list | None) -> list | None:
+        "2 to_write lists (see fill_misses) of 1 model as 1"
+        if to_write is None or other is None:
+            return other if to_write is None else to_write
+        return [np.concatenate([to_write[0], other[0]]), to_write[1] + other[1], to_write[2]]
 
     # -------------------------------------------------------------------------
-    def write_embeddings(self, embedding: list, document_hash: str, model: Model) -> None:
+    def lookup_embeddings_batch(self, documents: list[str], model_name: str,
+                                read_cache: bool = True) -> tuple[np.ndarray, dict]:
+        """
+        1st half of get_embeddings_batch (no model inference): hashes all documents & fills the
+        rows of cached ones into a new (len(documents), dim) matrix.
+        returns the matrix & the misses as {document hash: [rows of the matrix]}
+        """
+        model = self.models[model_name]
+        started = perf_counter()
+        document_hashes = [EmbeddingService.get_digest(document) for document in documents]
+        metrics.observe_stage(model_name, "hash", started)
+        embeddings = np.empty((len(documents), model.embedding_dimension), dtype=np.float32)
+
+        started = perf_counter()
+        cold_rows = []  # rows which missed the hot cache
+        touched = []    # hits, for the access stats
+        for row, document_hash in enumerate(document_hashes):
+            hot = model.hot_cache.get(document_hash) if read_cache else None
+            if hot is None:
+                cold_rows.append(row)
+            else:
+                embeddings[row] = hot
+                touched.append(document_hash)
+
+        offsets = (model.read_offsets([document_hashes[row] for row in cold_rows])
+                   if read_cache else {})
+        metrics.observe_stage(model_name, "lookup", started)
+        hit_rows, hit_offsets = [], []
+        miss_rows = {}  # document hash -> rows of embeddings where it's needed
+        for row in cold_rows:
+            document_hash = document_hashes[row]
+            offset = offsets.get(document_hash)
+            if offset is None:
+                miss_rows.setdefault(document_hash, []).append(row)
+            else:
+                hit_rows.append(row)
+                hit_offsets.append(offset)
+        if len(hit_rows):
+            started = perf_counter()
+            hits = self.cache_files[model_name].read_many(hit_offsets)
+            metrics.observe_stage(model_name, "read", started)
+            if hits is None:    # index points past EOF, recompute them all
+                for row in hit_rows:
+                    miss_rows.setdefault(document_hashes[row], []).append(row)
+            else:
+                embeddings[hit_rows] = hits
+                for row, hit in zip(hit_rows, hits):
+                    model.hot_cache.put(document_hashes[row], hit)
+                    touched.append(document_hashes[row])
+        if len(touched):
+            model.touch(touched)
+        if read_cache:
+            metrics.count_lookups(model_name, len(documents) - len(cold_rows) + len(hit_rows),
+                                  sum(len(rows) for rows in miss_rows.values()))
+        return embeddings, miss_rows
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def get_miss_documents(documents: list[str], miss_rows: dict) -> list[str]:
+        "the documents to compute for misses returned by lookup_embeddings_batch, 1 per hash"
+        return [documents[rows[0]] for rows in miss_rows.values()]
+
+    # -------------------------------------------------------------------------
+    def claim_misses(self, model_name: str, miss_rows: dict) -> tuple[dict, dict]:
+        """
+        request coalescing for the misses returned by lookup_embeddings_batch, returns:
+        * owned: {document hash: rows} which the caller must compute, then fill_misses (or
+          fail_misses)
+        * in_flight: {document hash: (rows, future)} already being computed by other requests
+        """
+        owned, in_flight = {}, {}
+        for document_hash, rows in miss_rows.items():
+            future, owner = self.claim(document_hash, model_name)
+            if owner:
+                owned[document_hash] = rows
+            else:
+                in_flight[document_hash] = (rows, future)
+        return owned, in_flight
+
+    # -------------------------------------------------------------------------
+    def fill_misses(self, model_name: str, embeddings: np.ndarray, miss_rows: dict,
+                    computed: np.ndarray) -> list:
+        """
+        2nd half of get_embeddings_batch: copies the computed embeddings (in get_miss_documents
+        order) into their rows & publishes them, returns the to_write list for
+        write_embeddings_batch
+        """
+        for (document_hash, rows), embedding in zip(miss_rows.items(), computed):
+            embeddings[rows] = embedding
+            self.publish(document_hash, model_name, embedding)
+        return [computed, list(miss_rows.keys()), self.models[model_name]]
+
+    def fail_misses(self, model_name: str, miss_rows: dict, exception: BaseException) -> None:
+        for document_hash in miss_rows:
+            self.fail(document_hash, model_name, exception)
+
+    # -------------------------------------------------------------------------
+    def write_embeddings(self, embedding: np.ndarray, document_hash: bytes, model: Model) -> None:
         """
         writes the computed word embeddings into a file.
         Also stores the offset information into the model index.
         """
-        format_string = f"{len(embedding)}f"
-        packed_data = pack(format_string, *embedding)
-        lock_dir = EmbeddingService.get_lock_dirpath()
+        self.write_embeddings_batch(
+                np.asarray(embedding, dtype=np.float32).reshape(1, -1), [document_hash], model)
 
-        if not os.path.exists(lock_dir):
-            try:
-                os.mkdir(lock_dir)
-            except FileExistsError:
-                pass    # lost the race to another worker?
-        if model.name not in self.locks:
-            self.locks[model.name] = FileLock(self.get_lock_filepath(model.name),
-                                              timeout=ACQUIRE_LOCK_TIMEOUT)
-        try:
-            self.locks[model.name].acquire()
-        except Timeout:
-            logging.error(f'timed-out acquiring lockfile to write to "{bin_filepath}", giving up...')
-            return
+    # -------------------------------------------------------------------------
+    def write_embeddings_batch(self, embeddings: np.ndarray, document_hashes: list[bytes],
+                               model: Model) -> None:
+        """
+        writes each row of embeddings into the cache & stores its location in the model index.
+        Writes are group-committed: the rows are queued, then whichever thread gets the model's
+        write lock first writes everything queued by then (its own & other threads' rows) with 1
+        locked append per cache shard & 1 batched index insert. The rows are already in the
+        model's hot cache, computed rows are published (see publish) before they're written
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        cache = self.cache_files[model.name]
+        queue = self.write_queues[model.name]
+        queue.append((embeddings, document_hashes))
+        metrics.add_write_backlog(model.name, len(document_hashes))
+        with self.write_locks[model.name]:
+            queued = []
+            while len(queue):
+                queued.append(queue.popleft())
+            if not len(queued):     # another thread already committed these rows
+                return
+            started = perf_counter()
+            embeddings = np.concatenate([queued_embeddings for queued_embeddings, _ in queued])
+            hashes = [document_hash for _, queued_hashes in queued
+                      for document_hash in queued_hashes]
+            if cache.cnt_shards == 1:
+                shard_rows = {0: list(range(len(hashes)))}
+            else:
+                shard_rows = {}
+                for row, document_hash in enumerate(hashes):
+                    shard_rows.setdefault(cache.get_shard(document_hash), []).append(row)
+            written_hashes, locations = [], []
+            for shard, rows in shard_rows.items():
+                shard_locations = cache.append(shard, embeddings[rows],
+                                               [hashes[row] for row in rows])
+                if shard_locations is None:
+                    metrics.count_dropped_writes(model.name, "lock_timeout", len(rows))
+                    continue
+                written_hashes.extend(hashes[row] for row in rows)
+                locations.extend(shard_locations)
+            metrics.add_write_backlog(model.name, -len(hashes))
+            if not len(locations):
+                return
 
-        offset = self._write_embeddings(packed_data, document_hash, model)
-        self.locks[model.name].release()
+        # the cache is written b4 the index: a crash in between leaves vectors without index rows
+        # (indexed by start-up recovery with --write-ahead, else dropped by compactCache.py), the
+        # reverse order would leave index rows pointing to vectors that were never written
+        model.write_offsets(written_hashes, locations)
+        metrics.observe_stage(model.name, "write", started)
 
-        # TODO: add consistentcy chk @ start-up in case app exits after cache wr, but b4 DB insert
-        # note: only consequence for above TODO would probably be a "lost" cached embedding in file
-        # reverse order (DB insert b4 cache wr) seems to have worse consequence (data corruption)
-        model.write_offset(document_hash, offset)
+    # -------------------------------------------------------------------------
+    def read_embeddings(self, location: int, model: Model) -> np.ndarray | None:
+        """
+        reads the embeddings from the model's cache, returns a read-only view of its memory
+        map (no copy, float32 storage) or None if location is past the end of its file
+        """
+        return self.cache_files[model.name].read(location)
 
     # -------------------------------------------------------------------------
-    def read_embeddings(self, offset: int, model: Model, path: str) -> np.ndarray:
-        "reads the embeddings from a cache file"
-        with open(path, "rb") as f:
-            f.seek(offset)
-            embedding = [0] * model.embedding_dimension
-            for i in range(model.embedding_dimension):
-                embedding[i] = unpack("f", f.read(4))[0]
-            return np.array(embedding, dtype=np.float32)
+    def lookup_tokens_batch(self, documents: list[str], model_name: str, read_cache: bool = True
+    ) -> tuple[list, dict]:
+        """
+        1st half of word embeddings (no model inference): hashes all documents & reads the token
+        vectors of cached ones with 1 gather. returns each document's (n_tokens, dim) matrix
+        (None for misses) & the misses as {document hash: [rows]}, as lookup_embeddings_batch
+        """
+        document_hashes = [EmbeddingService.get_digest(document) for document in documents]
+        matrices = [None] * len(documents)
+        entry_ids = (self.token_models[model_name].read_offsets(document_hashes)
+                     if read_cache else {})
+        if len(entry_ids):
+            hit_hashes = list(entry_ids)
+            hits = self.token_caches[model_name].read_many(
+                    [entry_ids[document_hash] for document_hash in hit_hashes])
+            if hits is not None:    # else an entry is missing, recompute them all
+                found = dict(zip(hit_hashes, split_tokens(*hits)))
+                matrices = [found.get(document_hash) for document_hash in document_hashes]
+        miss_rows = {}
+        for row, matrix in enumerate(matrices):
+            if matrix is None:
+                miss_rows.setdefault(document_hashes[row], []).append(row)
+        return matrices, miss_rows
 
+    def fill_token_misses(self, model_name: str, matrices: list, miss_rows: dict,
+                          computed: tuple[np.ndarray, np.ndarray]) -> list:
+        """
+        2nd half of word embeddings: puts the computed token vectors (of get_miss_documents,
+        joined) in their rows, returns the to_write list for write_token_embeddings
+        """
+        for rows, matrix in zip(miss_rows.values(), split_tokens(*computed)):
+            for row in rows:
+                matrices[row] = matrix
+        return [*computed, list(miss_rows), model_name]
+
+    def write_token_embeddings(self, vectors: np.ndarray, lengths: np.ndarray,
+                               document_hashes: list[bytes], model_name: str) -> None:
+        "caches the documents' token vectors with 1 locked append & indexes their entries"
+        entry_ids = self.token_caches[model_name].append(vectors, lengths)
+        if entry_ids is None:
+            metrics.count_dropped_writes(model_name, "lock_timeout", len(document_hashes))
+        else:
+            self.token_models[model_name].write_offsets(document_hashes, entry_ids)
+
+    # -------------------------------------------------------------------------
+    def write_documents(self, document_hashes: list[bytes], documents: list[str], model_name: str
+    ) -> None:
+        "stores the text of computed documents for search results (with --store-documents)"
+        document_store = self.document_stores.get(model_name)
+        if document_store is not None:
+            document_store.put_many(document_hashes, documents)
+
+    # -------------------------------------------------------------------------
+    def get_search_index(self, model_name: str) -> SearchIndex | None:
+        "opened on its 1st call, None if the model has no search index (see --search-index)"
+        search_index = self.search_indexes.get(model_name)
+        if search_index is None:
+            search_index = SearchIndex(self.models_cfg[model_name]["data_dirpath"])
+            if search_index.centroids is None:
+                return None
+            self.search_indexes[model_name] = search_index
+        return search_index
+
+    def search(self, query: np.ndarray, model_name: str, k: int = 10, metric: str = "cosine",
+               nprobe: int = 8, with_documents: bool = False) -> list[dict] | None:
+        """
+        the k cached documents most similar to the query vector, best 1st, as dicts of digest
+        (hex), score & document (if with_documents & stored). None if the model has no search
+        index (see --search-index)
+        """
+        search_index = self.get_search_index(model_name)
+        if search_index is None:
+            return None
+        found = search_index.search(query, self.cache_files[model_name], k, metric, nprobe)
+        documents = {}
+        if with_documents and model_name in self.document_stores:
+            documents = self.document_stores[model_name].get_many(
+                    [document_hash for document_hash, _ in found])
+        results = []
+        for document_hash, score in found:
+            result = {"digest": document_hash.hex(), "score": score}
+            if with_documents:
+                result["document"] = documents.get(document_hash)
+            results.append(result)
+        return results
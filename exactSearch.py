@@ -0,0 +1,176 @@
+"""
+exact (brute force) top-k similarity search over a model's cache files: every stored vector is
+scored against the queries with blocked matrix multiplies over the files' memory maps. Blocks are
+sized to stay in the CPU's L2/L3 cache (BLOCK_NBYTES of stored vectors), each keeps only its k
+best with argpartition & blocks are scored in parallel by a pool of threads (numpy releases the
+GIL in its matrix multiplies), so a scan runs @ about memory bandwidth.
+It's the ground truth for the recall of searchIndex.py & fast enough on its own for caches which
+fit in RAM. It scans all vectors, including those no index row points to (see compactCache.py),
+which have no digest: compact the cache 1st for exact recall figures.
+As a CLI: benchmarks a scan of a model directory & the recall of its search index, if any
+"""
+import argparse
+import logging
+import numpy as np
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from sys import stderr
+from time import perf_counter
+
+from cacheShards import CacheShards
+from compactCache import LOCK_PATH, get_cache_files
+from searchIndex import METRICS, SearchIndex, normalize
+
+BLOCK_NBYTES = 2**20    # stored vectors scored per step
+NPROBES = [1, 2, 4, 8, 16, 32]  # benchmarked for the search index's recall
+
+
+def scan_block(cache: CacheShards, file_id: int, start: int, cnt: int, queries: np.ndarray,
+               k: int, metric: str) -> tuple[np.ndarray, np.ndarray]:
+    "the k best (scores, locations) of each query among cnt vectors of a file, unsorted"
+    vectors = cache.get_file(file_id).read_rows(start, cnt)
+    scores = queries @ vectors.T    # (queries, cnt)
+    if metric == "cosine":
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1
+        scores /= norms
+    if k < cnt:
+        rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, rows, axis=1)
+    else:
+        rows = np.broadcast_to(np.arange(cnt), scores.shape)
+    cache_file = cache.get_file(file_id)
+    locations = CacheShards.pack_location(file_id, (start + rows) * cache_file.vector_nbytes)
+    return scores, locations
+
+# -----------------------------------------------------------------------------
+def exact_search(cache: CacheShards, queries: np.ndarray, k: int = 10, metric: str = "cosine",
+                 threads: int = 0, block_nbytes: int = BLOCK_NBYTES
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    the k most similar vectors of each query (a vector or a (n_queries, dim) matrix) as (scores,
+    locations), both (n_queries, k) & best 1st, fewer columns if the cache has fewer vectors.
+    threads: 0 for 1 per core
+    """
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {METRICS}, got \"{metric}\"")
+    queries = np.asarray(queries, dtype=np.float32).reshape(-1, cache.embedding_dimension)
+    if metric == "cosine":
+        queries = normalize(queries)
+    tasks = []  # (file id, 1st vector, number of vectors) of each block
+    for file_id in cache.get_file_ids():
+        cache_file = cache.get_file(file_id)
+        cnt_vectors = os.path.getsize(cache_file.path) // cache_file.vector_nbytes
+        block_rows = max(block_nbytes // cache_file.vector_nbytes, 1)
+        tasks.extend((file_id, start, min(block_rows, cnt_vectors - start))
+                     for start in range(0, cnt_vectors, block_rows))
+    if not len(tasks):
+        return (np.empty((len(queries), 0), dtype=np.float32),
+                np.empty((len(queries), 0), dtype=np.int64))
+    with ThreadPoolExecutor(threads or os.cpu_count()) as executor:
+        blocks = list(executor.map(lambda task: scan_block(cache, *task, queries, k, metric),
+                                   tasks))
+    scores = np.concatenate([block_scores for block_scores, _ in blocks], axis=1)
+    locations = np.concatenate([block_locations for _, block_locations in blocks], axis=1)
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1),
+                             axis=1)
+    return np.take_along_axis(scores, top, axis=1), np.take_along_axis(locations, top, axis=1)
+
+# -----------------------------------------------------------------------------
+def open_cache(model_dirpath: str, dimension: int | None) -> CacheShards:
+    "the model's cache files, dimension: only needed without embeddings.json"
+    cache_files = get_cache_files(model_dirpath, dimension)
+    if not len(cache_files):
+        raise ValueError(f'"{model_dirpath}" has no cache files')
+    cache_file = cache_files[min(cache_files)]
+    return CacheShards(model_dirpath, cache_file.embedding_dimension, LOCK_PATH, 0,
+                       cache_file.storage_dtype)
+
+def benchmark(model_dirpath: str, dimension: int | None, cnt_queries: int, k: int, metric: str,
+              threads: int, block_nbytes: int, batch: int) -> None:
+    "logs the scan's throughput & the search index's recall@k against it, per nprobe"
+    cache = open_cache(model_dirpath, dimension)
+    cnt_vectors = sum(os.path.getsize(cache.get_file(file_id).path)
+                      // cache.get_file(file_id).vector_nbytes for file_id in cache.get_file_ids())
+    if not cnt_vectors:
+        logging.error(f'"{model_dirpath}" has no cached vectors')
+        return
+    # the queries are cached vectors, so each 1 finds itself 1st
+    file_id = cache.get_file_ids()[0]
+    cache_file = cache.get_file(file_id)
+    rng = np.random.default_rng(0)
+    starts = rng.integers(0, os.path.getsize(cache_file.path) // cache_file.vector_nbytes,
+                          cnt_queries)
+    queries = np.stack([cache_file.read_rows(int(start), 1)[0] for start in starts])
+
+    results = []
+    started = perf_counter()
+    for i in range(0, cnt_queries, batch):
+        scores, locations = exact_search(cache, queries[i:i + batch], k, metric, threads,
+                                         block_nbytes)
+        results.append(locations)
+    secs = perf_counter() - started
+    nbytes = sum(os.path.getsize(cache.get_file(file_id).path) for file_id in cache.get_file_ids())
+    cnt_scans = -(-cnt_queries // batch)
+    logging.info(f"exact: {cnt_vectors} vectors, {cnt_queries} queries in batches of {batch}: "
+                 f"{1000 * secs / cnt_scans:.1f}ms per scan, {cnt_queries / secs:.0f} queries/s, "
+                 f"{cnt_vectors * cnt_scans / secs / 1e6:.1f}M vectors/s, "
+                 f"{nbytes * cnt_scans / secs / 2**30:.2f}GiB/s")
+
+    search_index = SearchIndex(model_dirpath)
+    if search_index.centroids is None:
+        logging.info(f'"{model_dirpath}" has no search index, skipping recall')
+        return
+    records = np.concatenate(search_index.lists[1])
+    digests = dict(zip(records["location"].tolist(),
+                       (digest.tobytes() for digest in records["digest"])))
+    exact = [{digests.get(location) for location in row}
+             for row in np.concatenate(results).tolist()]
+    for nprobe in NPROBES:
+        if nprobe > len(search_index.centroids) and nprobe != NPROBES[0]:
+            break
+        found, started = 0, perf_counter()
+        for query, exact_digests in zip(queries, exact):
+            approx = search_index.search(query, cache, k, metric, nprobe)
+            found += len(exact_digests & {digest for digest, _ in approx})
+        secs = perf_counter() - started
+        logging.info(f"search index: nprobe {nprobe} of {len(search_index.centroids)} lists: "
+                     f"recall@{k} {found / (cnt_queries * k):.3f}, "
+                     f"{1000 * secs / cnt_queries:.2f}ms per query")
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model_dir",
+            help="a model data directory, e.g. 'data/sentence-transformers_...'")
+    parser.add_argument("--batch",
+            help="optional: queries scored per scan, default: 1",
+            default=1, type=int)
+    parser.add_argument("--block-kb",
+            help=f"optional: KiB of stored vectors per block, default: {BLOCK_NBYTES // 1024}",
+            default=BLOCK_NBYTES // 1024, type=int)
+    parser.add_argument("--dimension",
+            help="optional: embedding dimension, only needed for cache files written before the"
+                 " storage dtype was recorded (no embeddings.json)",
+            type=int)
+    parser.add_argument("-k",
+            help="optional: number of results per query, default: 10",
+            default=10, type=int)
+    parser.add_argument("--metric",
+            choices=METRICS,
+            help="optional: default: 'cosine'",
+            default="cosine")
+    parser.add_argument("-q", "--queries",
+            help="optional: number of queries (vectors sampled from the cache), default: 100",
+            default=100, type=int)
+    parser.add_argument("--threads",
+            help="optional: scan threads, default: 1 per core",
+            default=0, type=int)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO, stream=stderr)
+
+    benchmark(args.model_dir, args.dimension, args.queries, args.k, args.metric, args.threads,
+              args.block_kb * 1024, args.batch)
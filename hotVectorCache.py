@@ -0,0 +1,59 @@
+"""
+bounded in-process LRU cache of recently used embeddings (1 per model), keyed on document hash.
+Sits in front of the index & cache file: a hot hit costs a dict lookup, no index query, no read
+"""
+import numpy as np
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class HotVectorCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes  # budget for the vectors' data, 0 disables the cache
+        self.entries = OrderedDict()    # least recently used 1st
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    # -------------------------------------------------------------------------
+    def get(self, document_hash: bytes) -> np.ndarray | None:
+        "returns the (read-only) cached vector & marks it most recently used, None on a miss"
+        if self.max_bytes <= 0:
+            return None
+        with self.lock:
+            vector = self.entries.get(document_hash)
+            if vector is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(document_hash)
+            self.hits += 1
+            return vector
+
+    # -------------------------------------------------------------------------
+    def put(self, document_hash: bytes, vector: np.ndarray) -> None:
+        "caches a copy of vector, evicting least recently used vectors to stay within budget"
+        if self.max_bytes <= 0 or vector.nbytes > self.max_bytes:
+            return
+        # own copy: vector may be a view of a cache file's map or of a caller's batch matrix
+        vector = np.array(vector, dtype=np.float32)
+        vector.flags.writeable = False
+        with self.lock:
+            previous = self.entries.pop(document_hash, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self.entries[document_hash] = vector
+            self.nbytes += vector.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    # -------------------------------------------------------------------------
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.nbytes,
+                    "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
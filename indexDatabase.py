@@ -1,4 +1,5 @@
 import abc
+from collections.abc import Iterator
 from os import path
 from tempfile import gettempdir
 
@@ -18,12 +19,12 @@ class IndexDatabase(metaclass=abc.ABCMeta):
         pass
     # -------------------------------------------------------------------------
     @abc.abstractmethod
-    def add_row(self, document_hash: str, offset: int) -> bool:
+    def add_row(self, document_hash: bytes, offset: int) -> bool:
         """
         Add a new row to the 'OffsetIndex' table.
 
         Args:
-            document_hash (str): The document hash value.
+            document_hash (bytes): The document hash value (raw sha256 digest).
             offset (int): The offset value.
 
         Returns:
@@ -31,19 +32,79 @@ class IndexDatabase(metaclass=abc.ABCMeta):
         """
         pass
     # -------------------------------------------------------------------------
+    def add_rows(self, rows: list[tuple[bytes, int]]) -> bool:
+        """
+        Add several rows to the 'OffsetIndex' table as 1 batch. Implementations which can insert
+        many rows at once (e.g. executemany or a write batch) should override this default.
+
+        Args:
+            rows (list[tuple[bytes, int]]): (document hash, offset) pairs.
+
+        Returns:
+            True: success, False: error
+        """
+        return all([self.add_row(document_hash, offset) for document_hash, offset in rows])
+    # -------------------------------------------------------------------------
+    def flush(self) -> None:
+        """
+        Commit rows added so far which are still held back for batching (e.g. until
+        COMMIT_AFTER_CNT rows), so that readers see them. Default: nothing is held back.
+        """
+        pass
+    # -------------------------------------------------------------------------
     @abc.abstractmethod
-    def read_offset(self, document_hash: str) -> int | None:
+    def read_offset(self, document_hash: bytes) -> int | None:
         """
         Read the offset value from the 'OffsetIndex' table based on the supplied document hash.
 
         Args:
-            document_hash (str): The document hash value.
+            document_hash (bytes): The document hash value (raw sha256 digest).
 
         Returns:
             int or None: The offset value if found, otherwise None.
         """
         pass
     # -------------------------------------------------------------------------
+    def read_offsets(self, document_hashes: list[bytes]) -> dict[bytes, int]:
+        """
+        Read the offset values for several document hashes in 1 pass. Implementations which can
+        look-up many keys at once (e.g. an SQL "IN" query) should override this default.
+
+        Args:
+            document_hashes (list[bytes]): The document hash values.
+
+        Returns:
+            dict: document hash -> offset, only for hashes which were found.
+        """
+        offsets = {}
+        for document_hash in document_hashes:
+            offset = self.read_offset(document_hash)
+            if offset is not None:
+                offsets[document_hash] = offset
+        return offsets
+    # -------------------------------------------------------------------------
+    @abc.abstractmethod
+    def delete_rows(self, document_hashes: list[bytes]) -> None:
+        """
+        Delete the rows of the document hashes from the 'OffsetIndex' table (e.g. rows pointing
+        past the end of the cache file) & commit, hashes without a row are ignored.
+
+        Args:
+            document_hashes (list[bytes]): The document hash values.
+        """
+        pass
+    # -------------------------------------------------------------------------
+    @abc.abstractmethod
+    def iter_rows(self) -> Iterator[tuple[bytes, int]]:
+        """
+        Iterate over all rows of the 'OffsetIndex' table (e.g. to compact the cache file), in no
+        particular order.
+
+        Returns:
+            Iterator of (document hash, offset) pairs.
+        """
+        pass
+    # -------------------------------------------------------------------------
 
     """
     @abc.abstractmethod
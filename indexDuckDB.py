@@ -0,0 +1,179 @@
+import duckdb
+import logging
+import pyarrow as pa
+
+from collections.abc import Iterator
+from os import path
+from threading import Lock
+
+from indexDatabase import IndexDatabase
+
+
+class IndexDuckDB(IndexDatabase):
+    """
+    per docs: only 1 process may open the database read-write & no other process may open it
+    then, so the database commit process owns it & serves the workers' reads (like LevelDB).
+    Rows are inserted in batches as Arrow tables (1 vectorized INSERT per batch)
+    """
+    INDEX_DB_FILE = "indexDatabase.duckdb"
+    TABLE = "OffsetIndex"   # documentHash: raw 32 byte sha256 digest (BLOB), "offset" is reserved
+    SCHEMA = pa.schema([("documentHash", pa.binary(32)), ("_offset", pa.int64())])
+    COMMIT_AFTER_CNT = 1000 # rows buffered before a batch insert, flush() inserts the rest
+    ITER_CHUNK = 100000     # rows fetched per step by iter_rows
+
+    def __init__(self, dirpath: str, readonly: bool = False):
+        self.db_filepath = path.join(dirpath, self.INDEX_DB_FILE)
+        self.readonly = readonly
+        self.connection = None
+        try:
+            self.connection = duckdb.connect(self.db_filepath, read_only=readonly)
+        except duckdb.Error as e:
+            logging.error(f'failed to connect to database: "{str(e)}"')
+            raise ConnectionError
+        self.pending = {}   # digest -> offset, rows not inserted yet
+        self.lock = Lock()  # the connection & pending are shared by the DCP's threads
+        if not readonly:
+            self.create_table_if_not_exists()
+
+    # -------------------------------------------------------------------------
+    def create_table_if_not_exists(self) -> None:
+        if self.readonly:
+            return
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {self.TABLE} "
+                                "(documentHash BLOB PRIMARY KEY, _offset BIGINT)")
+
+    # -------------------------------------------------------------------------
+    def _insert_arrow(self, rows: pa.Table) -> None:
+        "1 vectorized insert of an Arrow table of rows, call with self.lock held"
+        self.connection.register("new_rows", rows)
+        try:
+            self.connection.execute(f"INSERT OR IGNORE INTO {self.TABLE} "
+                                    "SELECT documentHash, _offset FROM new_rows")
+        finally:
+            self.connection.unregister("new_rows")
+
+    def _insert_pending(self) -> None:
+        if not len(self.pending):
+            return
+        rows = pa.table([pa.array(list(self.pending.keys()), pa.binary(32)),
+                         pa.array(list(self.pending.values()), pa.int64())],
+                        schema=self.SCHEMA)
+        self._insert_arrow(rows)
+        self.pending = {}
+
+    # -------------------------------------------------------------------------
+    def add_row(self, document_hash: bytes, offset: int) -> bool:
+        return self.add_rows([(document_hash, offset)])
+
+    def add_rows(self, rows: list[tuple[bytes, int]]) -> bool:
+        if self.readonly:
+            return False
+        with self.lock:
+            for document_hash, offset in rows:
+                self.pending.setdefault(document_hash, offset)
+            if len(self.pending) >= self.COMMIT_AFTER_CNT:
+                self._insert_pending()
+        return True
+
+    def flush(self) -> None:
+        if self.readonly:
+            return
+        with self.lock:
+            self._insert_pending()
+
+    # -------------------------------------------------------------------------
+    def read_offset(self, document_hash: bytes) -> int | None:
+        with self.lock:
+            offset = self.pending.get(document_hash)
+            if offset is not None:
+                return offset
+            result = self.connection.execute(
+                    f"SELECT _offset FROM {self.TABLE} WHERE documentHash = ?",
+                    [document_hash]).fetchone()
+        return None if result is None else result[0]
+
+    def read_offsets(self, document_hashes: list[bytes]) -> dict[bytes, int]:
+        "joins all digests (as an Arrow table) with the index in 1 query"
+        unique_hashes = list(dict.fromkeys(document_hashes))
+        keys = pa.table([pa.array(unique_hashes, pa.binary(32))], names=["documentHash"])
+        with self.lock:
+            offsets = {document_hash: self.pending[document_hash]
+                       for document_hash in unique_hashes if document_hash in self.pending}
+            self.connection.register("keys", keys)
+            try:
+                found = self.connection.execute(
+                        f"SELECT i.documentHash, i._offset FROM {self.TABLE} i "
+                        "JOIN keys USING (documentHash)").fetchall()
+            finally:
+                self.connection.unregister("keys")
+        offsets.update(found)
+        return offsets
+
+    def delete_rows(self, document_hashes: list[bytes]) -> None:
+        if self.readonly:
+            return
+        keys = pa.table([pa.array(list(dict.fromkeys(document_hashes)), pa.binary(32))],
+                        names=["documentHash"])
+        with self.lock:
+            for document_hash in document_hashes:
+                self.pending.pop(document_hash, None)
+            self.connection.register("keys", keys)
+            try:
+                self.connection.execute(f"DELETE FROM {self.TABLE} WHERE documentHash IN "
+                                        "(SELECT documentHash FROM keys)")
+            finally:
+                self.connection.unregister("keys")
+
+    def iter_rows(self) -> Iterator[tuple[bytes, int]]:
+        self.flush()
+        with self.lock:     # a cursor of its own: lookups may run between steps
+            cursor = self.connection.cursor()
+        cursor.execute(f"SELECT documentHash, _offset FROM {self.TABLE}")
+        while True:
+            rows = cursor.fetchmany(self.ITER_CHUNK)
+            if not len(rows):
+                break
+            yield from rows
+        cursor.close()
+
+    # -------------------------------------------------------------------------
+    def export_parquet(self, parquet_filepath: str) -> int:
+        "writes the whole digest -> offset table to a Parquet file, returns the number of rows"
+        self.flush()
+        with self.lock:
+            self.connection.execute(f'COPY (SELECT documentHash, _offset AS "offset" FROM '
+                                    f"{self.TABLE}) TO '{self._quote(parquet_filepath)}' "
+                                    "(FORMAT PARQUET)")
+            return self.connection.execute(f"SELECT count(*) FROM {self.TABLE}").fetchone()[0]
+
+    def import_parquet(self, parquet_filepath: str) -> int:
+        """
+        bulk loads rows (documentHash, offset columns) from a Parquet file, rows already in the
+        index are ignored, returns the number of rows added
+        """
+        if self.readonly:
+            return 0
+        self.flush()
+        with self.lock:
+            cnt_before = self.connection.execute(f"SELECT count(*) FROM {self.TABLE}").fetchone()[0]
+            self.connection.execute(
+                    f"INSERT OR IGNORE INTO {self.TABLE} "
+                    'SELECT DISTINCT ON (documentHash) documentHash, "offset" '
+                    f"FROM read_parquet('{self._quote(parquet_filepath)}')")
+            cnt_after = self.connection.execute(f"SELECT count(*) FROM {self.TABLE}").fetchone()[0]
+        return cnt_after - cnt_before
+
+    @staticmethod
+    def _quote(filepath: str) -> str:
+        "COPY doesn't take a parameter for its file name"
+        return filepath.replace("'", "''")
+
+    # -------------------------------------------------------------------------
+    def __del__(self) -> None:
+        if self.connection is None:
+            return
+        if not self.readonly:
+            with self.lock:
+                self._insert_pending()
+        self.connection.close()
+        self.connection = None
@@ -0,0 +1,347 @@
+"""
+digest -> offset index as an open-addressing (linear probing) hash table in numpy arrays, stored
+in a file which all workers memory map read-only: a hit is a few array probes, no query & no
+syscall, and opening the index is 1 mmap.
+The database commit process is the only writer. Rows it adds are appended to the generation's log
+(hashIndex.<generation>.log), which readers scan (from where they left off) on a table miss. Once
+the log is long enough, the writer builds the next generation's table (table + log) & publishes it
+by renaming it over hashIndex.tbl, readers pick it up on their next miss
+"""
+import logging
+import mmap
+import numpy as np
+import os
+
+from collections.abc import Iterator
+from struct import Struct
+from threading import Lock
+
+from indexDatabase import IndexDatabase
+
+# magic, generation, capacity (power of 2, home slot mask + 1), slots (capacity + overflow), rows
+HEADER = Struct("<8sQQQQ")
+HEADER_NBYTES = 64
+MAGIC = b"EMBHIDX1"
+LOG_RECORD = Struct("<32sq")    # digest, offset
+OFFSET = Struct("<q")
+DIGEST_NBYTES = 32
+EMPTY_OFFSET = -1
+MIN_CAPACITY = 1024
+LOAD_ATTEMPTS = 10  # a table's log goes missing only when a newer generation replaces it
+
+
+class IndexHashTable(IndexDatabase):
+    TABLE_FILE = "hashIndex.tbl"
+    REBUILD_MIN_LOG_ROWS = 65536    # build the next generation once the log has this many rows
+    REBUILD_LOG_FRACTION = 16       # or 1/this of the table's rows, whichever is more
+
+    def __init__(self, dirpath: str, readonly: bool = True):
+        self.dirpath = dirpath
+        self.table_filepath = os.path.join(dirpath, self.TABLE_FILE)
+        self.readonly = readonly
+        self.lock = Lock()  # (re)loading the table & scanning the log
+        # the mapped generation: table arrays & the rows of its log read so far (digest ->
+        # offset), replaced as 1 attribute by _load so that lookups see a consistent pair
+        self.table = None
+        self.log_fd = None
+        self.log_pos = 0    # bytes of the log already scanned
+        if not readonly:
+            self.create_table_if_not_exists()
+        with self.lock:
+            self._load()
+        if not readonly:
+            self._remove_stale_logs()
+
+    # -------------------------------------------------------------------------
+    def _get_log_filepath(self, generation: int) -> str:
+        return os.path.join(self.dirpath, f"hashIndex.{generation}.log")
+
+    @staticmethod
+    def _get_capacity(cnt_rows: int) -> int:
+        "load factor <= 0.5 keeps probe sequences short"
+        capacity = MIN_CAPACITY
+        while capacity < 2 * cnt_rows:
+            capacity *= 2
+        return capacity
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _build(keys: np.ndarray, offsets: np.ndarray, capacity: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        lays out unique keys ((n, 4) uint64 digests) & their offsets as a linear probing table:
+        keys sorted by home slot each take the 1st free slot from home on, i.e.
+        slot[i] = max(home[i], slot[i-1] + 1), computed as a running max (no python loop).
+        Probe sequences don't wrap around, the table has overflow slots past capacity instead
+        """
+        homes = (keys[:, 0] & np.uint64(capacity - 1)).astype(np.int64)
+        order = np.argsort(homes, kind="stable")
+        ranks = np.arange(len(homes), dtype=np.int64)
+        slots = np.maximum.accumulate(homes[order] - ranks) + ranks
+        cnt_slots = max(capacity, int(slots[-1]) + 1 if len(slots) else 0)
+        table_keys = np.zeros((cnt_slots, 4), dtype=np.uint64)
+        table_offsets = np.full(cnt_slots, EMPTY_OFFSET, dtype=np.int64)
+        table_keys[slots] = keys[order]
+        table_offsets[slots] = offsets[order]
+        return table_keys, table_offsets
+
+    def _write_table(self, generation: int, keys: np.ndarray, offsets: np.ndarray) -> None:
+        "builds the table & atomically replaces the table file with it"
+        capacity = self._get_capacity(len(keys))
+        table_keys, table_offsets = self._build(keys, offsets, capacity)
+        temp_filepath = self.table_filepath + ".tmp"
+        with open(temp_filepath, "wb") as f:
+            f.write(HEADER.pack(MAGIC, generation, capacity, len(table_offsets), len(keys))
+                    .ljust(HEADER_NBYTES, b"\0"))
+            f.write(table_keys.tobytes())
+            f.write(table_offsets.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filepath, self.table_filepath)
+
+    # -------------------------------------------------------------------------
+    def _load(self) -> None:
+        "maps the current table file & opens its generation's log, call with self.lock held"
+        for _ in range(LOAD_ATTEMPTS):
+            try:
+                with open(self.table_filepath, "rb") as f:
+                    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    inode = os.fstat(f.fileno()).st_ino
+            except FileNotFoundError:
+                if not self.readonly:
+                    raise
+                return  # the writer hasn't created it yet, retried on the next miss
+            magic, generation, capacity, cnt_slots, cnt_rows = HEADER.unpack_from(buffer)
+            if magic != MAGIC:
+                raise ValueError(f'"{self.table_filepath}" is not a hash index')
+            try:
+                log_fd = os.open(self._get_log_filepath(generation),
+                                 os.O_RDONLY if self.readonly else os.O_RDWR | os.O_CREAT)
+            except FileNotFoundError:
+                continue    # a newer generation replaced this one meanwhile
+            break
+        else:
+            raise FileNotFoundError(f'log of "{self.table_filepath}" not found')
+        if self.log_fd is not None:
+            os.close(self.log_fd)
+        self.log_fd, self.log_pos = log_fd, 0
+        keys_nbytes = cnt_slots * DIGEST_NBYTES
+        # old mappings are not closed, threads still probing them finish undisturbed
+        table = {
+            "buffer": buffer, "inode": inode, "generation": generation, "mask": capacity - 1,
+            "cnt_slots": cnt_slots, "cnt_rows": cnt_rows,
+            "offsets_pos": HEADER_NBYTES + keys_nbytes,
+            "keys": np.frombuffer(buffer, dtype=np.uint64, count=cnt_slots * 4,
+                                  offset=HEADER_NBYTES).reshape(-1, 4),
+            "offsets": np.frombuffer(buffer, dtype=np.int64, count=cnt_slots,
+                                     offset=HEADER_NBYTES + keys_nbytes),
+            "log_rows": {},
+            }
+        self._scan_log(table)
+        if not self.readonly:   # drop a torn last record left by a crash
+            os.ftruncate(self.log_fd, self.log_pos)
+        self.table = table
+
+    def _scan_log(self, table: dict) -> bool:
+        "reads rows appended to the log since the last scan, returns True if there were any"
+        size = os.fstat(self.log_fd).st_size
+        size -= (size - self.log_pos) % LOG_RECORD.size     # torn (being written) last record
+        if size <= self.log_pos:
+            return False
+        data = os.pread(self.log_fd, size - self.log_pos, self.log_pos)
+        log_rows = table["log_rows"]
+        for digest, offset in LOG_RECORD.iter_unpack(data):
+            log_rows.setdefault(digest, offset)
+        self.log_pos = size
+        return True
+
+    def _remove_stale_logs(self) -> None:
+        "logs of older (already in the table) or unpublished generations, left by a crash"
+        current = os.path.basename(self._get_log_filepath(self.table["generation"]))
+        for filename in os.listdir(self.dirpath):
+            if (filename.startswith("hashIndex.") and filename.endswith(".log")
+                    and filename != current):
+                logging.warning(f'hash index: removing stale log "{filename}"')
+                os.remove(os.path.join(self.dirpath, filename))
+
+    def _refresh(self) -> bool:
+        "after a miss: picks up new log rows & a new generation, returns True if there were any"
+        with self.lock:
+            if self.table is None:
+                self._load()
+                return self.table is not None
+            found_rows = self._scan_log(self.table)
+            try:
+                replaced = os.stat(self.table_filepath).st_ino != self.table["inode"]
+            except FileNotFoundError:
+                replaced = False
+            if replaced:
+                self._load()
+            return found_rows or replaced
+
+    # -------------------------------------------------------------------------
+    def _probe(self, table: dict, document_hash: bytes) -> int | None:
+        buffer, offsets_pos = table["buffer"], table["offsets_pos"]
+        slot = int.from_bytes(document_hash[:8], "little") & table["mask"]
+        while slot < table["cnt_slots"]:
+            offset = OFFSET.unpack_from(buffer, offsets_pos + slot * OFFSET.size)[0]
+            if offset == EMPTY_OFFSET:
+                return None
+            key_pos = HEADER_NBYTES + slot * DIGEST_NBYTES
+            if buffer[key_pos:key_pos + DIGEST_NBYTES] == document_hash:
+                return offset
+            slot += 1
+        return None
+
+    def _lookup(self, document_hash: bytes) -> int | None:
+        table = self.table
+        if table is not None:
+            offset = self._probe(table, document_hash)
+            if offset is not None:
+                return offset
+            return table["log_rows"].get(document_hash)
+        return None
+
+    # -------------------------------------------------------------------------
+    def create_table_if_not_exists(self) -> None:
+        if self.readonly or os.path.exists(self.table_filepath):
+            return
+        self._write_table(0, np.empty((0, 4), dtype=np.uint64), np.empty(0, dtype=np.int64))
+
+    # -------------------------------------------------------------------------
+    def add_row(self, document_hash: bytes, offset: int) -> bool:
+        return self.add_rows([(document_hash, offset)])
+
+    def add_rows(self, rows: list[tuple[bytes, int]]) -> bool:
+        "appends the new rows to the log with 1 write (rows already indexed are ignored)"
+        if self.readonly:
+            return False
+        with self.lock:
+            new_rows = {}
+            for document_hash, offset in rows:
+                if document_hash not in new_rows and self._lookup(document_hash) is None:
+                    new_rows[document_hash] = offset
+            if not len(new_rows):
+                return True
+            os.lseek(self.log_fd, self.log_pos, os.SEEK_SET)
+            os.write(self.log_fd, b"".join(LOG_RECORD.pack(document_hash, offset)
+                                           for document_hash, offset in new_rows.items()))
+            self.log_pos += len(new_rows) * LOG_RECORD.size
+            log_rows = self.table["log_rows"]
+            log_rows.update(new_rows)
+            if len(log_rows) >= max(self.REBUILD_MIN_LOG_ROWS,
+                                    self.table["cnt_rows"] // self.REBUILD_LOG_FRACTION):
+                self._publish()
+        return True
+
+    def _publish(self, removed: set[bytes] | None = None) -> None:
+        """
+        builds & publishes the next generation (table + log) without the rows of the digests in
+        removed, call with self.lock held
+        """
+        table = self.table
+        generation = table["generation"] + 1
+        used = table["offsets"] != EMPTY_OFFSET
+        log_rows = table["log_rows"]
+        log_keys = np.frombuffer(b"".join(log_rows.keys()), dtype=np.uint64).reshape(-1, 4)
+        keys = np.concatenate([table["keys"][used], log_keys])
+        offsets = np.concatenate([table["offsets"][used],
+                                  np.fromiter(log_rows.values(), dtype=np.int64,
+                                              count=len(log_rows))])
+        if removed:
+            # vectorized: candidates by the digests' 1st 8 bytes, then only they are compared
+            # as whole digests (isin is much faster on uint64 than on 32-byte scalars)
+            removed_keys = np.frombuffer(b"".join(removed), dtype=np.uint64).reshape(-1, 4)
+            candidates = np.flatnonzero(np.isin(keys[:, 0], removed_keys[:, 0]))
+            kept = np.ones(len(keys), dtype=bool)
+            kept[candidates] = ~np.isin(
+                    np.ascontiguousarray(keys[candidates]).view("V32").ravel(),
+                    np.ascontiguousarray(removed_keys).view("V32").ravel())
+            keys, offsets = keys[kept], offsets[kept]
+        logging.info(f"hash index: publishing generation {generation}, {len(offsets)} rows")
+        old_log_filepath = self._get_log_filepath(table["generation"])
+        os.fsync(self.log_fd)
+        # the new generation's log must exist before readers can see its table
+        with open(self._get_log_filepath(generation), "wb"):
+            pass
+        self._write_table(generation, keys, offsets)
+        self._load()
+        os.remove(old_log_filepath)     # readers which still have it open can finish reading it
+
+    # -------------------------------------------------------------------------
+    def flush(self) -> None:
+        if not self.readonly and self.log_fd is not None:
+            os.fsync(self.log_fd)
+
+    # -------------------------------------------------------------------------
+    def read_offset(self, document_hash: bytes) -> int | None:
+        offset = self._lookup(document_hash)
+        if offset is None and self._refresh():
+            offset = self._lookup(document_hash)
+        return offset
+
+    # -------------------------------------------------------------------------
+    def read_offsets(self, document_hashes: list[bytes]) -> dict[bytes, int]:
+        "probes for all digests at once, 1 vectorized step per probe distance"
+        unique_hashes = list(dict.fromkeys(document_hashes))
+        offsets = self._probe_many(unique_hashes)
+        misses = [document_hash for document_hash in unique_hashes
+                  if document_hash not in offsets]
+        if len(misses) and self._refresh():
+            offsets.update(self._probe_many(misses))
+        return offsets
+
+    def _probe_many(self, document_hashes: list[bytes]) -> dict[bytes, int]:
+        table = self.table
+        found = np.full(len(document_hashes), EMPTY_OFFSET, dtype=np.int64)
+        if table is not None and len(document_hashes):
+            queries = np.frombuffer(b"".join(document_hashes), dtype=np.uint64).reshape(-1, 4)
+            slots = (queries[:, 0] & np.uint64(table["mask"])).astype(np.int64)
+            active = np.arange(len(document_hashes))
+            while len(active):
+                active = active[slots[active] < table["cnt_slots"]]
+                probed = slots[active]
+                probed_offsets = table["offsets"][probed]
+                matched = ((table["keys"][probed] == queries[active]).all(axis=1)
+                           & (probed_offsets != EMPTY_OFFSET))
+                found[active[matched]] = probed_offsets[matched]
+                active = active[~matched & (probed_offsets != EMPTY_OFFSET)]
+                slots[active] += 1
+        offsets = {}
+        for document_hash, offset in zip(document_hashes, found.tolist()):
+            if offset == EMPTY_OFFSET:
+                offset = None if table is None else table["log_rows"].get(document_hash)
+            if offset is not None and offset != EMPTY_OFFSET:
+                offsets[document_hash] = offset
+        return offsets
+
+    # -------------------------------------------------------------------------
+    def delete_rows(self, document_hashes: list[bytes]) -> None:
+        "rows can't be removed from the table in place, publishes a generation without them"
+        if self.readonly or not len(document_hashes):
+            return
+        with self.lock:
+            self._publish(set(document_hashes))
+
+    # -------------------------------------------------------------------------
+    def iter_rows(self) -> Iterator[tuple[bytes, int]]:
+        "the table's rows, then the rows of its log"
+        self._refresh()
+        table = self.table
+        if table is None:
+            return
+        used = np.flatnonzero(table["offsets"] != EMPTY_OFFSET)
+        for start in range(0, len(used), MIN_CAPACITY):
+            slots = used[start:start + MIN_CAPACITY]
+            keys = table["keys"][slots].tobytes()
+            for i, offset in enumerate(table["offsets"][slots].tolist()):
+                yield keys[i * DIGEST_NBYTES:(i + 1) * DIGEST_NBYTES], offset
+        yield from list(table["log_rows"].items())
+
+    # -------------------------------------------------------------------------
+    def __del__(self) -> None:
+        if self.log_fd is not None:
+            if not self.readonly:
+                os.fsync(self.log_fd)
+            os.close(self.log_fd)
+            self.log_fd = None
@@ -1,6 +1,7 @@
 import logging
 import plyvel   # "New BSD License" https://github.com/wbolster/plyvel/blob/main/LICENSE.rst
 
+from collections.abc import Iterator
 from os import path
 from sys import stderr
 from time import sleep
@@ -14,6 +15,10 @@ class IndexLevelDB(IndexDatabase):
     "per docs: multiple instances can be used concurrently in threads, but not across processes"
     INDEX_DB_DIRNAME = "indexDatabase"
     COMMIT_AFTER_CNT = 10   # arbitrary value, tune for speed & min data loss @ shutdown
+    # keys are raw 32 byte sha256 digests in stores which have this key (can't clash with them),
+    # else 64 char hex digests (created before binary digests, see migrateIndex.py)
+    FORMAT_KEY = b"\x00indexFormat"
+    FORMAT_BINARY_DIGESTS = b"2"
 
     def __init__(self, data_dirpath: str = "", connection: plyvel._plyvel.DB = None):
         if connection is None:
@@ -27,6 +32,23 @@ class IndexLevelDB(IndexDatabase):
         print(f"***************** {self.connection}", file=stderr)
         self.write_batch = None
         self.cnt_put = 0
+        self.legacy = self._detect_legacy()
+
+    # -------------------------------------------------------------------------
+    def _detect_legacy(self) -> bool:
+        if self.connection.get(self.FORMAT_KEY) == self.FORMAT_BINARY_DIGESTS:
+            return False
+        with self.connection.iterator(include_value=False) as it:
+            is_empty = next(it, None) is None
+        if is_empty:    # new store
+            self.connection.put(self.FORMAT_KEY, self.FORMAT_BINARY_DIGESTS)
+            return False
+        logging.warning(f'"{self.db_path}" has a hex digest index, run migrateIndex.py to '
+                        "convert it to the smaller & faster binary digest index")
+        return True
+
+    def _key(self, document_hash: bytes) -> bytes:
+        return document_hash.hex().encode() if self.legacy else document_hash
 
     # -------------------------------------------------------------------------
     def _int_to_bytes(self, c: int) -> bytes:
@@ -36,21 +58,55 @@ class IndexLevelDB(IndexDatabase):
         # LevelDB is already a key-value store
         return None
 
-    def add_row(self, document_hash: str, offset: int) -> None:
-        logging.info(f'add_row: recvd doc_hash "{document_hash}" | offset {offset}')
+    def add_row(self, document_hash: bytes, offset: int) -> None:
+        logging.info(f'add_row: recvd doc_hash "{document_hash.hex()}" | offset {offset}')
         if self.write_batch is None:
             self.write_batch = self.connection.write_batch()
-        self.write_batch.put(document_hash.encode(), self._int_to_bytes(offset))
+        self.write_batch.put(self._key(document_hash), self._int_to_bytes(offset))
         self.cnt_put += 1
         if self.cnt_put >= self.COMMIT_AFTER_CNT:
             self.write_batch.write()
             self.cnt_put = 0
             self.write_batch = None
 
-    def read_offset(self, document_hash: str) -> int | None:
-        offset = self.connection.get(document_hash.encode())
+    def add_rows(self, rows: list[tuple[bytes, int]]) -> bool:
+        logging.info(f"add_rows: recvd {len(rows)} rows")
+        if self.write_batch is None:
+            self.write_batch = self.connection.write_batch()
+        for document_hash, offset in rows:
+            self.write_batch.put(self._key(document_hash), self._int_to_bytes(offset))
+        self.cnt_put += len(rows)
+        if self.cnt_put >= self.COMMIT_AFTER_CNT:
+            self.write_batch.write()
+            self.cnt_put = 0
+            self.write_batch = None
+        return True
+
+    def flush(self) -> None:
+        if self.write_batch is None:
+            return
+        self.write_batch.write()
+        self.cnt_put = 0
+        self.write_batch = None
+
+    def read_offset(self, document_hash: bytes) -> int | None:
+        offset = self.connection.get(self._key(document_hash))
         return None if offset is None else int.from_bytes(offset)
 
+    def delete_rows(self, document_hashes: list[bytes]) -> None:
+        self.flush()
+        with self.connection.write_batch() as write_batch:
+            for document_hash in document_hashes:
+                write_batch.delete(self._key(document_hash))
+
+    def iter_rows(self) -> Iterator[tuple[bytes, int]]:
+        self.flush()
+        with self.connection.snapshot().iterator() as it:
+            for key, offset in it:
+                if key == self.FORMAT_KEY:
+                    continue
+                yield (bytes.fromhex(key.decode()) if self.legacy else key), int.from_bytes(offset)
+
     # -------------------------------------------------------------------------
     def __del__(self) -> None:
         if self.connection is None or self.db_path is None: # this instance didn't open connection
@@ -1,63 +1,139 @@
 import logging
 import sqlite3
+from collections.abc import Iterator
+from contextlib import AbstractContextManager, nullcontext
 from os import path
+from threading import Lock, local
 
 from indexDatabase import IndexDatabase
 
 
 class IndexSQLite(IndexDatabase):
     INDEX_DB_FILE = "indexDatabase.db"
+    TABLE = "OffsetIndexV2"     # documentHash: raw 32 byte sha256 digest (BLOB)
+    LEGACY_TABLE = "OffsetIndex"    # documentHash: 64 char hex digest (TEXT), see migrateIndex.py
     COMMIT_AFTER_CNT = 10   # arbitrary value, tune for speed & min data loss @ shutdown
+    READ_MANY_CHUNK = 500   # max host params per "IN" query (older sqlite limit is 999)
+    ITER_CHUNK = 100000     # rows fetched per step by iter_rows
 
     def __init__(self, dirpath: str, readonly: bool = True):
         self.db_filepath = path.join(dirpath, self.INDEX_DB_FILE)
         self.trans_cnt = 0
         self.readonly = readonly
 
-        uri = f"file:{self.db_filepath}" + ("?mode=ro" if readonly else "")
+        self.connection = None
+        self.connection = self._connect()
+        self.cursor = self.connection.cursor()
+        # the read-write connection & its cursor are shared by the DCP's threads (a cursor can't
+        # be used by 2 threads @ once)
+        self.lock = Lock()
+        # readers may be called from several threads (e.g. an executor), each gets its own
+        # connection so that lookups don't share a cursor & can run in parallel
+        self.thread_local = local()
+        self.thread_connections = []
+        # an index created before binary digests is used as is (keys converted to hex on the
+        # way in & out) until it's migrated
+        self.legacy = self._has_only_legacy_table()
+        self.table = self.LEGACY_TABLE if self.legacy else self.TABLE
+        if self.legacy:
+            logging.warning(f'"{self.db_filepath}" has a hex digest index, run migrateIndex.py '
+                            "to convert it to the smaller & faster binary digest index")
+        if not readonly:
+            self.create_table_if_not_exists()
+
+    # -------------------------------------------------------------------------
+    def _connect(self) -> sqlite3.Connection:
+        uri = f"file:{self.db_filepath}" + ("?mode=ro" if self.readonly else "")
         try:
-            self.connection = sqlite3.connect(uri,
+            return sqlite3.connect(uri,
                     check_same_thread=False, uri=True, isolation_level="DEFERRED")
         except sqlite3.OperationalError as e:
             logging.error(f'failed to connect to database: "{str(e)}"')
-            self.connection = None
             raise ConnectionError
 
-        self.cursor = self.connection.cursor()
-        if not readonly:
-            self.create_table_if_not_exists()
+    def _get_read_cursor(self) -> sqlite3.Cursor:
+        if not self.readonly:
+            return self.cursor
+        cursor = getattr(self.thread_local, "cursor", None)
+        if cursor is None:
+            connection = self._connect()
+            self.thread_connections.append(connection)
+            cursor = self.thread_local.cursor = connection.cursor()
+        return cursor
+
+    def _reading(self) -> AbstractContextManager:
+        "held around the use of _get_read_cursor's cursor, only the read-write one is shared"
+        return nullcontext() if self.readonly else self.lock
+
+    def _has_only_legacy_table(self) -> bool:
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = {row[0] for row in self.cursor.fetchall()}
+        return self.LEGACY_TABLE in tables and self.TABLE not in tables
+
+    def _key(self, document_hash: bytes) -> bytes | str:
+        return document_hash.hex() if self.legacy else document_hash
 
     # -------------------------------------------------------------------------
     def create_table_if_not_exists(self) -> bool:
-        if self.readonly:
+        if self.readonly or self.legacy:
             return False
-        query = 'CREATE TABLE IF NOT EXISTS OffsetIndex (documentHash TEXT PRIMARY KEY, offset INTEGER)'
+        # WITHOUT ROWID: the rows are stored in the primary key's B-tree, no 2nd (rowid) B-tree
+        query = (f"CREATE TABLE IF NOT EXISTS {self.TABLE} "
+                 "(documentHash BLOB PRIMARY KEY, offset INTEGER) WITHOUT ROWID")
         self.cursor.execute(query)
         self.connection.commit()
 
     # -------------------------------------------------------------------------
-    def add_row(self, document_hash: str, offset: int) -> bool:
+    def add_row(self, document_hash: bytes, offset: int) -> bool:
         # TODO: add try/except block to db calls that may fail
         if self.readonly:
             return False
         #if document_hash not in self.temp_index:
         #    self.temp_index[document_hash] = offset
-        query = 'INSERT OR IGNORE INTO OffsetIndex (documentHash, offset) VALUES (?, ?)'
-        values = (document_hash, offset)
+        query = f"INSERT OR IGNORE INTO {self.table} (documentHash, offset) VALUES (?, ?)"
+        values = (self._key(document_hash), offset)
         logging.debug(f"add_row: values = {str(values)}")
-        self.cursor.execute(query, values)
+        with self.lock:
+            self.cursor.execute(query, values)
 
-        self.trans_cnt += 1
-        if self.trans_cnt >= self.COMMIT_AFTER_CNT:
-            self.connection.commit()    # per docs "BEGIN DEFERRED" after commit() is implied
-            self.trans_cnt = 0
+            self.trans_cnt += 1
+            if self.trans_cnt >= self.COMMIT_AFTER_CNT:
+                self.connection.commit()    # per docs "BEGIN DEFERRED" after commit() is implied
+                self.trans_cnt = 0
         return True
 
     # -------------------------------------------------------------------------
-    def read_offset(self, document_hash: str) -> int | None:
-        query = 'SELECT offset FROM OffsetIndex WHERE documentHash = ?'
-        self.cursor.execute(query, (document_hash,))
-        result = self.cursor.fetchone()
+    def add_rows(self, rows: list[tuple[bytes, int]]) -> bool:
+        if self.readonly:
+            return False
+        query = f"INSERT OR IGNORE INTO {self.table} (documentHash, offset) VALUES (?, ?)"
+        logging.debug(f"add_rows: {len(rows)} rows")
+        if self.legacy:
+            rows = [(document_hash.hex(), offset) for document_hash, offset in rows]
+        with self.lock:
+            self.cursor.executemany(query, rows)
+
+            self.trans_cnt += len(rows)
+            if self.trans_cnt >= self.COMMIT_AFTER_CNT:
+                self.connection.commit()
+                self.trans_cnt = 0
+        return True
+
+    # -------------------------------------------------------------------------
+    def flush(self) -> None:
+        if self.readonly or not self.trans_cnt:
+            return
+        with self.lock:
+            self.connection.commit()
+            self.trans_cnt = 0
+
+    # -------------------------------------------------------------------------
+    def read_offset(self, document_hash: bytes) -> int | None:
+        query = f"SELECT offset FROM {self.table} WHERE documentHash = ?"
+        with self._reading():
+            cursor = self._get_read_cursor()
+            cursor.execute(query, (self._key(document_hash),))
+            result = cursor.fetchone()
         if result:
             return result[0]
         return None
@@ -65,6 +141,53 @@ class IndexSQLite(IndexDatabase):
         #    return self.temp_index[document_hash]
         #return None
 
+    # -------------------------------------------------------------------------
+    def read_offsets(self, document_hashes: list[bytes]) -> dict[bytes, int]:
+        offsets = {}
+        unique_keys = [self._key(document_hash) for document_hash in dict.fromkeys(document_hashes)]
+        with self._reading():
+            cursor = self._get_read_cursor()
+            for i in range(0, len(unique_keys), self.READ_MANY_CHUNK):
+                chunk = unique_keys[i:i + self.READ_MANY_CHUNK]
+                query = (f"SELECT documentHash, offset FROM {self.table} WHERE documentHash IN "
+                         f'({",".join("?" * len(chunk))})')
+                cursor.execute(query, chunk)
+                if self.legacy:
+                    offsets.update((bytes.fromhex(key), offset)
+                                   for key, offset in cursor.fetchall())
+                else:
+                    offsets.update(cursor.fetchall())
+        return offsets
+
+    # -------------------------------------------------------------------------
+    def delete_rows(self, document_hashes: list[bytes]) -> None:
+        if self.readonly:
+            return
+        with self.lock:
+            self.cursor.executemany(f"DELETE FROM {self.table} WHERE documentHash = ?",
+                                    [(self._key(document_hash),)
+                                     for document_hash in document_hashes])
+            self.connection.commit()
+            self.trans_cnt = 0
+
+    # -------------------------------------------------------------------------
+    def iter_rows(self) -> Iterator[tuple[bytes, int]]:
+        """
+        all rows, ITER_CHUNK per query in key order: each query runs to completion under the
+        lock (the read-write connection is shared by the DCP's threads, which commit meanwhile)
+        """
+        query = f"SELECT documentHash, offset FROM {self.table}"
+        with self._reading():
+            rows = self.connection.execute(f"{query} ORDER BY documentHash LIMIT ?",
+                                           (self.ITER_CHUNK,)).fetchall()
+        while len(rows):
+            for key, offset in rows:
+                yield (bytes.fromhex(key) if self.legacy else key), offset
+            with self._reading():
+                rows = self.connection.execute(
+                        f"{query} WHERE documentHash > ? ORDER BY documentHash LIMIT ?",
+                        (rows[-1][0], self.ITER_CHUNK)).fetchall()
+
     # -------------------------------------------------------------------------
     def __del__(self) -> None:
         if self.connection is None:
@@ -73,6 +196,8 @@ class IndexSQLite(IndexDatabase):
             self.connection.commit()
         self.cursor.close()
         self.connection.close()
+        for connection in self.thread_connections:
+            connection.close()
 
     # -------------------------------------------------------------------------
 
@@ -0,0 +1,104 @@
+"""
+Prometheus metrics (opt-in, see server.py --metrics) of the workers & the database commit process,
+exported by '/metrics'. They're aggregated across processes with prometheus_client's multiprocess
+mode: each process writes its samples to memory mapped files in 1 directory, which '/metrics'
+merges. Until enable() is called the functions below do nothing & prometheus_client isn't
+imported, so instrumented code only pays a function call
+"""
+import os
+
+from tempfile import gettempdir
+from time import perf_counter
+
+DIRPATH = os.path.join(gettempdir(), "embeddingServiceMetrics")
+# latencies from hashing a document (µs) to encoding a large batch (secs)
+SECS_BUCKETS = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+_metrics = None     # name -> metric, once enabled
+
+
+def enable(dirpath: str = DIRPATH, clear: bool = False) -> None:
+    """
+    run by every process before its 1st sample (processes forked after it inherit it), the
+    samples go to dirpath. clear: removes the samples of a previous run, by the 1st process only
+    (the files of the others' samples are open)
+    """
+    global _metrics
+    if _metrics is not None:
+        return
+    os.makedirs(dirpath, exist_ok=True)
+    if clear:
+        for filename in os.listdir(dirpath):
+            if filename.endswith(".db"):
+                os.remove(os.path.join(dirpath, filename))
+    # read when prometheus_client is imported
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = dirpath
+    from prometheus_client import Counter, Gauge, Histogram
+    _metrics = {
+        "lookups": Counter("embeddings_cache_lookups", "documents looked-up in the cache",
+                           ["model", "result"]),
+        "stage": Histogram("embeddings_stage_seconds", "latency of each stage of a request:"
+                           " hash, lookup (hot cache & index), read (cache file), encode, write"
+                           " (cache file & index msgs) & commit (index insert, in the database"
+                           " commit process)", ["model", "stage"], buckets=SECS_BUCKETS),
+        "batch": Histogram("embeddings_batch_size", "documents per encode call & rows per index"
+                           " insert", ["model", "kind"], buckets=BATCH_BUCKETS),
+        "backlog": Gauge("embeddings_write_backlog_rows", "computed rows queued for the cache"
+                         " file & index", ["model"], multiprocess_mode="livesum"),
+        "dropped": Counter("embeddings_dropped_writes", "computed rows which weren't cached",
+                           ["model", "reason"]),
+        "lock_wait": Histogram("embeddings_lock_wait_seconds", "wait for a cache file's lock",
+                               ["lock"], buckets=SECS_BUCKETS),
+        "ring": Gauge("embeddings_ring_occupancy_records", "records waiting in a worker's"
+                      " requests ring when the database commit process pops it", ["worker"],
+                      multiprocess_mode="livesum"),
+        "ring_full": Counter("embeddings_ring_full_seconds", "time spent blocked on a full ring"
+                             " (backpressure)"),
+    }
+
+def generate() -> tuple[bytes, str]:
+    "the samples of all processes in the text exposition format & its content type"
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest
+    from prometheus_client.multiprocess import MultiProcessCollector
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+# -----------------------------------------------------------------------------
+def observe_stage(model_name: str, stage: str, started: float) -> None:
+    "started: the stage's perf_counter() @ its start"
+    if _metrics is not None:
+        _metrics["stage"].labels(model_name, stage).observe(perf_counter() - started)
+
+def count_lookups(model_name: str, hits: int, misses: int) -> None:
+    if _metrics is not None:
+        _metrics["lookups"].labels(model_name, "hit").inc(hits)
+        _metrics["lookups"].labels(model_name, "miss").inc(misses)
+
+def observe_batch(model_name: str, kind: str, size: int) -> None:
+    "kind: encode or index"
+    if _metrics is not None:
+        _metrics["batch"].labels(model_name, kind).observe(size)
+
+def add_write_backlog(model_name: str, cnt: int) -> None:
+    "cnt > 0: rows queued, < 0: rows written (or dropped)"
+    if _metrics is not None:
+        _metrics["backlog"].labels(model_name).inc(cnt)
+
+def count_dropped_writes(model_name: str, reason: str, cnt: int) -> None:
+    if _metrics is not None:
+        _metrics["dropped"].labels(model_name, reason).inc(cnt)
+
+def observe_lock_wait(lock_path: str, started: float) -> None:
+    if _metrics is not None:
+        _metrics["lock_wait"].labels(os.path.basename(lock_path)).observe(perf_counter() - started)
+
+def set_ring_occupancy(worker_pid: int, cnt: int) -> None:
+    if _metrics is not None:
+        _metrics["ring"].labels(str(worker_pid)).set(cnt)
+
+def add_ring_full(secs: float) -> None:
+    if _metrics is not None:
+        _metrics["ring_full"].inc(secs)
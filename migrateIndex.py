@@ -0,0 +1,144 @@
+"""
+converts indexes created before binary digests (documentHash stored as a 64 char hex string) to
+the binary digest format (raw 32 byte sha256 digests), which halves the keys & makes the index
+B-tree smaller, so that more of it fits in the page cache. The server can use unconverted indexes
+as is, but slower. Stop the server before running this, the cache files (.bin) are unchanged.
+Already converted indexes are skipped, an interrupted conversion can be re-run
+"""
+import argparse
+import logging
+import os
+import sqlite3
+
+from sys import stderr
+
+from indexSQLite import IndexSQLite
+
+MIGRATE_CHUNK = 100000  # rows read, converted & inserted per pass
+
+
+def get_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, _, filenames in os.walk(path) for filename in filenames)
+
+# -----------------------------------------------------------------------------
+def migrate_sqlite(model_dirpath: str, keep_legacy: bool = False) -> int:
+    "returns the number of rows converted"
+    db_filepath = os.path.join(model_dirpath, IndexSQLite.INDEX_DB_FILE)
+    # no implicit transactions: sqlite3 would commit the CREATE TABLE right away
+    connection = sqlite3.connect(db_filepath, isolation_level=None)
+    tables = {row[0] for row in
+              connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    # an empty binary digest table next to the hex one was left by an interrupted run of an
+    # older version of this script, which committed its CREATE TABLE 1st
+    unfinished = (IndexSQLite.LEGACY_TABLE in tables and IndexSQLite.TABLE in tables and
+                  connection.execute(f"SELECT 1 FROM {IndexSQLite.TABLE} LIMIT 1").fetchone()
+                  is None)
+    if IndexSQLite.LEGACY_TABLE not in tables or (IndexSQLite.TABLE in tables and
+                                                  not unfinished):
+        logging.info(f'"{db_filepath}": no hex digest index to convert, skipping')
+        connection.close()
+        return 0
+
+    connection.execute("BEGIN")
+    if unfinished:
+        logging.info(f'"{db_filepath}": restarting an interrupted conversion')
+        connection.execute(f"DROP TABLE {IndexSQLite.TABLE}")
+    connection.execute(f"CREATE TABLE {IndexSQLite.TABLE} "
+                       "(documentHash BLOB PRIMARY KEY, offset INTEGER) WITHOUT ROWID")
+    read_cursor = connection.cursor()
+    read_cursor.execute(f"SELECT documentHash, offset FROM {IndexSQLite.LEGACY_TABLE}")
+    cnt, cnt_bad = 0, 0
+    while True:
+        rows = read_cursor.fetchmany(MIGRATE_CHUNK)
+        if not len(rows):
+            break
+        converted = []
+        for document_hash, offset in rows:
+            try:
+                converted.append((bytes.fromhex(document_hash), offset))
+            except (TypeError, ValueError):
+                cnt_bad += 1
+        connection.executemany(f"INSERT OR IGNORE INTO {IndexSQLite.TABLE} "
+                               "(documentHash, offset) VALUES (?, ?)", converted)
+        cnt += len(converted)
+        logging.info(f'"{db_filepath}": {cnt} rows converted...')
+    if not keep_legacy:
+        connection.execute(f"DROP TABLE {IndexSQLite.LEGACY_TABLE}")
+    connection.execute("COMMIT")    # 1 transaction: the new table is complete or doesn't exist
+    if cnt_bad:
+        logging.warning(f'"{db_filepath}": skipped {cnt_bad} rows which had no hex digest')
+    if not keep_legacy:
+        connection.execute("VACUUM")    # returns the old table's pages to the filesystem
+    connection.close()
+    return cnt
+
+# -----------------------------------------------------------------------------
+def migrate_leveldb(model_dirpath: str) -> int:
+    "returns the number of rows converted"
+    import plyvel
+    from indexLevelDB import IndexLevelDB
+
+    db_path = os.path.join(model_dirpath, IndexLevelDB.INDEX_DB_DIRNAME)
+    connection = plyvel.DB(db_path)
+    if connection.get(IndexLevelDB.FORMAT_KEY) == IndexLevelDB.FORMAT_BINARY_DIGESTS:
+        logging.info(f'"{db_path}": no hex digest index to convert, skipping')
+        connection.close()
+        return 0
+
+    cnt = 0
+    write_batch = connection.write_batch()
+    # snapshot: the iterator doesn't see the converted keys being written
+    for key, offset in connection.snapshot().iterator():
+        if len(key) != 64:  # already converted by an interrupted run
+            continue
+        try:
+            write_batch.put(bytes.fromhex(key.decode()), offset)
+        except ValueError:
+            logging.warning(f'"{db_path}": skipping key which is no hex digest: {key}')
+            continue
+        write_batch.delete(key)
+        cnt += 1
+        if not cnt % MIGRATE_CHUNK:
+            write_batch.write()
+            write_batch = connection.write_batch()
+            logging.info(f'"{db_path}": {cnt} rows converted...')
+    write_batch.write()
+    connection.put(IndexLevelDB.FORMAT_KEY, IndexLevelDB.FORMAT_BINARY_DIGESTS)
+    connection.compact_range()  # drops the deleted hex keys from the files
+    connection.close()
+    return cnt
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model_dirs",
+            nargs="+",
+            help="1 or more model data directories, e.g. 'data/sentence-transformers_...'")
+    parser.add_argument("--keep-legacy",
+            action="store_true",
+            help="optional: sqlite only, keep the hex digest table (it's dropped by default)")
+    parser.add_argument("-t", "--db-type",
+            choices=["leveldb", "sqlite"],
+            help="optional: database type of the indexes, default: 'sqlite'",
+            default="sqlite")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO, stream=stderr)
+
+    for model_dirpath in args.model_dirs:
+        if args.db_type == "sqlite":
+            index_path = os.path.join(model_dirpath, IndexSQLite.INDEX_DB_FILE)
+        else:
+            index_path = os.path.join(model_dirpath, "indexDatabase")
+        if not os.path.exists(index_path):
+            logging.error(f'"{index_path}" not found, skipping')
+            continue
+        size_before = get_size(index_path)
+        if args.db_type == "sqlite":
+            cnt = migrate_sqlite(model_dirpath, args.keep_legacy)
+        else:
+            cnt = migrate_leveldb(model_dirpath)
+        logging.info(f'"{index_path}": {cnt} rows converted, size {size_before} -> '
+                     f"{get_size(index_path)} bytes")
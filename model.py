@@ -3,37 +3,156 @@ represents a neural model used for computing word embeddings
 """
 import logging
 
-from multiprocessing.shared_memory import ShareableList
-from numpy import ndarray
-from os import getpid, linesep
-from pickle import loads
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from hashlib import sha256
+from itertools import count
+from numpy import float32, ndarray, stack, zeros
+from numpy.linalg import norm
+from numpy.random import default_rng
+from os import getpid
 #from sentence_transformers import SentenceTransformer  # loaded in __init__ below
 from signal import signal, SIGINT, SIGTERM
 from sys import exit
-from time import sleep
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
 
 import databaseCommitProcess as dcp
+from hotVectorCache import HotVectorCache
+from indexHashTable import IndexHashTable
 from indexLevelDB import IndexLevelDB
 from indexSQLite import IndexSQLite
+from shmRingBuffer import ShmChannel
+from tokenCache import join_tokens
 
 INIT_SHM_TIMEOUT = 10   # secs
 READ_SHM_TIMEOUT = 5
-READ_SHM_POLL_INTERVAL1 = 0.001
-READ_SHM_POLL_INTERVAL2 = 0.005
+REPLY_LISTENER_WAKE_SECS = 1    # the reply listener re-checks whether it should stop this often
+ENCODE_BATCH_SIZE = 64  # sentences per forward pass when a batch of documents is encoded
+TOUCH_BATCH_CNT = 256   # cache hits buffered per model before they're sent to the DCP
+TOUCH_BATCH_SECS = 5    # or once the oldest buffered hit is this old
+
+_process_models = {}    # SentenceTransformers loaded by encode_in_process, keyed on model name
+_link = None    # this worker's CommitProcessLink, shared by all its models
+_link_lock = Lock()
+
+
+class CommitProcessLink:
+    """
+    a worker's channel to the database commit process (DCP), shared by all the worker's models
+    (their msgs carry the model id): the channel's rings have 1 producer & 1 consumer each
+    """
+    def __init__(self):
+        self.channel = None
+        self.send_lock = Lock()     # the requests ring has 1 producer: 1 thread @ a time
+        self.seqs = count(1)    # numbers requests expecting a reply, to match the reply
+        self.replies_waiting = {}   # seq -> Future of the reply's offset
+        self.replies_lock = Lock()
+        self.stopping = Event()
+        self._init_db_shm()
+
+    def _init_db_shm(self) -> None:
+        "attaches to the channel created by the DCP for this worker, starts listening for replies"
+        deadline = monotonic() + INIT_SHM_TIMEOUT
+        while True:
+            try:
+                self.channel = ShmChannel(dcp.DatabaseCommitProcess.get_shm_name(getpid()))
+                break
+            except FileNotFoundError:
+                if monotonic() > deadline:
+                    raise TimeoutError
+                sleep(0.1)
+        Thread(target=self._listen_replies, daemon=True).start()
+
+    def _listen_replies(self) -> None:
+        "hands replies from the DCP to the threads waiting on them, sleeps until 1 is rung"
+        channel = self.channel
+        try:
+            while not self.stopping.is_set():
+                if not channel.reply_bell.wait(REPLY_LISTENER_WAKE_SECS):
+                    continue
+                for _, offset, seq, _, _ in channel.replies.pop_all():
+                    with self.replies_lock:
+                        future = self.replies_waiting.pop(seq, None)
+                    if future is not None:  # None: its requester timed-out & left
+                        future.set_result(offset)
+        except (OSError, TypeError, ValueError):
+            if not self.stopping.is_set():  # else: the channel was closed under us by close
+                raise
+
+    # --------------------------------------------------------------------------
+    def send_records(self, records: list[tuple]) -> None:
+        "blocks while the requests ring is full (backpressure), writes are never dropped"
+        with self.send_lock:
+            self.channel.send_requests(records)
+
+    def request(self, kind: int, document_hash: bytes, model_id: int, offset: int = 0
+    ) -> int | None:
+        "sends 1 msg expecting a reply, returns the reply's offset field or None on error"
+        return self.request_many(kind, [document_hash], model_id, offset)[0]
+
+    def request_many(self, kind: int, document_hashes: list[bytes], model_id: int,
+                     offset: int = 0) -> list[int | None]:
+        "request for several digests in 1 push, returns their replies' offset fields in order"
+        seqs = [next(self.seqs) & 0xFFFFFFFF for _ in document_hashes]
+        futures = [Future() for _ in document_hashes]
+        with self.replies_lock:
+            self.replies_waiting.update(zip(seqs, futures))
+        self.send_records([(document_hash, offset, seq, kind, model_id)
+                           for document_hash, seq in zip(document_hashes, seqs)])
+        deadline = monotonic() + READ_SHM_TIMEOUT
+        vals = []
+        for document_hash, seq, future in zip(document_hashes, seqs, futures):
+            try:
+                vals.append(future.result(timeout=max(deadline - monotonic(), 0)))
+                continue
+            except FutureTimeoutError:
+                logging.error(f"request: no reply after {READ_SHM_TIMEOUT}s, kind={kind}, "
+                              f"hash:'{document_hash.hex()}'")
+            with self.replies_lock:
+                self.replies_waiting.pop(seq, None)
+            vals.append(None)
+        return vals
+
+    # --------------------------------------------------------------------------
+    def close(self) -> None:
+        self.stopping.set()
+        if self.channel is not None:
+            self.channel.close()    # the DCP, which created it, unlinks it
+            logging.info(f"worker {getpid()} closed shm successfully.")
+            self.channel = None
+
+
+# ------------------------------------------------------------------------------
+def get_commit_process_link() -> CommitProcessLink:
+    global _link
+    with _link_lock:
+        if _link is None:
+            _link = CommitProcessLink()
+        return _link
 
 
 class Model:
     def __init__(self, name: str, embedding_dimension: int, data_dirpath: str,
-                 db_type: str, load_transformers: bool = True):
+                 db_type: str, load_transformers: bool = True, hot_cache_bytes: int = 0,
+                 model_id: int = 0, track_access: bool = False, stub_encode_ms: float = 0):
         self.name = name
+        self.model_id = model_id    # its position in models.txt, routes msgs to its index in the DCP
         self.embedding_dimension = embedding_dimension  # how many floats the embeddings has
         self.data_dirpath = data_dirpath
         self.db_type = db_type
+        self.hot_cache = HotVectorCache(hot_cache_bytes)  # recently used embeddings in RAM
         if db_type == "sqlite":
             self.database_ro = IndexSQLite(data_dirpath, readonly = True)
+        elif db_type == "hashtable":
+            self.database_ro = IndexHashTable(data_dirpath, readonly = True)
         else:
             self.database_ro = None
-        self._init_db_shm()
+        self.link = get_commit_process_link()
+        # cache hits are reported to the DCP's access stats (for eviction) in batches
+        self.track_access = track_access
+        self.touched = []
+        self.touched_since = 0.0
+        self.touched_lock = Lock()
         signal(SIGINT, self.clean_up)
         signal(SIGTERM, self.clean_up)
 
@@ -43,93 +162,154 @@ class Model:
         else:
             self.model = None
         self.load_transformers = load_transformers
-
-    # --------------------------------------------------------------------------
-    def _init_db_shm(self) -> None:
-        elapsed = 0
-        sleep_interval = 0.1
-        while elapsed < INIT_SHM_TIMEOUT:
-            try:
-                temp_shm = ShareableList(name = dcp.DatabaseCommitProcess.get_shm_name(getpid()))
-            except FileNotFoundError:
-                elapsed += sleep_interval
-                sleep(sleep_interval)
-            else:
-                while elapsed < INIT_SHM_TIMEOUT:
-                    if len(temp_shm):
-                        self.db_shm = loads(temp_shm[0])
-                        temp_shm.shm.close()
-                        for i in range(dcp.DatabaseCommitProcess.WORKER_SHM_SIZE):
-                            self.db_shm[i] = ""   # signal to DCP that SHM location was rcvd
-                        return
-                    sleep(sleep_interval)
-        raise TimeoutError
+        # without transformers (a stub model, e.g. to benchmark the storage paths without torch):
+        # simulated inference time per call
+        self.stub_encode_secs = stub_encode_ms / 1000
 
     # --------------------------------------------------------------------------
     def compute_embeddings(self, document: str) -> ndarray:
-        return self.model.encode(document) if self.load_transformers else ndarray([[0],[0],[0],[0]])
+        if not self.load_transformers:
+            return self.compute_embeddings_batch([document])[0]
+        return self.model.encode(document)
+
+    def compute_embeddings_batch(self, documents: list[str]) -> ndarray:
+        "encodes all documents with 1 call to the model, returns a (len(documents), dim) matrix"
+        if not self.load_transformers:
+            if self.stub_encode_secs > 0:
+                sleep(self.stub_encode_secs)
+            return stub_embeddings(documents, self.embedding_dimension)
+        return self.model.encode(documents, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True)
+
+    def compute_token_embeddings_batch(self, documents: list[str]) -> tuple[ndarray, ndarray]:
+        "encodes all documents' tokens with 1 call to the model, see tokenCache.join_tokens"
+        if not self.load_transformers:  # 1 token per word
+            if self.stub_encode_secs > 0:
+                sleep(self.stub_encode_secs)
+            return join_tokens([zeros((len(document.split()), self.get_token_dimension()),
+                                      dtype=float32) for document in documents])
+        return encode_tokens(self.model, documents)
+
+    def get_token_dimension(self) -> int:
+        "token embeddings are the transformer's, before any pooling/dense layer"
+        if not self.load_transformers:
+            return self.embedding_dimension
+        return self.model[0].get_word_embedding_dimension()
 
     # --------------------------------------------------------------------------
-    def read_offset(self, document_hash: str) -> int | None:
+    def read_offset(self, document_hash: bytes) -> int | None:
         if self.database_ro is not None:
             return self.database_ro.read_offset(document_hash)
-        if self.db_type == "leveldb":
-            val = self.send_shm_msg(document_hash,
-                                    dcp.DatabaseCommitProcess.SENTINEL_OFFSET, get_reply=True)
-            if isinstance(val, bool) and not val:
+        if self.db_type in dcp.DatabaseCommitProcess.DCP_READ_DB_TYPES:
+            offset = self.link.request(dcp.DatabaseCommitProcess.MSG_READ, document_hash,
+                                       self.model_id)
+            if offset is None or offset == dcp.DatabaseCommitProcess.NOT_FOUND_OFFSET:
                 return None
-            if isinstance(val, tuple):
-                return int(val[1])
-            return None
+            return offset
 
-    def write_offset(self, document_hash: str, offset: int) -> bool:
-        return self.send_shm_msg(document_hash, offset)
+    def read_offsets(self, document_hashes: list[bytes]) -> dict[bytes, int]:
+        if self.database_ro is not None:
+            return self.database_ro.read_offsets(document_hashes)
+        if self.db_type not in dcp.DatabaseCommitProcess.DCP_READ_DB_TYPES:
+            return {}
+        # all unique digests in 1 push, the DCP looks them up with 1 read_offsets call
+        unique_hashes = list(dict.fromkeys(document_hashes))
+        if not len(unique_hashes):
+            return {}
+        vals = self.link.request_many(dcp.DatabaseCommitProcess.MSG_READ, unique_hashes,
+                                      self.model_id)
+        return {document_hash: offset for document_hash, offset in zip(unique_hashes, vals)
+                if offset is not None and offset != dcp.DatabaseCommitProcess.NOT_FOUND_OFFSET}
 
-    # --------------------------------------------------------------------------
-    def send_shm_msg(self, document_hash: str, offset: int, get_reply: bool = False
-    ) -> bool | tuple[str, int]:
-        msg = dcp.SHMPayload(document_hash, offset).pack()
-        if msg is None:
-            logging.error("send_shm_msg: can't create msg offset={offset}, hash:'{document_hash}'")
-            return False
-        try:
-            available_ind = self.db_shm.index("")
-        except ValueError as e:
-            logging.warning(f"send_shm_msg: no room to write to db_shm: {str(e)}, dropping"
-                            f"{linesep}\toffset={offset}, hash:'{document_hash}'")
-            return False
-        self.db_shm[available_ind] = msg
-
-        if not get_reply:
-            return True
-        elapsed = READ_SHM_POLL_INTERVAL1
-        sleep(READ_SHM_POLL_INTERVAL1)
-
-        while elapsed < READ_SHM_TIMEOUT:
-            inbox = self.db_shm[available_ind]
-            digest = inbox[:len(dcp.DatabaseCommitProcess.SENTINEL_DIGEST)]
-            if digest == dcp.DatabaseCommitProcess.SENTINEL_DIGEST:
-                reply = dcp.SHMPayload(string=inbox).unpack()
-            else:
-                continue
-            if reply is None:
-                logging.error("send_shm_msg: can't unpack reply")
-                return False
-            else:
-                return reply
-            sleep(READ_SHM_POLL_INTERVAL2)
-            elapsed += READ_SHM_POLL_INTERVAL
+    def write_offset(self, document_hash: bytes, offset: int) -> bool:
+        return self.write_offsets([document_hash], [offset])
+
+    def write_offsets(self, document_hashes: list[bytes], offsets: list[int]) -> bool:
+        "sends all rows to the database commit process in 1 push, which inserts them as 1 batch"
+        self.link.send_records([(document_hash, offset, 0, dcp.DatabaseCommitProcess.MSG_WRITE,
+                                 self.model_id)
+                                for document_hash, offset in zip(document_hashes, offsets)])
+        return True
+
+    def touch(self, document_hashes: list[bytes]) -> None:
+        "reports cache hits for the access stats, sent in batches of TOUCH_BATCH_CNT"
+        if not self.track_access:
+            return
+        with self.touched_lock:
+            if not len(self.touched):
+                self.touched_since = monotonic()
+            self.touched.extend(document_hashes)
+            if (len(self.touched) < TOUCH_BATCH_CNT
+                    and monotonic() - self.touched_since < TOUCH_BATCH_SECS):
+                return
+            touched, self.touched = self.touched, []
+        self.link.send_records([(document_hash, 0, 0, dcp.DatabaseCommitProcess.MSG_TOUCH,
+                                 self.model_id) for document_hash in touched])
+
+    def claim(self, document_hash: bytes) -> bool:
+        """
+        cross-worker request coalescing: asks the database commit process whether this worker
+        should compute document_hash (True) or another worker is already computing (or has just
+        written) it (False). Errors are treated as granted, worst case the embeddings are computed
+        twice. A granted claim ends with the document's write, or with release
+        """
+        return self.claim_many([document_hash])[0]
+
+    def claim_many(self, document_hashes: list[bytes]) -> list[bool]:
+        "claim for several digests in 1 round trip"
+        if not len(document_hashes):
+            return []
+        vals = self.link.request_many(dcp.DatabaseCommitProcess.MSG_CLAIM, document_hashes,
+                                      self.model_id)
+        return [val != dcp.DatabaseCommitProcess.CLAIM_DENIED for val in vals]
+
+    def release(self, document_hashes: list[bytes]) -> None:
+        "gives up claims this worker won't write (failed or cancelled), their waiters compute them"
+        if not len(document_hashes):
+            return
+        self.link.send_records([(document_hash, 0, 0, dcp.DatabaseCommitProcess.MSG_RELEASE,
+                                 self.model_id) for document_hash in document_hashes])
 
     # --------------------------------------------------------------------------
     def clean_up(self, signum=None, frame=None):
-        if self.db_shm is not None:
-            self.db_shm.shm.close()
-            if self.db_shm.shm.buf is None:
-                logging.info(f"worker {getpid()} closed shm successfully.")
-                self.db_shm = None
+        self.link.close()   # closing it more than once (1 handler call per model) is harmless
     # --------------------------------------------------------------------------
     """
     def write_temp_index(self) -> None:
         self.get_index_database().write_temp_index()
     """
 
+
+# ------------------------------------------------------------------------------
+def stub_embeddings(documents: list[str], embedding_dimension: int) -> ndarray:
+    "the stub model's: unit vectors drawn from a generator seeded with each document's digest"
+    if not len(documents):
+        return zeros((0, embedding_dimension), dtype=float32)
+    embeddings = stack([
+            default_rng(list(sha256(document.encode("utf-8")).digest()[:16])).standard_normal(
+                    embedding_dimension, dtype=float32) for document in documents])
+    return embeddings / norm(embeddings, axis=1, keepdims=True)
+
+def encode_in_process(name: str, documents: list[str]) -> ndarray:
+    """
+    target for a ProcessPoolExecutor (see server.py --encode-executor): encodes documents with a
+    SentenceTransformer loaded once per executor process
+    """
+    if name not in _process_models:
+        from sentence_transformers import SentenceTransformer
+        _process_models[name] = SentenceTransformer(name)
+    return _process_models[name].encode(documents, batch_size=ENCODE_BATCH_SIZE,
+                                        convert_to_numpy=True)
+
+def encode_tokens_in_process(name: str, documents: list[str]) -> tuple[ndarray, ndarray]:
+    "encode_in_process for token embeddings"
+    if name not in _process_models:
+        from sentence_transformers import SentenceTransformer
+        _process_models[name] = SentenceTransformer(name)
+    return encode_tokens(_process_models[name], documents)
+
+def encode_tokens(model, documents: list[str]) -> tuple[ndarray, ndarray]:
+    "a SentenceTransformer's (unpadded) token embeddings of documents, see join_tokens"
+    # ragged: 1 tensor per document, which convert_to_numpy can't stack
+    tokens = model.encode(documents, batch_size=ENCODE_BATCH_SIZE,
+                          output_value="token_embeddings", convert_to_numpy=False)
+    return join_tokens([document_tokens.float().cpu().numpy() for document_tokens in tokens])
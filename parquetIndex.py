@@ -0,0 +1,36 @@
+"""
+bulk export & import of a model's DuckDB index (--db-type duckdb) to & from Parquet: the
+digest -> offset table as columns documentHash (32 byte binary) & offset (int64), for analytics
+over the cache or to load many rows at once instead of row by row.
+Stop the server before running this, DuckDB allows only 1 process to open an index read-write
+"""
+import argparse
+import logging
+import os
+
+from sys import stderr
+
+from indexDuckDB import IndexDuckDB
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("action",
+            choices=["export", "import"],
+            help="export: index -> Parquet file, import: Parquet file -> index")
+    parser.add_argument("model_dir",
+            help="model data directory, e.g. 'data/sentence-transformers_...'")
+    parser.add_argument("parquet_file",
+            help="Parquet file to write (export) or read (import)")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO, stream=stderr)
+
+    if args.action == "export":
+        index = IndexDuckDB(args.model_dir, readonly=True)
+        cnt = index.export_parquet(args.parquet_file)
+        logging.info(f'exported {cnt} rows to "{args.parquet_file}" '
+                     f"({os.path.getsize(args.parquet_file)} bytes)")
+    else:
+        index = IndexDuckDB(args.model_dir, readonly=False)
+        cnt = index.import_parquet(args.parquet_file)
+        logging.info(f'imported {cnt} new rows from "{args.parquet_file}"')
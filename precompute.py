@@ -0,0 +1,263 @@
+"""
+offline bulk precompute of a model's cache from a corpus known ahead of time, instead of sending
+it to the server: documents are read from a text file (1 per line) or a column of a Parquet file
+in chunks, each chunk is deduplicated by digest against itself & the model's index, its misses are
+encoded in large batches by a pool of processes (sized to the cores, each loads the model once &
+runs its torch ops on --threads threads) & they're written with 1 locked append per cache shard,
+then 1 batched index insert & commit. The next chunk is read & looked-up while 1 is encoded.
+Progress (how far the input is cached) is saved in the model's directory after each chunk, an
+interrupted run resumes from there. A crash between a chunk's append & its index commit leaves
+vectors no index row points to, compactCache.py drops them.
+Stop the server before running this, the index is written directly (not through the database
+commit process)
+"""
+import argparse
+import json
+import logging
+import numpy as np
+import os
+
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from multiprocessing import get_context
+from sys import stderr
+from time import perf_counter
+
+from cacheShards import CacheShards
+from compactCache import open_index
+from databaseCommitProcess import DatabaseCommitProcess
+from documentStore import DocumentStore
+from embeddingService import ACQUIRE_LOCK_TIMEOUT, EmbeddingService
+from indexDatabase import IndexDatabase
+from model import encode_in_process
+from searchIndex import SearchIndex
+
+CHUNK_CNT = 65536   # documents read, looked-up & committed per step
+BATCH_CNT = 1024    # documents encoded per task of the process pool
+PROGRESS_FILENAME = "precompute.json"   # input file path -> position cached up to
+
+
+def init_process(threads: int) -> None:
+    "pins a pool process' intra-op threads, so that the processes don't oversubscribe the cores"
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[name] = str(threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    import torch
+    torch.set_num_threads(threads)
+
+# -----------------------------------------------------------------------------
+def read_text_chunks(input_path: str, position: int, cnt: int
+) -> Iterator[tuple[int, list[str]]]:
+    "(byte offset after the chunk, its lines) from the byte offset position on"
+    with open(input_path, "rb") as f:
+        f.seek(position)
+        while True:
+            lines = list(islice(f, cnt))
+            if not len(lines):
+                return
+            # invalid utf-8 is replaced rather than failing the rest of the corpus
+            yield f.tell(), [line.rstrip(b"\r\n").decode("utf-8", errors="replace")
+                             for line in lines]
+
+def read_parquet_chunks(input_path: str, column: str, position: int, cnt: int
+) -> Iterator[tuple[int, list[str]]]:
+    "(row number after the chunk, its column's values) from row number position on"
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(input_path)
+    # skips the row groups before position without reading them
+    group, group_start = 0, 0
+    while (group < parquet_file.num_row_groups
+           and group_start + parquet_file.metadata.row_group(group).num_rows <= position):
+        group_start += parquet_file.metadata.row_group(group).num_rows
+        group += 1
+    skip = position - group_start
+    for batch in parquet_file.iter_batches(cnt, range(group, parquet_file.num_row_groups),
+                                           columns=[column]):
+        documents = batch.column(0).to_pylist()[skip:]
+        skip = 0
+        if len(documents):
+            position += len(documents)
+            yield position, documents
+
+def read_chunks(input_path: str, column: str, position: int, cnt: int
+) -> Iterator[tuple[int, list[str]]]:
+    if os.path.splitext(input_path)[1].lower() in (".parquet", ".pq"):
+        return read_parquet_chunks(input_path, column, position, cnt)
+    return read_text_chunks(input_path, position, cnt)
+
+# -----------------------------------------------------------------------------
+def load_progress(model_dirpath: str, input_path: str) -> int:
+    "the input's position cached up to by previous runs, 0 if none"
+    try:
+        with open(os.path.join(model_dirpath, PROGRESS_FILENAME), "r", encoding="utf-8") as f:
+            return json.load(f).get(os.path.abspath(input_path), 0)
+    except FileNotFoundError:
+        return 0
+
+def save_progress(model_dirpath: str, input_path: str, position: int) -> None:
+    progress_path = os.path.join(model_dirpath, PROGRESS_FILENAME)
+    try:
+        with open(progress_path, "r", encoding="utf-8") as f:
+            progress = json.load(f)
+    except FileNotFoundError:
+        progress = {}
+    progress[os.path.abspath(input_path)] = position
+    temp_path = f"{progress_path}.{os.getpid()}"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(progress, f, indent=1)
+    os.replace(temp_path, progress_path)
+
+# -----------------------------------------------------------------------------
+def commit_chunk(cache: CacheShards, index: IndexDatabase, document_hashes: list[bytes],
+                 encoded: list[Future]) -> list[tuple[bytes, int]]:
+    """
+    waits for a chunk's misses to be encoded, appends them to the cache (1 locked append per
+    shard), then indexes them with 1 batched insert & commit. Returns the index rows
+    """
+    if not len(document_hashes):    # all cached already
+        return []
+    embeddings = np.concatenate([future.result() for future in encoded]).astype(np.float32,
+                                                                                 copy=False)
+    shard_rows = {}
+    for row, document_hash in enumerate(document_hashes):
+        shard_rows.setdefault(cache.get_shard(document_hash), []).append(row)
+    rows = []
+    for shard, shard_hashes_rows in shard_rows.items():
+        shard_hashes = [document_hashes[row] for row in shard_hashes_rows]
+        locations = cache.append(shard, embeddings[shard_hashes_rows], shard_hashes)
+        if locations is None:
+            raise TimeoutError(f'timed-out acquiring the lock of "{cache.dirpath}" shard {shard}')
+        rows.extend(zip(shard_hashes, locations))
+    # as in the server, the cache is written b4 the index
+    index.add_rows(rows)
+    index.flush()
+    return rows
+
+def precompute(model_name: str, input_path: str, data_dirpath: str, db_type: str,
+               column: str = "text", processes: int = 0, threads: int = 1,
+               chunk_cnt: int = CHUNK_CNT, batch_cnt: int = BATCH_CNT, cache_shards: int = 1,
+               max_shard_nbytes: int = 0, store_documents: bool = False, restart: bool = False
+) -> dict:
+    """
+    caches the embeddings of the input's documents which aren't yet. processes: 0 for 1 per
+    `threads` cores. Returns a report: documents read, skipped (empty, duplicates or already
+    cached) & computed
+    """
+    models_cfg = EmbeddingService.get_models_cfg(data_dirpath)
+    if model_name not in models_cfg:
+        raise ValueError(f'"{model_name}" is not in models.txt')
+    cfg = models_cfg[model_name]
+    model_dirpath = cfg["data_dirpath"]
+    EmbeddingService.setup_model_dir(cfg)
+    EmbeddingService.setup_lock_dir()
+    cache = CacheShards(model_dirpath, cfg["embedding_dimension"],
+                        EmbeddingService.get_lock_filepath(model_name), ACQUIRE_LOCK_TIMEOUT,
+                        cfg["storage_dtype"], cache_shards, max_shard_nbytes)
+    index = open_index(db_type, model_dirpath, readonly=False)
+    document_store = DocumentStore(model_dirpath) if store_documents else None
+    # the server builds it @ start-up if there's none, else it gets this run's rows
+    search_index = (SearchIndex(model_dirpath, readonly=False)
+                    if os.path.exists(os.path.join(model_dirpath, SearchIndex.FILENAME)) else None)
+    position = 0 if restart else load_progress(model_dirpath, input_path)
+    if position:
+        logging.info(f'"{input_path}": resuming from {position}')
+    processes = processes or max(os.cpu_count() // threads, 1)
+    report = {"read": 0, "skipped": 0, "computed": 0}
+    started = perf_counter()
+
+    def commit(pending: tuple) -> None:
+        end, document_hashes, documents, encoded = pending
+        rows = commit_chunk(cache, index, document_hashes, encoded)
+        if document_store is not None:
+            document_store.put_many(document_hashes, documents)
+        if search_index is not None:
+            search_index.add(rows, cache)
+        save_progress(model_dirpath, input_path, end)
+        report["computed"] += len(rows)
+        secs = perf_counter() - started
+        logging.info(f'"{input_path}" @ {end}: {report["read"]} documents read, '
+                     f'{report["skipped"]} skipped, {report["computed"]} computed '
+                     f'({report["computed"] / secs:.0f}/s)')
+
+    encode = partial(encode_in_process, model_name)
+    pending = None  # the chunk being encoded: (end position, miss hashes, misses, futures)
+    with ProcessPoolExecutor(processes, mp_context=get_context("spawn"), initializer=init_process,
+                             initargs=(threads,)) as executor:
+        try:
+            for end, documents in read_chunks(input_path, column, position, chunk_cnt):
+                report["read"] += len(documents)
+                misses = {}     # hash -> document, unique
+                for document in documents:
+                    if document:
+                        misses.setdefault(EmbeddingService.get_digest(document), document)
+                # also skips those of the chunk still being encoded
+                cached = set(index.read_offsets(list(misses)))
+                if pending is not None:
+                    cached.update(pending[1])
+                misses = {document_hash: document for document_hash, document in misses.items()
+                          if document_hash not in cached}
+                report["skipped"] += len(documents) - len(misses)
+                documents = list(misses.values())
+                encoded = [executor.submit(encode, documents[i:i + batch_cnt])
+                           for i in range(0, len(documents), batch_cnt)]
+                if pending is not None:
+                    commit(pending)
+                pending = (end, list(misses), documents, encoded)
+            if pending is not None:
+                commit(pending)
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+    return report
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model",
+            help="model name, as in models.txt")
+    parser.add_argument("input",
+            help="text file (1 document per line) or Parquet file (.parquet) of documents")
+    parser.add_argument("--batch",
+            help=f"optional: documents encoded per task of the process pool, default: {BATCH_CNT}",
+            default=BATCH_CNT, type=int)
+    parser.add_argument("--cache-shards",
+            help="optional: as the server's, default: 1",
+            default=1, type=int)
+    parser.add_argument("--chunk",
+            help=f"optional: documents committed (& progress saved) per step, default: {CHUNK_CNT}",
+            default=CHUNK_CNT, type=int)
+    parser.add_argument("--column",
+            help="optional: Parquet column of the documents, default: 'text'",
+            default="text")
+    parser.add_argument("-d", "--data-dir",
+            help="optional: path to data files (index & cache) per model, default: 'data'",
+            default="data")
+    parser.add_argument("--max-shard-mb",
+            help="optional: as the server's, default: 0 (no cap)",
+            default=0, type=float)
+    parser.add_argument("-p", "--processes",
+            help="optional: encoding processes, default: cores / threads",
+            default=0, type=int)
+    parser.add_argument("--restart",
+            action="store_true",
+            help="optional: ignore the progress saved by previous runs of this input")
+    parser.add_argument("--store-documents",
+            action="store_true",
+            help="optional: as the server's, also store the documents' text")
+    parser.add_argument("-t", "--db-type",
+            choices=DatabaseCommitProcess.SUPPORTED_DB_TYPES,
+            help="optional: database type of the index, default: 'sqlite'",
+            default="sqlite")
+    parser.add_argument("--threads",
+            help="optional: torch intra-op threads per encoding process, default: 1",
+            default=1, type=int)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO, stream=stderr)
+
+    report = precompute(args.model, args.input, args.data_dir, args.db_type, args.column,
+                        args.processes, args.threads, args.chunk, args.batch, args.cache_shards,
+                        int(args.max_shard_mb * 2**20), args.store_documents, args.restart)
+    logging.info(f'"{args.input}": {report["read"]} documents read, {report["skipped"]} skipped, '
+                 f'{report["computed"]} computed')
@@ -0,0 +1,185 @@
+"""
+start-up recovery of a model's cache files & index after a crash (run by server.py before the
+database commit process & the workers start, or by hand with the server stopped):
+* a cache file ending in a torn (partly written) vector is truncated to whole vectors
+* vectors written but not indexed (the rows were still held back for batching or in flight to the
+  database commit process) are indexed from the write-ahead log (see --write-ahead & CacheFile),
+  from its mark on: the database commit process trims the log as it commits (trim_write_ahead)
+* index rows pointing past the end (or not @ the start of a vector) of their cache file are
+  dropped, so that those documents are computed & cached again instead of missing forever
+Index rows & the logs are read in chunks & checked as arrays, a multi-GB cache takes seconds
+"""
+import argparse
+import logging
+import numpy as np
+import os
+
+from collections.abc import Iterator
+from itertools import islice
+from sys import stderr
+
+from cacheFile import CacheFile, WAL_RECORD
+from cacheShards import CacheShards, LOCATION_SHIFT, OFFSET_MASK
+from compactCache import get_cache_files, open_index
+from indexDatabase import IndexDatabase
+
+RECOVERY_MODES = ["full", "tail", "off"]    # full: also checks every index row
+SCAN_CHUNK = 100000     # index rows checked per step
+
+
+def truncate_torn_tail(cache_file: CacheFile) -> int:
+    "returns the number of bytes cut off"
+    size = os.path.getsize(cache_file.path)
+    torn = size % cache_file.vector_nbytes
+    if torn:
+        os.truncate(cache_file.path, size - torn)
+        logging.warning(f'"{cache_file.path}": truncated a torn vector ({torn} bytes)')
+    return torn
+
+# -----------------------------------------------------------------------------
+def read_write_ahead(cache_file: CacheFile, start: int
+) -> Iterator[tuple[int, np.ndarray, np.ndarray]]:
+    """
+    the file's write-ahead log from position start on, in chunks of SCAN_CHUNK records: yields
+    (position of the chunk, its records, stale), stale marks the records which a later record
+    covers (same or lower offset): their append failed & the offset was written again, their
+    vectors aren't in the file. 2 passes, the 1st only keeps the chunks' lowest offsets
+    """
+    chunk_mins, end = [], start
+    for pos, records in cache_file.read_write_ahead(start, SCAN_CHUNK):
+        chunk_mins.append(int(records["offset"].min()))
+        end = pos + len(records) * WAL_RECORD.size  # records appended since aren't looked at
+    # lowest offset of the records after each chunk
+    later_mins = np.minimum.accumulate(np.array(chunk_mins[1:] + [np.iinfo(np.int64).max],
+                                                dtype=np.int64)[::-1])[::-1]
+    for i, (pos, records) in enumerate(cache_file.read_write_ahead(start, SCAN_CHUNK)):
+        if pos >= end:
+            return
+        records = records[:(end - pos) // WAL_RECORD.size]
+        offsets = records["offset"]
+        after = np.append(np.minimum.accumulate(offsets[::-1])[::-1][1:], later_mins[i])
+        yield pos, records, offsets >= after
+
+def replay_write_ahead(index: IndexDatabase, file_id: int, cache_file: CacheFile) -> int:
+    """
+    indexes the vectors in the file's write-ahead log (from its mark on) which were completely
+    written but have no index row, then empties the log. Returns the number of rows added
+    """
+    if not os.path.exists(cache_file.wal_path):
+        return 0
+    size = os.path.getsize(cache_file.path)
+    cnt_added = 0
+    for _, records, stale in read_write_ahead(cache_file, cache_file.get_write_ahead_mark()):
+        records = records[~stale & (records["offset"] + cache_file.vector_nbytes <= size)]
+        digests = [digest.tobytes() for digest in records["digest"]]
+        found = index.read_offsets(digests)
+        rows = [(digest, CacheShards.pack_location(file_id, offset))
+                for digest, offset in zip(digests, records["offset"].tolist())
+                if digest not in found]
+        if len(rows):
+            index.add_rows(rows)
+            cnt_added += len(rows)
+    index.flush()
+    # all its vectors are indexed now (the server is stopped, nothing holds the lock)
+    cache_file.trim_write_ahead(os.path.getsize(cache_file.wal_path), 0)
+    if cnt_added:
+        logging.warning(f'"{cache_file.path}": indexed {cnt_added} vectors from the write-ahead '
+                        "log")
+    return cnt_added
+
+def trim_write_ahead(index: IndexDatabase, cache_file: CacheFile, lock_timeout: float) -> int:
+    """
+    run by the database commit process: moves the file's write-ahead mark past the records from
+    the mark on whose digests are indexed (or which are stale, see read_write_ahead), up to the
+    1st which isn't (yet), & commits them. The log is emptied once that's all of it. Returns the
+    number of records trimmed
+    """
+    mark = pos = cache_file.get_write_ahead_mark()
+    for chunk_pos, records, stale in read_write_ahead(cache_file, mark):
+        digests = [digest.tobytes() for digest in records["digest"]]
+        found = index.read_offsets(digests)
+        settled = stale | np.fromiter((digest in found for digest in digests), dtype=bool,
+                                      count=len(digests))
+        cnt_settled = len(settled) if settled.all() else int(np.argmin(settled))
+        pos = chunk_pos + cnt_settled * WAL_RECORD.size
+        if cnt_settled < len(settled):
+            break
+    if pos == mark:
+        return 0
+    index.flush()   # rows found may still be held back for batching
+    if not cache_file.trim_write_ahead(pos, lock_timeout):
+        return 0
+    return (pos - mark) // WAL_RECORD.size
+
+# -----------------------------------------------------------------------------
+def drop_rows_past_eof(index: IndexDatabase, cache_files: dict[int, CacheFile]) -> int:
+    "returns the number of index rows dropped"
+    cnt_ids = max(cache_files, default=0) + 1
+    sizes = np.zeros(cnt_ids, dtype=np.int64)   # missing files have no vectors
+    vector_nbytes = np.ones(cnt_ids, dtype=np.int64)
+    for file_id, cache_file in cache_files.items():
+        sizes[file_id] = os.path.getsize(cache_file.path)
+        vector_nbytes[file_id] = cache_file.vector_nbytes
+    dropped = []
+    rows = index.iter_rows()
+    while True:
+        chunk = list(islice(rows, SCAN_CHUNK))
+        if not len(chunk):
+            break
+        locations = np.fromiter((location for _, location in chunk), dtype=np.int64,
+                                count=len(chunk))
+        file_ids = np.minimum(locations >> LOCATION_SHIFT, cnt_ids - 1)
+        offsets = locations & OFFSET_MASK
+        nbytes = vector_nbytes[file_ids]
+        bad = ((locations < 0) | (locations >> LOCATION_SHIFT >= cnt_ids)
+               | (offsets % nbytes != 0) | (offsets + nbytes > sizes[file_ids]))
+        dropped.extend(chunk[row][0] for row in np.flatnonzero(bad).tolist())
+    if len(dropped):
+        index.delete_rows(dropped)
+        logging.warning(f"dropped {len(dropped)} index rows pointing past the end of the cache")
+    return len(dropped)
+
+# -----------------------------------------------------------------------------
+def recover(model_dirpath: str, db_type: str, dimension: int, mode: str = "full") -> dict:
+    "returns a report: bytes truncated, index rows added from the write-ahead logs & dropped"
+    report = {"truncated_nbytes": 0, "replayed_rows": 0, "dropped_rows": 0}
+    if mode == "off" or not os.path.isdir(model_dirpath):
+        return report
+    cache_files = get_cache_files(model_dirpath, dimension)
+    if not len(cache_files):
+        return report
+    for cache_file in cache_files.values():
+        report["truncated_nbytes"] += truncate_torn_tail(cache_file)
+    index = open_index(db_type, model_dirpath, readonly=False)
+    for file_id, cache_file in cache_files.items():
+        report["replayed_rows"] += replay_write_ahead(index, file_id, cache_file)
+    if mode == "full":
+        report["dropped_rows"] = drop_rows_past_eof(index, cache_files)
+    del index   # the database commit process opens it next
+    return report
+
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("model_dirs",
+            nargs="+",
+            help="1 or more model data directories, e.g. 'data/sentence-transformers_...'")
+    parser.add_argument("--dimension",
+            help="optional: embedding dimension, only needed for cache files written before the"
+                 " storage dtype was recorded (no embeddings.json)",
+            type=int)
+    parser.add_argument("-m", "--mode",
+            choices=RECOVERY_MODES[:2],
+            help="optional: 'tail' skips checking every index row, default: 'full'",
+            default="full")
+    parser.add_argument("-t", "--db-type",
+            choices=["duckdb", "hashtable", "leveldb", "sqlite"],
+            help="optional: database type of the indexes, default: 'sqlite'",
+            default="sqlite")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO, stream=stderr)
+
+    for model_dirpath in args.model_dirs:
+        report = recover(model_dirpath, args.db_type, args.dimension, args.mode)
+        logging.info(f'"{model_dirpath}": truncated {report["truncated_nbytes"]} bytes, indexed '
+                     f'{report["replayed_rows"]} & dropped {report["dropped_rows"]} rows')
@@ -0,0 +1,53 @@
+"""
+deduplication of identical in-flight computations within a worker: the 1st request to miss on a
+key (model name, document hash) claims it & computes, requests arriving while it's in flight
+wait on the same future instead of computing (and caching) the same embeddings again.
+An owner which is cancelled (e.g. its client disconnected) doesn't fail its waiters: they get
+RECLAIM & claim the key again, the 1st of them computes it
+"""
+from concurrent.futures import Future
+from threading import Lock
+
+RECLAIM = object()  # a waiter's result when the owner was cancelled
+
+
+class RequestCoalescer:
+    def __init__(self):
+        self.in_flight = {}     # key -> Future of its embeddings
+        self.lock = Lock()
+
+    # -------------------------------------------------------------------------
+    def claim(self, key: tuple) -> tuple[Future, bool]:
+        """
+        returns (future, True) if the caller now owns key & must resolve/fail it, or
+        (future, False) if key is already in flight, the caller should wait on future.
+        concurrent.futures.Future: threads wait with result(), coroutines await wrap_future()
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                return future, False
+            future = self.in_flight[key] = Future()
+            return future, True
+
+    # -------------------------------------------------------------------------
+    def resolve(self, key: tuple, result) -> None:
+        "owner hands result to all waiters & releases key"
+        with self.lock:
+            future = self.in_flight.pop(key, None)
+        if future is not None:
+            future.set_result(result)
+
+    def fail(self, key: tuple, exception: BaseException) -> None:
+        """
+        owner couldn't compute: waiters get exception & key is released. Not for cancellation
+        (asyncio.CancelledError, KeyboardInterrupt...: not an Exception), waiters get RECLAIM
+        """
+        with self.lock:
+            future = self.in_flight.pop(key, None)
+        if future is None:
+            return
+        if isinstance(exception, Exception):
+            future.set_exception(exception)
+        else:
+            future.set_result(RECLAIM)
@@ -0,0 +1,236 @@
+"""
+approximate nearest neighbour search over a model's cached embeddings: an inverted file (IVF)
+index in numpy. The vectors are clustered (spherical k-means) around nlist centroids & each cached
+vector is filed in the list of its nearest centroid, a search scores the query against the
+centroids, then exactly against the vectors of the nprobe nearest lists (read from the cache).
+The index file (searchIndex.bin, next to the index database) holds the centroids, then 1 record
+(digest, location, list) per vector. It's built (& retrained once the cache has grown
+RETRAIN_FACTOR times) at start-up, the database commit process appends the vectors written
+since, workers read it & pick up new records on their next search
+"""
+import logging
+import numpy as np
+import os
+
+from collections.abc import Iterator
+from itertools import islice
+from struct import Struct
+from threading import Lock
+from time import monotonic
+
+from cacheShards import CacheShards, LOCATION_SHIFT, OFFSET_MASK
+
+# magic, nlist, dimension, rows the centroids were trained on
+HEADER = Struct("<8sIIQ")
+HEADER_NBYTES = 64
+MAGIC = b"EMBSRCH1"
+RECORD = np.dtype([("digest", "V32"), ("location", "<i8"), ("list", "<i4"), ("pad", "<i4")])
+METRICS = ["cosine", "dot"]
+MIN_TRAIN_ROWS = 1024   # fewer rows: 1 list, i.e. an exact search
+MAX_LISTS = 4096
+TRAIN_ROWS_PER_LIST = 64    # k-means sample size per centroid
+KMEANS_ITERATIONS = 10
+RETRAIN_FACTOR = 4  # retrain @ start-up once the index has this many times its trained rows
+ASSIGN_CHUNK = 65536    # vectors read & assigned to lists per step
+REFRESH_SECS = 1    # a reader looks for new records at most this often
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def train_centroids(vectors: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    "spherical k-means: (nlist, dim) unit centroids of the (unit) vectors"
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assigned = np.argmax(vectors @ centroids.T, axis=1)
+        order = np.argsort(assigned, kind="stable")
+        lists, starts = np.unique(assigned[order], return_index=True)
+        # lists which got no vector keep their centroid
+        centroids[lists] = normalize(np.add.reduceat(vectors[order], starts, axis=0))
+    return centroids
+
+
+class SearchIndex:
+    FILENAME = "searchIndex.bin"
+
+    def __init__(self, dirpath: str, readonly: bool = True):
+        self.filepath = os.path.join(dirpath, self.FILENAME)
+        self.readonly = readonly
+        self.lock = Lock()  # (re)loading
+        self.centroids = None
+        self.trained_rows = 0
+        self.inode = None
+        self.records_pos = 0    # bytes of the file already read
+        self.checked_at = 0.0
+        self.cnt_records = 0
+        # the centroids & each list's records (digests, locations), replaced as 1 attribute on a
+        # reload, a list's records array is replaced when records are appended to it
+        self.lists = (None, [])
+        self._load()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def build(cls, dirpath: str, rows: Iterator[tuple[bytes, int]], cache: CacheShards
+    ) -> "SearchIndex":
+        "trains the centroids on a sample of rows' vectors, files all rows & replaces the index"
+        records = []
+        for chunk in iter(lambda: list(islice(rows, ASSIGN_CHUNK)), []):
+            chunk_records = np.zeros(len(chunk), dtype=RECORD)
+            chunk_records["digest"] = np.frombuffer(b"".join(digest for digest, _ in chunk),
+                                                    dtype="V32")
+            chunk_records["location"] = [location for _, location in chunk]
+            records.append(chunk_records)
+        records = np.concatenate(records) if len(records) else np.zeros(0, dtype=RECORD)
+        records = records[cls._get_readable(records["location"], cache)]
+        nlist = 1 if len(records) < MIN_TRAIN_ROWS else min(int(np.sqrt(len(records))), MAX_LISTS)
+        if nlist == 1:
+            centroids = np.zeros((1, cache.embedding_dimension), dtype=np.float32)
+        else:
+            cnt_sample = min(len(records), nlist * TRAIN_ROWS_PER_LIST)
+            sample = np.sort(np.random.default_rng(0).choice(len(records), cnt_sample,
+                                                              replace=False))
+            centroids = train_centroids(
+                    normalize(cache.read_many(records["location"][sample])), nlist)
+        for start in range(0, len(records), ASSIGN_CHUNK):
+            chunk = records[start:start + ASSIGN_CHUNK]
+            chunk["list"] = cls._assign(centroids, cache.read_many(chunk["location"]))
+        temp_filepath = os.path.join(dirpath, cls.FILENAME + ".tmp")
+        with open(temp_filepath, "wb") as f:
+            f.write(HEADER.pack(MAGIC, nlist, centroids.shape[1], len(records))
+                    .ljust(HEADER_NBYTES, b"\0"))
+            f.write(centroids.astype(np.float32).tobytes())
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filepath, os.path.join(dirpath, cls.FILENAME))
+        logging.info(f'search index: filed {len(records)} vectors in {nlist} lists in "{dirpath}"')
+        return cls(dirpath, readonly=False)
+
+    @staticmethod
+    def _get_readable(locations: np.ndarray, cache: CacheShards) -> np.ndarray:
+        "mask of the locations which can be read from the cache"
+        readable = np.ones(len(locations), dtype=bool)
+        file_ids = locations >> LOCATION_SHIFT
+        for file_id in np.unique(file_ids).tolist():
+            cache_file = cache.get_file(file_id)
+            rows = file_ids == file_id
+            if cache_file is None or not os.path.exists(cache_file.path):   # e.g. retired
+                readable[rows] = False
+                continue
+            readable[rows] = ((locations[rows] & OFFSET_MASK) + cache_file.vector_nbytes
+                              <= os.path.getsize(cache_file.path))
+        return readable
+
+    @staticmethod
+    def _assign(centroids: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+        "the list of each vector: its nearest centroid"
+        if len(centroids) == 1:
+            return np.zeros(len(vectors), dtype=np.int32)
+        return np.argmax(normalize(vectors) @ centroids.T, axis=1).astype(np.int32)
+
+    def needs_retraining(self) -> bool:
+        cnt_rows = self.cnt_records
+        return (self.centroids is None or (cnt_rows >= MIN_TRAIN_ROWS
+                                           and cnt_rows >= RETRAIN_FACTOR * self.trained_rows))
+
+    # -------------------------------------------------------------------------
+    def add(self, rows: list[tuple[bytes, int]], cache: CacheShards) -> None:
+        "files new rows (digest, location) of the model's index, called by the DCP"
+        if self.readonly or self.centroids is None or not len(rows):
+            return
+        records = np.zeros(len(rows), dtype=RECORD)
+        records["digest"] = np.frombuffer(b"".join(digest for digest, _ in rows), dtype="V32")
+        records["location"] = [location for _, location in rows]
+        records = records[self._get_readable(records["location"], cache)]
+        if not len(records):
+            return
+        records["list"] = self._assign(self.centroids, cache.read_many(records["location"]))
+        with open(self.filepath, "ab") as f:
+            f.write(records.tobytes())
+
+    # -------------------------------------------------------------------------
+    def _load(self) -> None:
+        "reads the centroids & all records, or only the records added since the last call"
+        with self.lock:
+            try:
+                f = open(self.filepath, "rb")
+            except FileNotFoundError:
+                return
+            with f:
+                stat = os.fstat(f.fileno())
+                reloaded = stat.st_ino != self.inode    # new or rebuilt
+                if reloaded:
+                    magic, nlist, dimension, trained_rows = HEADER.unpack(
+                            f.read(HEADER_NBYTES)[:HEADER.size])
+                    if magic != MAGIC:
+                        raise ValueError(f'"{self.filepath}" is not a search index')
+                    self.centroids = np.frombuffer(f.read(nlist * dimension * 4),
+                                                   dtype=np.float32).reshape(nlist, dimension)
+                    self.trained_rows = trained_rows
+                    self.inode = stat.st_ino
+                    self.records_pos = HEADER_NBYTES + self.centroids.nbytes
+                    self.cnt_records = 0
+                    lists = [np.empty(0, dtype=RECORD)] * nlist
+                else:
+                    lists = self.lists[1]
+                size = stat.st_size - (stat.st_size - self.records_pos) % RECORD.itemsize
+                if size > self.records_pos:
+                    new_records = np.frombuffer(os.pread(f.fileno(), size - self.records_pos,
+                                                         self.records_pos), dtype=RECORD)
+                    self.records_pos = size
+                    self.cnt_records += len(new_records)
+                    # only the new records are sorted, each is appended to its list
+                    new_records = new_records[np.argsort(new_records["list"], kind="stable")]
+                    list_ids, starts = np.unique(new_records["list"], return_index=True)
+                    for list_id, records in zip(list_ids.tolist(),
+                                                np.split(new_records, starts[1:])):
+                        lists[list_id] = np.concatenate([lists[list_id], records])
+                if reloaded:
+                    self.lists = (self.centroids, lists)
+        self.checked_at = monotonic()
+
+    # -------------------------------------------------------------------------
+    def search(self, query: np.ndarray, cache: CacheShards, k: int = 10, metric: str = "cosine",
+               nprobe: int = 8) -> list[tuple[bytes, float]]:
+        "the k (digest, score) most similar to the query vector, best 1st"
+        if monotonic() - self.checked_at > REFRESH_SECS:
+            self._load()
+        centroids, lists = self.lists
+        if centroids is None:
+            return []
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        if metric == "cosine":
+            query = normalize(query)
+        probed = np.argsort(-(centroids @ normalize(query)))[:nprobe]
+        candidates = np.concatenate([lists[i] for i in probed.tolist()])
+        if not len(candidates):
+            return []
+        vectors = cache.read_many(candidates["location"])
+        if vectors is None:     # e.g. rows dropped by recovery, skip the unreadable ones
+            candidates = candidates[self._get_readable(candidates["location"], cache)]
+            vectors = cache.read_many(candidates["location"])
+        if metric == "cosine":
+            vectors = normalize(vectors)
+        scores = vectors @ query
+        # a document cached twice (by 2 workers @ once) is filed twice, over-fetch & dedupe
+        cnt_top = min(2 * k, len(scores))
+        top = np.argpartition(-scores, cnt_top - 1)[:cnt_top]
+        top = top[np.argsort(-scores[top])]
+        found = {}
+        for i in top.tolist():
+            found.setdefault(candidates["digest"][i].tobytes(), float(scores[i]))
+        return list(found.items())[:k]
+
+# -----------------------------------------------------------------------------
+def prepare(model_dirpath: str, db_type: str, cache: CacheShards) -> None:
+    "builds the model's search index if it has none or it needs retraining, run @ start-up"
+    from compactCache import open_index
+    if not SearchIndex(model_dirpath).needs_retraining():
+        return
+    # read-write: creates a new model's index (as recover does), a read-only one can't be opened
+    index = open_index(db_type, model_dirpath, readonly=False)
+    SearchIndex.build(model_dirpath, index.iter_rows(), cache)
+    del index
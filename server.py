@@ -5,81 +5,225 @@ implementations may use a separate thread to handle transaction commits in BG as
 To insure that resources are properly cleaned-up, use "graceful" server shutdown when possible
 """
 import argparse
+import asyncio
+import json
 import logging
+import numpy as np
 import uvicorn
 
+from collections import deque
+from collections.abc import AsyncIterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from fastapi import BackgroundTasks, FastAPI, Form, HTTPException, Response
+from functools import partial
+from fastapi import (BackgroundTasks, FastAPI, Form, Header, HTTPException, Query, Request,
+                     Response)
 from fastapi.middleware.cors import CORSMiddleware
-from filelock import Timeout, FileLock
-from os import getpid
+from fastapi.responses import StreamingResponse
+from io import BytesIO
+from multiprocessing import get_context
+from os import getpid, path
 from pathlib import Path
+from starlette.requests import ClientDisconnect
+from struct import Struct
 from sys import stderr
+from time import perf_counter
 from typing import Annotated
 
 #import embeddingService # importing further down (after parse_args) speeds up "help" display
                          # and args error-handling significantly (about 4x) due to PyTorch load
 DEFAULT_MODEL = "sentence-transformers/distiluse-base-multilingual-cased-v2"
+STREAM_BATCH_CNT = 256  # lines of a '/stream' upload looked-up & encoded together
+STREAM_PIPELINE_DEPTH = 4   # '/stream' batches in flight (so held in memory) per request
+STREAM_FORMATS = ["binary", "ndjson"]
+FRAME_NBYTES = Struct("<I")     # '/stream' binary frame header: the frame's length
+RESPONSE_DTYPES = ["float32", "float16", "stored"]
+# Accept header media type -> format of the embeddings in '/' & '/batch' responses
+RESPONSE_FORMATS = {"application/octet-stream": "raw", "application/x-npy": "npy",
+                    "application/vnd.apache.arrow.stream": "arrow"}
 
 
 parser = argparse.ArgumentParser()
+parser.add_argument("--cache-shards",
+        help="optional: per model, number of cache files written in parallel, documents are"
+             " spread over them by digest, default: 1",
+        default=1, type=int)
+parser.add_argument("--coalesce-across-workers",
+        action="store_true",
+        help="optional: a worker which misses on a document that another worker is computing"
+             " waits for it to be cached instead of computing it too")
 parser.add_argument("-c", "--cors-origin",
         nargs="*", default="*",
         help='optional: 1 or more origins for CORS requests. "*" (default) means all are allowed')
 parser.add_argument("-d", "--data-dir",
         help="optional: path to data files (index & cache) per model, default: 'data' in curr_dir",
         default="data")
+parser.add_argument("--eviction-policy",
+        choices=["lfu", "lru"],
+        help="optional: with --max-cache-mb or --max-cache-vectors, keep the most recently (lru)"
+             " or most frequently (lfu) used documents (see --track-access), default: 'lru'",
+        default="lru")
+parser.add_argument("--encode-executor",
+        choices=["process", "thread"],
+        help="optional: run model inference in a pool of threads or of processes (each process"
+             " loads its own copy of the model), default: 'thread'",
+        default="thread")
+parser.add_argument("--encode-workers",
+        help="optional: size of the model inference pool per worker, default: 1",
+        default=1, type=int)
 parser.add_argument("--host",
         default="127.0.0.1",
         help="optional: run uvicorn/gunicorn as this host, defaults to '127.0.0.1'")
+parser.add_argument("--hot-cache-mb",
+        help="optional: per worker & model, RAM budget (MiB) for recently used embeddings, 0"
+             " disables the hot cache, default: 64",
+        default=64, type=float)
+parser.add_argument("--io-workers",
+        help="optional: number of threads per worker for cache lookups & reads, default: 4",
+        default=4, type=int)
 parser.add_argument("-l", "--log-level",
         choices=["debug", "info", "warning", "error", "critical"],
         help="optional: log level for entire application, default: 'info'",
         default="info")
+parser.add_argument("--max-batch-size",
+        help="optional: max number of concurrent cache misses encoded together in 1 call to the"
+             " model, 1 disables micro-batching, default: 32",
+        default=32, type=int)
+parser.add_argument("--max-batch-wait-ms",
+        help="optional: max time (ms) a cache miss waits for others to fill its batch, default: 5",
+        default=5.0, type=float)
+parser.add_argument("--max-cache-mb",
+        help="optional: per model, cap (MiB) of the cache files, the oldest full ones are retired"
+             " (see --eviction-policy) once it's exceeded, needs --max-shard-mb, default: 0 (no"
+             " cap)",
+        default=0, type=float)
+parser.add_argument("--max-cache-vectors",
+        help="optional: per model, cap of the cached vectors, as --max-cache-mb, default: 0 (no"
+             " cap)",
+        default=0, type=int)
+parser.add_argument("--max-shard-mb",
+        help="optional: size cap (MiB) of a cache file, a full one is sealed & its shard continues"
+             " in a new file, default: 0 (no cap)",
+        default=0, type=float)
+parser.add_argument("--metrics",
+        action="store_true",
+        help="optional: export Prometheus metrics of all workers on '/metrics' (needs"
+             " prometheus_client)")
 parser.add_argument("-m", "--model",
         help=f"optional: start all workers with this model, default: '{DEFAULT_MODEL}'",
         default=DEFAULT_MODEL)
 parser.add_argument("-p", "--port", help="optional: default port: 8009", default=8009, type=int)
+parser.add_argument("-r", "--recovery",
+        choices=["full", "tail", "off"],
+        help="optional: start-up recovery of the caches & indexes, 'full' also drops index rows"
+             " pointing past the end of the cache, 'tail' only truncates torn vectors (& replays"
+             " the write-ahead logs), default: 'full'",
+        default="full")
+parser.add_argument("--search-index",
+        action="store_true",
+        help="optional: keep a nearest neighbour index of each model's cached embeddings for"
+             " '/search', built (or retrained) @ start-up & updated as documents are cached")
+parser.add_argument("--store-documents",
+        action="store_true",
+        help="optional: store the text of the documents computed, so that '/search' can return"
+             " the documents found, not only their digests")
+parser.add_argument("--stub-model",
+        action="store_true",
+        help="optional: don't load the models (nor torch), compute deterministic fake embeddings"
+             " instead, e.g. to benchmark the cache & index paths, see benchmark.py")
+parser.add_argument("--stub-encode-ms",
+        help="optional: with --stub-model, simulated inference time (ms) per call to the model,"
+             " default: 0",
+        default=0, type=float)
 parser.add_argument("-t", "--db-type",
-        choices=["duckdb", "leveldb", "sqlite"],
+        choices=["duckdb", "hashtable", "leveldb", "sqlite"],
         help="optional: database type for all workers & models, default: 'sqlite'",
         default="sqlite")
+parser.add_argument("--track-access",
+        action="store_true",
+        help="optional: keep per model stats of when & how often each cached document is used,"
+             " for --eviction-policy & the eviction options of compactCache.py")
+parser.add_argument("--write-ahead",
+        action="store_true",
+        help="optional: log the digests of cached vectors before writing them, so that start-up"
+             " recovery can index those whose index rows were lost in a crash")
 parser.add_argument("-w", "--workers",
         help="optional: number of workers, more than 1 implies 'production' mode (no hot reload),"
              " default: 1",
         default=1, type=int)
 args = parser.parse_args()
+if (args.max_cache_mb > 0 or args.max_cache_vectors > 0) and args.max_shard_mb <= 0:
+    parser.error("--max-cache-mb & --max-cache-vectors need --max-shard-mb: the cache is capped"
+                 " by retiring whole sealed cache files")
+
 
+import metrics
+import pyarrow as pa
+import searchIndex
 
+from batchScheduler import BatchScheduler
+from cacheFile import CacheFile
+from cacheShards import CacheShards
 from databaseCommitProcess import DatabaseCommitProcess as dbcp
 from embeddingService import ACQUIRE_LOCK_TIMEOUT, EmbeddingService
+from model import encode_in_process, encode_tokens_in_process
+from recoverCache import recover
+from requestCoalescer import RECLAIM
 
+if args.metrics:    # in every worker, before any of its samples
+    metrics.enable(clear=__name__ == "__main__")
 loglevel = getattr(logging, args.log_level.upper())
 logging.basicConfig(format="%(asctime)s %(message)s", level=loglevel, stream=stderr)
 models_cfg = EmbeddingService.get_models_cfg(args.data_dir)
 supported_models = models_cfg.keys()
 es = None # uninitialized embeddingService
+schedulers = {} # micro-batching of cache misses, keyed on model name
+encoders = {}   # blocking batch encode functions run in encode_executor, keyed on model name
+token_encoders = {}     # same for token (word) embeddings
+encode_executor = None  # model inference, off the event loop
+io_executor = None      # index lookups & cache file reads, off the event loop
+claim_executor = None   # waits on documents claimed by other workers, apart from the lookups
 
 # -----------------------------------------------------------------------------
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> None:
     "worker initialization and cleanup (only w/ 'graceful' shutdown), requests handled @ 'yield'"
-    global args, es, supported_models
+    global args, claim_executor, encode_executor, encoders, es, io_executor, schedulers
+    global supported_models, token_encoders
     my_pid = getpid()
     logging.info(f"initializing worker {my_pid}, default model: '{args.model}'")
 
-    lawk = FileLock(dbcp.WORKER_PIDS_LOCK, timeout = ACQUIRE_LOCK_TIMEOUT)
-    try:
-        lawk.acquire()
-    except Timeout:
-        logging.error(f"worker {my_pid}: acquire WORKER_PIDS_LOCK timed-out after "
-                f"{ACQUIRE_LOCK_TIMEOUT}s")
+    if not dbcp.register_worker(my_pid):
         return # TODO: what else should be done?
-    with open(dbcp.WORKER_PIDS_FILE, "a") as wfp:
-        print(my_pid, file=wfp)
-    lawk.release()
     es = EmbeddingService(args)
+
+    io_executor = ThreadPoolExecutor(args.io_workers, thread_name_prefix="io")
+    if args.coalesce_across_workers:
+        claim_executor = ThreadPoolExecutor(args.io_workers, thread_name_prefix="claim")
+    # a process would load the transformer, the stub model is always run in threads
+    encode_in_processes = args.encode_executor == "process" and not args.stub_model
+    if encode_in_processes:
+        # "spawn" since forking a process that already runs threads & an event loop is unsafe
+        encode_executor = ProcessPoolExecutor(args.encode_workers, mp_context=get_context("spawn"))
+    else:
+        encode_executor = ThreadPoolExecutor(args.encode_workers, thread_name_prefix="encode")
+    for name, model in es.models.items():
+        if encode_in_processes:
+            encoders[name] = partial(encode_in_process, name)
+            token_encoders[name] = partial(encode_tokens_in_process, name)
+        else:
+            encoders[name] = model.compute_embeddings_batch
+            token_encoders[name] = model.compute_token_embeddings_batch
+        schedulers[name] = BatchScheduler(encoders[name], args.max_batch_size,
+                                          args.max_batch_wait_ms, encode_executor, name,
+                                          args.encode_workers)
     yield
+    for scheduler in schedulers.values():
+        await scheduler.close()
+    encode_executor.shutdown(cancel_futures=True)
+    io_executor.shutdown(cancel_futures=True)
+    if claim_executor is not None:
+        claim_executor.shutdown(cancel_futures=True)
 
 # -----------------------------------------------------------------------------
 
@@ -93,6 +237,282 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# -----------------------------------------------------------------------------
+def check_params(model_name: str, emb_type: str, dtype: str = "float32") -> None:
+    "raises HTTPException for query parameters which can't be served"
+    global supported_models
+    if model_name not in supported_models:
+        raise HTTPException(status_code=422,
+                        detail=f'model_name "{model_name}" not found in list of supported models')
+    if dtype not in RESPONSE_DTYPES:
+        raise HTTPException(status_code=422,
+                        detail=f'dtype must be one of {{"float32","float16","stored"}}, got: '
+                               f'"{dtype}"')
+    if emb_type not in ("sentence", "word"):
+        raise HTTPException(status_code=422,
+                        detail=f'emb_type must be one of {{"sentence","word"}}, got: "{emb_type}"')
+
+# -----------------------------------------------------------------------------
+def get_response_format(accept: str | None) -> str:
+    """
+    the format (see RESPONSE_FORMATS) of the Accept header's most preferred media type which is
+    supported, raw without an Accept header. HTTPException 406 if none is
+    """
+    if not accept:
+        return "raw"
+    response_format, best_q = None, 0.0
+    for media_range in accept.split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        media_type = media_type.lower()
+        accepted = RESPONSE_FORMATS.get(media_type,
+                                        "raw" if media_type in ("*/*", "application/*") else None)
+        if accepted is not None and q > best_q:    # ties: the 1st listed
+            response_format, best_q = accepted, q
+    if response_format is None:
+        raise HTTPException(status_code=406, detail=f"Accept one of {list(RESPONSE_FORMATS)}")
+    return response_format
+
+def encode_response(vectors: np.ndarray, cache: CacheShards | CacheFile, dtype: str
+) -> tuple[np.ndarray, str]:
+    """
+    float32 vectors (1 or a matrix) -> (the vectors in the response dtype, its name). dtype
+    "stored": the model's storage dtype (see models.txt), for int8 each vector is a float32
+    scale followed by dim int8 values (a structured array)
+    """
+    if dtype == "float16":
+        return vectors.astype("<f2"), dtype
+    if dtype == "stored":
+        encoded = cache.encode(vectors)
+        return encoded[0] if vectors.ndim == 1 else encoded, cache.storage_dtype
+    return vectors, dtype
+
+def npy_content(vectors: np.ndarray) -> bytes:
+    "vectors as a .npy file, the array's bytes copied once (after the header)"
+    header = BytesIO()
+    np.lib.format.write_array_header_1_0(header, np.lib.format.header_data_from_array_1_0(vectors))
+    return b"".join((header.getvalue(), memoryview(np.ascontiguousarray(vectors))))
+
+def arrow_columns(vectors: np.ndarray, dimension: int) -> dict[str, pa.Array]:
+    "n encoded vectors -> Arrow columns of n fixed size lists (& n int8 scales), no copy"
+    if vectors.dtype.names is None:
+        return {"embedding": pa.FixedSizeListArray.from_arrays(pa.array(vectors.reshape(-1)),
+                                                               dimension)}
+    return {"scale": pa.array(vectors["scale"].reshape(-1)),
+            "embedding": pa.FixedSizeListArray.from_arrays(
+                    pa.array(vectors["values"].reshape(-1)), dimension)}
+
+def arrow_content(columns: dict[str, pa.Array], dtype: str) -> bytes:
+    "an Arrow IPC stream of 1 record batch, the dtype in its schema's metadata"
+    batch = pa.RecordBatch.from_pydict(columns, metadata={"dtype": dtype})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+def embeddings_response(embeddings: np.ndarray, model_name: str, dtype: str,
+                        response_format: str = "raw") -> Response:
+    """
+    the embeddings (1 vector or a (n_documents, dim) matrix) in the response dtype (see
+    encode_response, named in the X-Embedding-Dtype header, the dimension in
+    X-Embedding-Dimension) & format: raw: the vectors' bytes, npy: a .npy file, arrow: an
+    Arrow IPC stream of 1 row per document, column "embedding" (& "scale" for int8)
+    """
+    global es
+    cache = es.cache_files[model_name]
+    vectors, dtype = encode_response(embeddings, cache, dtype)
+    if response_format == "npy":
+        content = npy_content(vectors)
+    elif response_format == "arrow":
+        content = arrow_content(arrow_columns(vectors, cache.embedding_dimension), dtype)
+    else:
+        content = vectors.tobytes()
+    return Response(content=content, media_type=get_media_type(response_format),
+                    headers={"X-Embedding-Dtype": dtype,
+                             "X-Embedding-Dimension": str(cache.embedding_dimension)})
+
+def token_embeddings_response(matrices: list[np.ndarray], model_name: str, dtype: str,
+                              response_format: str = "raw") -> Response:
+    """
+    emb_type=word: the documents' token embeddings as 1 contiguous (n_tokens, dim) matrix (raw,
+    npy), the documents' numbers of tokens (their rows, in order) in the X-Token-Counts header,
+    comma separated. arrow: 1 row per document, a list of its tokens' vectors. dim
+    (X-Embedding-Dimension) is the transformer's, it can differ from the sentence embeddings'.
+    dtype as in embeddings_response
+    """
+    global es
+    token_cache = es.token_caches[model_name]
+    vectors = (np.concatenate(matrices) if len(matrices) else
+               np.empty((0, token_cache.embedding_dimension), dtype=np.float32))
+    vectors, dtype = encode_response(vectors, token_cache.vectors, dtype)
+    if response_format == "npy":
+        content = npy_content(vectors)
+    elif response_format == "arrow":
+        offsets = pa.array(np.concatenate([[0], np.cumsum([len(matrix) for matrix in matrices],
+                                                           dtype=np.int32)]), type=pa.int32())
+        columns = arrow_columns(vectors, token_cache.embedding_dimension)
+        content = arrow_content({name: pa.ListArray.from_arrays(offsets, column)
+                                 for name, column in columns.items()}, dtype)
+    else:
+        content = vectors.tobytes()
+    return Response(content=content, media_type=get_media_type(response_format),
+                    headers={"X-Embedding-Dtype": dtype,
+                             "X-Embedding-Dimension": str(token_cache.embedding_dimension),
+                             "X-Token-Counts": ",".join(str(len(matrix)) for matrix in matrices)})
+
+def get_media_type(response_format: str) -> str:
+    return next(media_type for media_type, media_format in RESPONSE_FORMATS.items()
+                if media_format == response_format)
+
+# -----------------------------------------------------------------------------
+async def get_token_embeddings(documents: list[str], model_name: str, read_cache: bool
+) -> tuple[list[np.ndarray], list]:
+    """
+    emb_type=word: cached token embeddings are read, misses computed in 1 call. Returns each
+    document's (n_tokens, dim) matrix & the writes to run for the misses: (function, args)
+    """
+    global encode_executor, es, io_executor, token_encoders
+    loop = asyncio.get_running_loop()
+    matrices, miss_rows = await loop.run_in_executor(
+            io_executor, es.lookup_tokens_batch, documents, model_name, read_cache)
+    writes = []
+    if len(miss_rows):
+        metrics.observe_batch(model_name, "encode", len(miss_rows))
+        started = perf_counter()
+        computed = await loop.run_in_executor(encode_executor, token_encoders[model_name],
+                EmbeddingService.get_miss_documents(documents, miss_rows))
+        metrics.observe_stage(model_name, "encode", started)
+        writes.append((es.write_token_embeddings,
+                       es.fill_token_misses(model_name, matrices, miss_rows, computed)))
+    return matrices, writes
+
+async def embed_words(documents: list[str], background_tasks: BackgroundTasks, model_name: str,
+                      read_cache: bool, write_cache: bool, dtype: str, response_format: str
+) -> Response:
+    "emb_type=word of '/' & '/batch'"
+    matrices, writes = await get_token_embeddings(documents, model_name, read_cache)
+    for write, write_args in writes if write_cache else []:
+        background_tasks.add_task(write, *write_args)
+    return token_embeddings_response(matrices, model_name, dtype, response_format)
+
+# -----------------------------------------------------------------------------
+async def get_embeddings_batch(documents: list[str], model_name: str, read_cache: bool,
+                               write_cache: bool) -> tuple[np.ndarray, list]:
+    """
+    all documents are looked-up in the cache in 1 pass & only the misses are computed, with a
+    single batched call to the model. Returns the (n_documents, dim) matrix & the writes to run
+    for the misses: (function, args). With --coalesce-across-workers, misses claimed by other
+    workers are waited for (only if this worker will write the others)
+    """
+    global args, claim_executor, encode_executor, encoders, es, io_executor
+    loop = asyncio.get_running_loop()
+    message, miss_rows = await loop.run_in_executor(
+            io_executor, es.lookup_embeddings_batch, documents, model_name, read_cache)
+    owned, in_flight = es.claim_misses(model_name, miss_rows)
+    across_workers = read_cache and write_cache and args.coalesce_across_workers
+    writes = []
+    if len(owned):
+        try:
+            if across_workers:
+                owned = await loop.run_in_executor(claim_executor,
+                                                   es.claim_misses_across_workers, model_name,
+                                                   message, owned)
+            miss_documents = EmbeddingService.get_miss_documents(documents, owned)
+            if len(owned):
+                metrics.observe_batch(model_name, "encode", len(miss_documents))
+                started = perf_counter()
+                computed = await loop.run_in_executor(encode_executor, encoders[model_name],
+                                                      miss_documents)
+                metrics.observe_stage(model_name, "encode", started)
+        except BaseException as e:
+            if across_workers:
+                es.models[model_name].release(list(owned))
+            es.fail_misses(model_name, owned, e)
+            raise
+    if len(owned):
+        writes.append((es.write_embeddings_batch,
+                       es.fill_misses(model_name, message, owned, computed)))
+        writes.append((es.write_documents, [list(owned), miss_documents, model_name]))
+    reclaimed = {}  # misses whose owners were cancelled, claimed again
+    for document_hash, (rows, future) in in_flight.items():
+        result = await asyncio.wrap_future(future)
+        if result is RECLAIM:
+            reclaimed[document_hash] = rows
+        else:
+            message[rows] = result
+    if len(reclaimed):
+        computed, reclaimed_writes = await get_embeddings_batch(
+                EmbeddingService.get_miss_documents(documents, reclaimed), model_name,
+                read_cache, write_cache)
+        for rows, embedding in zip(reclaimed.values(), computed):
+            message[rows] = embedding
+        writes.extend(reclaimed_writes)
+    return message, writes
+
+# -----------------------------------------------------------------------------
+async def compute_miss(document: str, document_hash: bytes, model_name: str, read_cache: bool,
+                       write_cache: bool):
+    """
+    returns (embeddings, True) if computed by this request, or (embeddings, False) if they were
+    computed by another request (in-flight in this worker, or in another worker with
+    --coalesce-across-workers, only if this request writes what it computes), which also
+    writes them
+    """
+    global args, claim_executor, es, schedulers
+    future, owner = es.claim(document_hash, model_name)
+    if not owner:
+        message = await asyncio.wrap_future(future)
+        if message is not RECLAIM:
+            return message, False
+        # its owner was cancelled: claimed again (& computed, unless another request was 1st)
+        return await compute_miss(document, document_hash, model_name, read_cache, write_cache)
+    across_workers = read_cache and write_cache and args.coalesce_across_workers
+    try:
+        message = None
+        if read_cache:
+            # published between this request's cache miss & its claim
+            message = es.models[model_name].hot_cache.get(document_hash)
+            if message is None and across_workers:
+                message = (await asyncio.get_running_loop().run_in_executor(
+                        claim_executor, es.claim_across_workers, [document_hash], model_name)
+                           ).get(document_hash)
+        computed = message is None
+        if computed:
+            message = await schedulers[model_name].submit(document)
+    except BaseException as e:
+        if across_workers:
+            es.models[model_name].release([document_hash])
+        es.fail(document_hash, model_name, e)
+        raise
+    es.publish(document_hash, model_name, message)
+    return message, computed
+
+# -----------------------------------------------------------------------------
+async def get_document_embeddings(document: str, document_hash: bytes, model_name: str,
+                                  read_cache: bool, write_cache: bool):
+    "(embeddings, True if computed by this request & so to be written), see compute_miss"
+    global es, io_executor
+    message = None
+    if read_cache:
+        # hot hits are served right away, others keep being served while encodes are in flight
+        message = es.models[model_name].hot_cache.get(document_hash)
+        if message is None:
+            message = await asyncio.get_running_loop().run_in_executor(
+                    io_executor, es.get_cached_embeddings, document_hash, model_name, False)
+        else:
+            es.models[model_name].touch([document_hash])
+        metrics.count_lookups(model_name, int(message is not None), int(message is None))
+    if message is None:
+        return await compute_miss(document, document_hash, model_name, read_cache, write_cache)
+    return message, False
+
 # -----------------------------------------------------------------------------
 @app.post("/")
 async def embed(
@@ -101,32 +521,261 @@ async def embed(
         model_name: str = args.model,
         read_cache: bool = True,
         emb_type: str = "sentence",
-        write_cache: bool = True
+        write_cache: bool = True,
+        dtype: str = "float32",
+        accept: Annotated[str | None, Header()] = None
 ) -> Response:
     """
     takes 1 www-x-form-urlencoded field, "document" and returns an embedding.
     takes several optional query parameters:
     * model_name: other than default or from command-line arg
     * read_cache: 0 or 1, check cache for embedding, compute on miss
-    * emb_type: "sentence" or "word" (word not yet supported)
+    * emb_type: "sentence" or "word": the embeddings of each token, see
+      token_embeddings_response
     * write_cache: cache computed emb if not already cached
+    * dtype: "float32" (default), "float16" or "stored": in the model's storage dtype, e.g. int8
+      (see the X-Embedding-Dtype response header)
+    the Accept header picks the response's format, see embeddings_response: the vector's bytes
+    (application/octet-stream, default), a .npy file (application/x-npy) or an Arrow IPC stream
+    (application/vnd.apache.arrow.stream)
     emb response sent as soon as it's available, then if write_cache is true, writes cache in BG
+    cache misses of concurrent requests are encoded together (see --max-batch-* args), identical
+    documents in flight are computed once
     """
-    global es, supported_models
-    if model_name not in supported_models:
+    global es
+    check_params(model_name, emb_type, dtype)
+    response_format = get_response_format(accept)
+    if emb_type == "word":
+        return await embed_words([document], background_tasks, model_name, read_cache,
+                                 write_cache, dtype, response_format)
+
+    started = perf_counter()
+    document_hash = EmbeddingService.get_digest(document)
+    metrics.observe_stage(model_name, "hash", started)
+    message, computed = await get_document_embeddings(document, document_hash, model_name,
+                                                      read_cache, write_cache)
+    if write_cache and computed:
+        background_tasks.add_task(es.write_embeddings, message, document_hash,
+                                  es.models[model_name])
+        background_tasks.add_task(es.write_documents, [document_hash], [document], model_name)
+    return embeddings_response(message, model_name, dtype, response_format)
+
+# -----------------------------------------------------------------------------
+@app.post("/batch")
+async def embed_batch(
+        documents: Annotated[list[str], Form()],
+        background_tasks: BackgroundTasks,
+        model_name: str = args.model,
+        read_cache: bool = True,
+        emb_type: str = "sentence",
+        write_cache: bool = True,
+        dtype: str = "float32",
+        accept: Annotated[str | None, Header()] = None
+) -> Response:
+    """
+    takes 1 or more www-x-form-urlencoded "documents" fields & returns their embeddings as 1
+    contiguous (n_documents, dim) float32 matrix, rows in the same order as the fields.
+    takes the same optional query parameters & Accept header as "/". All documents are
+    looked-up in the cache in 1 pass and only the misses are computed, with a single batched
+    call to the model.
+    emb_type=word: all the documents' token embeddings, 1 (n_tokens, dim) matrix
+    """
+    check_params(model_name, emb_type, dtype)
+    response_format = get_response_format(accept)
+    if emb_type == "word":
+        return await embed_words(documents, background_tasks, model_name, read_cache,
+                                 write_cache, dtype, response_format)
+
+    message, writes = await get_embeddings_batch(documents, model_name, read_cache,
+                                                 write_cache)
+    for write, write_args in writes if write_cache else []:
+        background_tasks.add_task(write, *write_args)
+    return embeddings_response(message, model_name, dtype, response_format)
+
+# -----------------------------------------------------------------------------
+@app.post("/search")
+async def search(
+        background_tasks: BackgroundTasks,
+        document: Annotated[str | None, Form()] = None,
+        vector: Annotated[list[float], Form()] = [],
+        model_name: str = args.model,
+        k: int = 10,
+        metric: str = "cosine",
+        nprobe: int = 8,
+        documents: bool = False
+) -> dict:
+    """
+    takes 1 www-x-form-urlencoded field, either "document" (embedded like "/", & cached) or
+    "vector" (repeated, 1 per dimension) and returns the k most similar cached documents, best
+    1st: {"results": [{"digest": sha256 hex, "score": float, "document": str}, ...]}.
+    takes several optional query parameters:
+    * model_name: other than default or from command-line arg
+    * k: number of results, default: 10
+    * metric: "cosine" (default) or "dot" (inner product)
+    * nprobe: number of the index's lists searched, more is slower & more exact, default: 8
+    * documents: 0 or 1, include the documents' text (null unless stored, see --store-documents)
+    needs --search-index. Documents cached in the last few secs may not be found yet
+    """
+    global es, io_executor
+    check_params(model_name, "sentence")
+    if metric not in searchIndex.METRICS:
         raise HTTPException(status_code=422,
-                        detail=f'model_name "{model_name}" not found in list of supported models')
-    if emb_type != "sentence":
+                        detail=f'metric must be one of {{"cosine","dot"}}, got: "{metric}"')
+    if k < 1 or nprobe < 1:
+        raise HTTPException(status_code=422, detail="k & nprobe must be at least 1")
+    if (document is None) == (not len(vector)):
+        raise HTTPException(status_code=422, detail='takes either a "document" or a "vector"')
+    if model_name not in es.models:
+        raise HTTPException(status_code=404, detail=f'model "{model_name}" is not loaded')
+    # b4 the query is computed (& cached, & claimed from the other workers)
+    if model_name not in es.search_indexes and await asyncio.get_running_loop().run_in_executor(
+            io_executor, es.get_search_index, model_name) is None:
+        raise HTTPException(status_code=409, detail=f'model "{model_name}" has no search index,'
+                                                    " start the server with --search-index")
+
+    if document is not None:
+        document_hash = EmbeddingService.get_digest(document)
+        query, computed = await get_document_embeddings(document, document_hash, model_name, True,
+                                                            True)
+        if computed:
+            background_tasks.add_task(es.write_embeddings, query, document_hash,
+                                      es.models[model_name])
+            background_tasks.add_task(es.write_documents, [document_hash], [document],
+                                      model_name)
+    else:
+        query = np.asarray(vector, dtype=np.float32)
+        if len(query) != es.cache_files[model_name].embedding_dimension:
+            raise HTTPException(status_code=422, detail=f"vector must have "
+                                f"{es.cache_files[model_name].embedding_dimension} dimensions")
+    results = await asyncio.get_running_loop().run_in_executor(
+            io_executor, partial(es.search, query, model_name, k, metric, nprobe, documents))
+    return {"results": results}
+
+# -----------------------------------------------------------------------------
+class DuplexStreamingResponse(StreamingResponse):
+    """
+    a StreamingResponse which doesn't listen for the client's disconnect while it streams, that
+    would consume (& drop) the request's body, which '/stream' is still reading. A disconnect
+    ends the stream when reading the body fails instead
+    """
+    async def __call__(self, scope, receive, send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+async def read_lines(request: Request) -> AsyncIterator[list[str]]:
+    "the upload's newline-delimited documents, in batches of STREAM_BATCH_CNT"
+    batch, partial_line = [], b""
+    async for chunk in request.stream():
+        lines = (partial_line + chunk).split(b"\n")
+        partial_line = lines.pop()
+        # invalid utf-8 is replaced rather than failing the rest of the stream
+        batch.extend(line.rstrip(b"\r").decode("utf-8", errors="replace") for line in lines)
+        while len(batch) >= STREAM_BATCH_CNT:
+            yield batch[:STREAM_BATCH_CNT]
+            batch = batch[STREAM_BATCH_CNT:]
+    if len(partial_line):   # the last line has no newline
+        batch.append(partial_line.rstrip(b"\r").decode("utf-8", errors="replace"))
+    if len(batch):
+        yield batch
+
+def get_stream_cache(model_name: str, emb_type: str) -> CacheShards | CacheFile:
+    "the cache whose storage dtype & dimension '/stream' responses have"
+    global es
+    if emb_type == "word":
+        return es.token_caches[model_name].vectors
+    return es.cache_files[model_name]
+
+def stream_frames(embeddings: np.ndarray | list[np.ndarray], model_name: str, emb_type: str,
+                  dtype: str, stream_format: str) -> bytes:
+    "1 batch's embeddings (a matrix, or 1 matrix per document for emb_type=word) as frames"
+    if stream_format == "ndjson":
+        rows = (embeddings.tolist() if emb_type == "sentence" else
+                [matrix.tolist() for matrix in embeddings])
+        return "".join(json.dumps(row) + "\n" for row in rows).encode()
+    if dtype != "float32":
+        cache = get_stream_cache(model_name, emb_type)
+        embeddings = ([encode_response(matrix, cache, dtype)[0] for matrix in embeddings]
+                      if emb_type == "word" else encode_response(embeddings, cache, dtype)[0])
+    return b"".join(FRAME_NBYTES.pack(document_embeddings.nbytes)
+                    + document_embeddings.tobytes() for document_embeddings in embeddings)
+
+@app.post("/stream")
+async def embed_stream(
+        request: Request,
+        model_name: str = args.model,
+        read_cache: bool = True,
+        emb_type: str = "sentence",
+        write_cache: bool = True,
+        dtype: str = "float32",
+        stream_format: Annotated[str, Query(alias="format")] = "binary"
+) -> Response:
+    """
+    takes a (chunked) upload of newline-delimited documents, 1 per line (utf-8) & streams back
+    their embeddings in the same order while the upload is read: STREAM_BATCH_CNT lines are
+    looked-up & encoded together (as '/batch'), up to STREAM_PIPELINE_DEPTH batches @ once.
+    Memory doesn't depend on the upload's size, the upload is read only as fast as the results
+    are sent: clients must read the response while they upload (e.g. curl -X POST -T -), one
+    which sends the whole upload 1st stalls once the socket buffers are full.
+    takes the same optional query parameters as "/" and:
+    * format: "binary" (default): 1 frame per document, the length in bytes of its embeddings
+      (u32 little endian), then its embeddings as "/" (or its (n_tokens, dim) matrix for
+      emb_type=word). "ndjson": 1 JSON array of float32 values per line (of arrays for
+      emb_type=word)
+    """
+    global es, io_executor
+    check_params(model_name, emb_type, dtype)
+    if stream_format not in STREAM_FORMATS:
+        raise HTTPException(status_code=422, detail=f'format must be one of {{"binary","ndjson"}},'
+                                                    f' got: "{stream_format}"')
+    if stream_format == "ndjson" and dtype != "float32":
+        raise HTTPException(status_code=422, detail="format=ndjson only takes dtype=float32")
+    loop = asyncio.get_running_loop()
+
+    async def process(documents: list[str]) -> np.ndarray | list[np.ndarray]:
         if emb_type == "word":
-            raise HTTPException(status_code=501, detail="word embeddings not yet implemented")
-        raise HTTPException(status_code=422,
-                        detail='emb_type must be one of {"sentence","word"}, got: "{emb_type}"')
+            embeddings, writes = await get_token_embeddings(documents, model_name, read_cache)
+        else:
+            embeddings, writes = await get_embeddings_batch(documents, model_name, read_cache,
+                                                            write_cache)
+        # awaited, so that batches still being written count against the pipeline's depth
+        for write, write_args in writes if write_cache else []:
+            await loop.run_in_executor(io_executor, partial(write, *write_args))
+        return embeddings
 
-    message, to_write = es.get_embeddings(document, model_name, read_cache)
+    async def stream() -> AsyncIterator[bytes]:
+        in_flight = deque()     # tasks of the batches read, in upload order
+        try:
+            async for documents in read_lines(request):
+                in_flight.append(asyncio.create_task(process(documents)))
+                if len(in_flight) >= STREAM_PIPELINE_DEPTH:
+                    yield stream_frames(await in_flight.popleft(), model_name, emb_type, dtype,
+                                        stream_format)
+            while len(in_flight):
+                yield stream_frames(await in_flight.popleft(), model_name, emb_type, dtype,
+                                    stream_format)
+        except ClientDisconnect:
+            logging.warning(f"/stream: client disconnected, dropping {len(in_flight)} batches")
+        finally:
+            for task in in_flight:
+                task.cancel()
 
-    if write_cache and isinstance(to_write, list):
-        background_tasks.add_task(es.write_embeddings, *to_write)
-    return Response(content=message.tobytes(), media_type="application/octet-stream")
+    cache = get_stream_cache(model_name, emb_type)
+    return DuplexStreamingResponse(
+            stream(),
+            media_type="application/octet-stream" if stream_format == "binary" else
+                       "application/x-ndjson",
+            headers={"X-Embedding-Dtype": cache.storage_dtype if dtype == "stored" else dtype,
+                     "X-Embedding-Dimension": str(cache.embedding_dimension)})
+
+# -----------------------------------------------------------------------------
+@app.get("/metrics")
+def get_metrics() -> Response:
+    "Prometheus metrics of all workers & the database commit process, needs --metrics"
+    if not args.metrics:
+        raise HTTPException(status_code=404, detail="start the server with --metrics")
+    content, media_type = metrics.generate()
+    return Response(content=content, media_type=media_type)
 
 # -----------------------------------------------------------------------------
 def remove_lock_files(stale: bool = False) -> None:
@@ -150,6 +799,16 @@ if __name__ == "__main__":
 
     EmbeddingService.setup_models_dirs(models_cfg)
     remove_lock_files(stale=True)
+    for cfg in models_cfg.values():
+        report = recover(cfg["data_dirpath"], args.db_type, cfg["embedding_dimension"],
+                         args.recovery)
+        if any(report.values()):
+            logging.warning(f'recovered "{cfg["data_dirpath"]}": {report}')
+        if args.search_index and cfg["autoload"]:
+            searchIndex.prepare(cfg["data_dirpath"], args.db_type, CacheShards(
+                    cfg["data_dirpath"], cfg["embedding_dimension"],
+                    path.join(EmbeddingService.get_lock_dirpath(), "search.lock"),
+                    ACQUIRE_LOCK_TIMEOUT, cfg["storage_dtype"]))
 
     dbc = dbcp(args)
     dbc.start()
@@ -0,0 +1,210 @@
+"""
+channel between a worker & the DatabaseCommitProcess: lock-free single-producer/single-consumer
+ring buffers of fixed-size binary records on raw shared memory, plus "doorbells" (named pipes)
+for event-driven wake-ups, so neither side sleep-polls.
+A full ring is backpressure: the producer blocks until the consumer frees slots, nothing is lost.
+Memory ordering relies on the record being stored before the tail index that publishes it, which
+holds for CPython on x86-64 (TSO), head & tail are 8-byte aligned so each is stored atomically
+"""
+import logging
+import os
+import select
+
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from struct import Struct
+from time import monotonic, perf_counter, sleep
+
+import metrics
+
+# digest (sha256), offset, request sequence number (to match replies), kind, model id
+RECORD = Struct("<32sqIBxH")
+U64 = Struct("<Q")
+CAPACITY_POS = 0    # header fields each on their own cache line
+HEAD_POS = 64       # next record to pop, written by the consumer only
+TAIL_POS = 128      # next record to push, written by the producer only
+WAITING_POS = 192   # producer is blocked on a full ring (consumer should ring the doorbell)
+RECORDS_POS = 256
+ATTACH_TIMEOUT = 10 # secs
+ATTACH_POLL_INTERVAL = 0.1
+
+
+class ShmRingBuffer:
+    def __init__(self, name: str, capacity: int = 0, create: bool = False):
+        "create: allocates a ring of capacity records, else attaches to existing ring name"
+        self.name = name
+        if create:
+            size = RECORDS_POS + capacity * RECORD.size
+            try:
+                self.shm = SharedMemory(name, create=True, size=size)
+            except FileExistsError:     # left by a crash
+                SharedMemory(name).unlink()
+                self.shm = SharedMemory(name, create=True, size=size)
+            self.shm.buf[:RECORDS_POS] = bytes(RECORDS_POS)
+            U64.pack_into(self.shm.buf, CAPACITY_POS, capacity)   # last: marks ring as ready
+        else:
+            self.shm = SharedMemory(name)
+            # the creator unlinks the ring, don't let this process' resource tracker do it too
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+            deadline = monotonic() + ATTACH_TIMEOUT
+            while not U64.unpack_from(self.shm.buf, CAPACITY_POS)[0]:
+                if monotonic() > deadline:
+                    raise TimeoutError(f'ring "{name}" was not initialized')
+                sleep(ATTACH_POLL_INTERVAL)
+        self.capacity = U64.unpack_from(self.shm.buf, CAPACITY_POS)[0]
+        self.is_creator = create
+
+    # -------------------------------------------------------------------------
+    def __len__(self) -> int:
+        "number of records waiting to be popped"
+        buf = self.shm.buf
+        return U64.unpack_from(buf, TAIL_POS)[0] - U64.unpack_from(buf, HEAD_POS)[0]
+
+    @property
+    def producer_waiting(self) -> bool:
+        return U64.unpack_from(self.shm.buf, WAITING_POS)[0] != 0
+
+    @producer_waiting.setter
+    def producer_waiting(self, waiting: bool) -> None:
+        U64.pack_into(self.shm.buf, WAITING_POS, int(waiting))
+
+    # -------------------------------------------------------------------------
+    def push(self, records: list[tuple]) -> int:
+        "producer: stores as many of records as there is room for, returns how many"
+        buf = self.shm.buf
+        tail = U64.unpack_from(buf, TAIL_POS)[0]
+        cnt = min(len(records), self.capacity - (tail - U64.unpack_from(buf, HEAD_POS)[0]))
+        for i in range(cnt):
+            RECORD.pack_into(buf, RECORDS_POS + ((tail + i) % self.capacity) * RECORD.size,
+                             *records[i])
+        if cnt:
+            U64.pack_into(buf, TAIL_POS, tail + cnt)    # publishes the records
+        return cnt
+
+    def pop_all(self) -> list[tuple]:
+        "consumer: removes & returns all records waiting in the ring, oldest 1st"
+        buf = self.shm.buf
+        head = U64.unpack_from(buf, HEAD_POS)[0]
+        tail = U64.unpack_from(buf, TAIL_POS)[0]
+        records = [RECORD.unpack_from(buf, RECORDS_POS + (i % self.capacity) * RECORD.size)
+                   for i in range(head, tail)]
+        if len(records):
+            U64.pack_into(buf, HEAD_POS, tail)  # frees the slots
+        return records
+
+    # -------------------------------------------------------------------------
+    def close(self) -> None:
+        self.shm.close()
+        if self.is_creator:
+            self.shm.unlink()
+
+
+class Doorbell:
+    """
+    wake-up signal between processes over a named pipe (FIFO): ring() never blocks, wait()
+    blocks (in select, no CPU) until the bell was rung or timeout. Spurious wake-ups are
+    possible, waiters must re-check their condition
+    """
+    def __init__(self, path: str, create: bool = False):
+        self.path = path
+        self.is_creator = create
+        if create:
+            if os.path.exists(path):
+                os.remove(path)     # left by a crash
+            os.mkfifo(path)
+        # O_RDWR: opening doesn't block waiting for the other end & the FIFO never reports EOF
+        self.fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+    def ring(self) -> None:
+        try:
+            os.write(self.fd, b"\0")
+        except BlockingIOError:
+            pass    # pipe is full of rings already, the waiter will wake-up anyway
+
+    def wait(self, timeout: float | None = None) -> bool:
+        "returns False on timeout"
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not len(readable):
+            return False
+        try:
+            while len(os.read(self.fd, 4096)):
+                pass
+        except BlockingIOError:
+            pass    # drained
+        return True
+
+    def close(self) -> None:
+        os.close(self.fd)
+        if self.is_creator:
+            os.remove(self.path)
+
+
+class ShmChannel:
+    """
+    a worker's 2-way link to the DatabaseCommitProcess (DCP): requests (worker -> DCP) & replies
+    (DCP -> worker) rings, each with a doorbell rung by its producer, & a "space" doorbell rung
+    by the DCP when it frees request slots for a worker which is blocked on a full ring
+    """
+    FIFO_DIRPATH = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+    FULL_RECHECK_SECS = 0.1     # a producer blocked on a full ring re-checks at least this often
+
+    def __init__(self, name: str, capacity: int = 0, create: bool = False):
+        # bells 1st, so that they exist once a worker can attach to the rings
+        fifo_path = os.path.join(self.FIFO_DIRPATH, name)
+        self.request_bell = Doorbell(fifo_path + "_req.fifo", create)
+        self.reply_bell = Doorbell(fifo_path + "_rep.fifo", create)
+        self.space_bell = Doorbell(fifo_path + "_spc.fifo", create)
+        self.requests = ShmRingBuffer(name + "_req", capacity, create)
+        self.replies = ShmRingBuffer(name + "_rep", capacity, create)
+        self.backpressure_waits = 0     # times this process found a ring full
+
+    # -------------------------------------------------------------------------
+    def send_requests(self, records: list[tuple]) -> None:
+        "worker: blocks while the requests ring is full"
+        self._send(self.requests, self.request_bell, self.space_bell, records)
+
+    def pop_requests(self) -> list[tuple]:
+        "DCP"
+        records = self.requests.pop_all()
+        if len(records) and self.requests.producer_waiting:
+            self.space_bell.ring()
+        return records
+
+    def send_replies(self, records: list[tuple]) -> None:
+        "DCP: the worker drains replies as soon as they're rung, a full ring is short-lived"
+        self._send(self.replies, self.reply_bell, None, records)
+
+    # -------------------------------------------------------------------------
+    def _send(self, ring: ShmRingBuffer, bell: Doorbell, space_bell: Doorbell | None,
+              records: list[tuple]) -> None:
+        """
+        pushes all records to ring & rings bell. While ring is full, blocks on space_bell,
+        re-checking every FULL_RECHECK_SECS regardless (or only sleeps without a space_bell)
+        """
+        waited = False
+        while True:
+            cnt = ring.push(records)
+            if cnt:
+                bell.ring()
+                records = records[cnt:]
+            if not len(records):
+                return
+            if not waited:
+                logging.warning(f'ring "{ring.name}" is full, waiting for the consumer')
+                waited = True
+            self.backpressure_waits += 1
+            started = perf_counter()
+            ring.producer_waiting = True
+            if len(ring) >= ring.capacity:  # re-check once flagged, consumer may have just popped
+                if space_bell is None:
+                    sleep(self.FULL_RECHECK_SECS)
+                else:
+                    space_bell.wait(self.FULL_RECHECK_SECS)
+            ring.producer_waiting = False
+            metrics.add_ring_full(perf_counter() - started)
+
+    # -------------------------------------------------------------------------
+    def close(self) -> None:
+        for closeable in (self.requests, self.replies,
+                          self.request_bell, self.reply_bell, self.space_bell):
+            closeable.close()
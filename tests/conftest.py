@@ -0,0 +1,56 @@
+"the service's modules live in the repository's root, not in a package"
+import os
+import pytest
+import sys
+
+from time import monotonic, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODEL_NAME = "test/stub-model"
+DIMENSION = 8
+START_TIMEOUT = 20  # secs, for the database commit process
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    """
+    server.py's module with a running app: 1 stub model (no transformer) served by this process
+    as the only worker of its own database commit process, data in a temporary directory. Yields
+    (server module, fastapi TestClient)
+    """
+    from fastapi.testclient import TestClient
+
+    dirpath = tmp_path_factory.mktemp("server")
+    cwd, argv = os.getcwd(), sys.argv
+    os.chdir(dirpath)   # models.txt is read from the current directory
+    with open("models.txt", "w", encoding="utf-8") as f:
+        f.write(f"{MODEL_NAME} {DIMENSION} 1\n")
+    sys.argv = ["server.py", "--stub-model", "-m", MODEL_NAME, "-d", str(dirpath / "data"),
+                "--max-batch-wait-ms", "1", "--encode-workers", "4"]
+    import server
+    from databaseCommitProcess import DatabaseCommitProcess
+    from embeddingService import EmbeddingService
+
+    EmbeddingService.setup_models_dirs(server.models_cfg)
+    try:    # the commit process truncates the pids file, registering b4 that would be lost
+        os.remove(DatabaseCommitProcess.WORKER_PIDS_FILE)
+    except FileNotFoundError:
+        pass
+    commit_process = DatabaseCommitProcess(server.args)
+    commit_process.start()
+    deadline = monotonic() + START_TIMEOUT
+    while not os.path.exists(DatabaseCommitProcess.WORKER_PIDS_FILE):
+        assert commit_process.is_alive() and monotonic() < deadline
+        sleep(0.05)
+    try:
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            # the lifespan runs in the client's thread, Model can't install its signal handlers
+            monkeypatch.setattr("model.signal", lambda signum, handler: None)
+            with TestClient(server.app) as client:  # runs the lifespan: registers, starts app
+                yield server, client
+    finally:
+        commit_process.terminate()
+        commit_process.join(START_TIMEOUT)
+        os.chdir(cwd)
+        sys.argv = argv
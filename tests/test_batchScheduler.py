@@ -0,0 +1,110 @@
+import asyncio
+import numpy as np
+import pytest
+
+from batchScheduler import BatchScheduler
+
+DIMENSION = 4
+
+
+class Encoder:
+    "records its batches, the embeddings are full of the documents' numbers"
+    def __init__(self, fail: bool = False):
+        self.batches = []
+        self.fail = fail
+
+    def __call__(self, documents: list[str]) -> np.ndarray:
+        self.batches.append(documents)
+        if self.fail:
+            raise RuntimeError("encode failed")
+        return np.repeat(np.array(documents, dtype=np.float32)[:, None], DIMENSION, axis=1)
+
+async def submit_all(scheduler: BatchScheduler, documents: list[str]) -> list:
+    return await asyncio.gather(*(scheduler.submit(document) for document in documents),
+                                return_exceptions=True)
+
+# -----------------------------------------------------------------------------
+def test_batches_concurrent_documents():
+    encoder = Encoder()
+
+    async def main():
+        scheduler = BatchScheduler(encoder, max_batch_size=8, max_wait_ms=50)
+        embeddings = await submit_all(scheduler, ["1", "2", "3"])
+        await scheduler.close()
+        return embeddings
+
+    embeddings = asyncio.run(main())
+    assert encoder.batches == [["1", "2", "3"]]
+    assert [embedding.tolist() for embedding in embeddings] == [[i] * DIMENSION for i in (1, 2, 3)]
+
+def test_max_batch_size():
+    encoder = Encoder()
+
+    async def main():
+        scheduler = BatchScheduler(encoder, max_batch_size=2, max_wait_ms=50)
+        embeddings = await submit_all(scheduler, [str(i) for i in range(5)])
+        await scheduler.close()
+        return embeddings
+
+    embeddings = asyncio.run(main())
+    assert encoder.batches == [["0", "1"], ["2", "3"], ["4"]]
+    assert [float(embedding[0]) for embedding in embeddings] == [0, 1, 2, 3, 4]
+
+def test_max_wait():
+    "a lone document doesn't wait for a full batch longer than max_wait_ms"
+    encoder = Encoder()
+
+    async def main():
+        scheduler = BatchScheduler(encoder, max_batch_size=8, max_wait_ms=1)
+        embedding = await asyncio.wait_for(scheduler.submit("1"), 5)
+        await scheduler.close()
+        return embedding
+
+    assert asyncio.run(main()).tolist() == [1] * DIMENSION
+
+def test_encode_error():
+    "the batch's requests all get the exception, the next batches are encoded"
+    encoder = Encoder(fail=True)
+
+    async def main():
+        scheduler = BatchScheduler(encoder, max_batch_size=8, max_wait_ms=50)
+        results = await submit_all(scheduler, ["1", "2"])
+        encoder.fail = False
+        embedding = await scheduler.submit("3")
+        await scheduler.close()
+        return results, embedding
+
+    results, embedding = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert embedding.tolist() == [3] * DIMENSION
+
+def test_cancelled_request_not_encoded():
+    "a request cancelled while waiting for its batch (e.g. its client went away) is dropped"
+    encoder = Encoder()
+
+    async def main():
+        scheduler = BatchScheduler(encoder, max_batch_size=8, max_wait_ms=50)
+        tasks = [asyncio.create_task(scheduler.submit(str(i))) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks[1].cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        await scheduler.close()
+        return results
+
+    results = asyncio.run(main())
+    assert encoder.batches == [["0", "2"]]
+    assert isinstance(results[1], asyncio.CancelledError)
+
+def test_close_cancels_waiting_requests():
+    encoder = Encoder()
+
+    async def main():
+        scheduler = BatchScheduler(encoder, max_batch_size=8, max_wait_ms=10000)
+        task = asyncio.create_task(scheduler.submit("1"))
+        await asyncio.sleep(0.01)
+        await scheduler.close()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert encoder.batches == []
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from cacheFile import CacheFile, INT8_MAX
+
+DIMENSION = 8
+
+
+def open_cache_file(tmp_path, storage_dtype: str) -> CacheFile:
+    return CacheFile(str(tmp_path / "embeddings.bin"), DIMENSION, str(tmp_path / "cache.lock"), 1,
+                     storage_dtype)
+
+def get_embeddings(cnt: int) -> np.ndarray:
+    embeddings = np.random.default_rng(0).standard_normal((cnt, DIMENSION), dtype=np.float32)
+    embeddings[1] = 0   # int8: scale 0, stored as 1
+    return embeddings
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("storage_dtype, atol", [("float32", 0), ("float16", 2e-3),
+                                                 ("int8", None)])
+def test_encode_decode(tmp_path, storage_dtype, atol):
+    cache_file = open_cache_file(tmp_path, storage_dtype)
+    embeddings = get_embeddings(5)
+    decoded = cache_file.decode(cache_file.encode(embeddings))
+    assert decoded.dtype == np.float32 and decoded.shape == embeddings.shape
+    if atol is None:    # int8: off by at most half a step of the vector's scale
+        atol = np.abs(embeddings).max(axis=1, keepdims=True) / INT8_MAX / 2 + 1e-6
+    assert (np.abs(decoded - embeddings) <= atol).all()
+    assert not decoded[1].any()
+
+def test_int8_scales(tmp_path):
+    cache_file = open_cache_file(tmp_path, "int8")
+    records = cache_file.encode(get_embeddings(5))
+    assert records["scale"][1] == 1
+    assert (np.abs(records["values"]).max(axis=1)[[0, 2, 3, 4]] == INT8_MAX).all()
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("storage_dtype", ["float32", "float16", "int8"])
+def test_append_read(tmp_path, storage_dtype):
+    cache_file = open_cache_file(tmp_path, storage_dtype)
+    embeddings = get_embeddings(6)
+    expected = cache_file.decode(cache_file.encode(embeddings))
+    assert cache_file.append(cache_file.encode(embeddings[:2]).tobytes()) == 0
+    assert cache_file.append(cache_file.encode(embeddings[2:]).tobytes()) == \
+            2 * cache_file.vector_nbytes
+    offsets = [i * cache_file.vector_nbytes for i in (4, 1, 1, 0)]
+    assert np.array_equal(cache_file.read_many(offsets), expected[[4, 1, 1, 0]])
+    assert np.array_equal(cache_file.read(offsets[0]), expected[4])
+    assert np.array_equal(cache_file.read_rows(2, 3), expected[2:5])
+    assert cache_file.read_many([6 * cache_file.vector_nbytes]) is None    # past EOF
+    cache_file.close()
+
+@pytest.mark.parametrize("storage_dtype", ["float32", "float16", "int8"])
+def test_read_many_unaligned(tmp_path, storage_dtype):
+    "a file which doesn't start on a vector boundary, e.g. after a header"
+    cache_file = open_cache_file(tmp_path, storage_dtype)
+    embeddings = get_embeddings(3)
+    expected = cache_file.decode(cache_file.encode(embeddings))
+    cache_file.append(b"\1" * 3 + cache_file.encode(embeddings).tobytes())
+    offsets = [3 + i * cache_file.vector_nbytes for i in (2, 0, 1)]
+    assert np.array_equal(cache_file.read_many(offsets), expected[[2, 0, 1]])
+    assert np.array_equal(cache_file.read(offsets[0]), expected[2])
+    cache_file.close()
+
+def test_recorded_storage_dtype_wins(tmp_path):
+    cache_file = open_cache_file(tmp_path, "float16")
+    cache_file.append(cache_file.encode(get_embeddings(2)).tobytes())
+    cache_file.close()
+    assert open_cache_file(tmp_path, "int8").storage_dtype == "float16"
@@ -0,0 +1,228 @@
+import numpy as np
+import os
+import pytest
+
+import compactCache
+
+from accessStats import AccessStats
+from cacheFile import CacheFile
+from cacheShards import CacheShards
+from compactCache import compact, evict_files, finish_swap, open_index
+
+DIMENSION = 4
+VECTOR_NBYTES = 4 * DIMENSION   # float32
+FILE_VECTORS = 4    # per cache file, then the shard continues in a new one
+
+
+def digest(i: int) -> bytes:
+    return i.to_bytes(32, "little")
+
+def open_cache(dirpath) -> CacheShards:
+    return CacheShards(str(dirpath), DIMENSION, str(dirpath / "cache.lock"), 1,
+                       max_shard_nbytes=FILE_VECTORS * VECTOR_NBYTES)
+
+def cache_documents(cache: CacheShards, index, documents: list[int]) -> None:
+    "the documents' vectors are full of their numbers"
+    vectors = np.repeat(np.array(documents, dtype=np.float32)[:, None], DIMENSION, axis=1)
+    locations = cache.append(0, vectors)
+    index.add_rows([(digest(i), location) for i, location in zip(documents, locations)])
+    index.flush()
+
+def read_documents(cache: CacheShards, index) -> dict[int, float]:
+    "document -> the value its vector is full of"
+    documents = {}
+    for document_hash, location in index.iter_rows():
+        vector = cache.read(location)
+        assert (vector == vector[0]).all()
+        documents[int.from_bytes(document_hash, "little")] = float(vector[0])
+    return documents
+
+@pytest.fixture(params=["hashtable", "sqlite"])
+def db_type(request) -> str:
+    return request.param
+
+@pytest.fixture
+def model(tmp_path, db_type):
+    """
+    documents 1-6 in embeddings.bin, only 1, 3 & 5 indexed (the others' vectors are dead) & a
+    dangling row of document 7, past EOF. Yields the model's directory & document -> vector
+    """
+    dirpath = tmp_path / "model"
+    dirpath.mkdir()
+    cache_file = CacheFile(str(dirpath / "embeddings.bin"), DIMENSION,
+                           str(tmp_path / "cache.lock"), 1)
+    vectors = np.random.default_rng(0).standard_normal((6, DIMENSION), dtype=np.float32)
+    cache_file.append(vectors.tobytes())
+    index = open_index(db_type, str(dirpath), readonly=False)
+    index.add_rows([(digest(i), (i - 1) * VECTOR_NBYTES) for i in [1, 3, 5, 7]])
+    index.flush()
+    del index
+    yield dirpath, {i: vectors[i - 1] for i in range(1, 7)}
+
+def read_model(dirpath, db_type: str) -> dict[int, np.ndarray]:
+    "document -> vector, of all the index rows"
+    cache = CacheShards(str(dirpath), DIMENSION, str(dirpath.parent / "read.lock"), 1)
+    index = open_index(db_type, str(dirpath), readonly=True)
+    vectors = {int.from_bytes(document_hash, "little"): cache.read(location)
+               for document_hash, location in index.iter_rows()}
+    del index
+    return vectors
+
+@pytest.fixture
+def cached(tmp_path, db_type):
+    "documents 1-12 in files 0, 1 & 2 (the active one), 1 used last"
+    cache = open_cache(tmp_path)
+    index = open_index(db_type, str(tmp_path), readonly=False)
+    for start in range(1, 13, FILE_VECTORS):
+        cache_documents(cache, index, list(range(start, start + FILE_VECTORS)))
+    stats = AccessStats(str(tmp_path))
+    for i in range(1, 13):
+        stats.touch([digest(i)], now=100 + i)
+    stats.touch([digest(2)], now=200)
+    return cache, index, stats
+
+# -----------------------------------------------------------------------------
+def test_compact_keeps_live_vectors(model, db_type):
+    dirpath, vectors = model
+    (dirpath / "progress.json").write_text("{}")   # not rebuilt, carried over
+    report = compact(str(dirpath), db_type)
+    assert report == {"rows": 4, "dangling_rows": 1, "evicted_rows": 0, "vectors_before": 6,
+                      "vectors_after": 3, "nbytes_before": 6 * VECTOR_NBYTES,
+                      "nbytes_after": 3 * VECTOR_NBYTES}
+    compacted = read_model(dirpath, db_type)
+    assert sorted(compacted) == [1, 3, 5]
+    for i in [1, 3, 5]:
+        assert compacted[i].tobytes() == vectors[i].tobytes()
+    assert (dirpath / "progress.json").read_text() == "{}"
+    assert sorted(path.name for path in dirpath.parent.iterdir()) == ["cache.lock", "model"]
+
+def test_compact_dry_run(model, db_type):
+    dirpath, _ = model
+    before = sorted(os.listdir(dirpath))
+    report = compact(str(dirpath), db_type, dry_run=True)
+    assert report["vectors_after"] == 3 and report["nbytes_after"] == 3 * VECTOR_NBYTES
+    assert sorted(os.listdir(dirpath)) == before
+    assert os.path.getsize(dirpath / "embeddings.bin") == 6 * VECTOR_NBYTES
+
+def test_compact_converts_dtype(model, db_type):
+    "float32 -> float16 -> float32: the values are float16's, the vectors half the size"
+    dirpath, vectors = model
+    report = compact(str(dirpath), db_type, "float16")
+    assert report["nbytes_after"] == 3 * VECTOR_NBYTES // 2
+    assert CacheFile(str(dirpath / "embeddings.bin"), DIMENSION,
+                     str(dirpath.parent / "read.lock"), 1).storage_dtype == "float16"
+    compact(str(dirpath), db_type, "float32")
+    assert os.path.getsize(dirpath / "embeddings.bin") == 3 * VECTOR_NBYTES
+    compacted = read_model(dirpath, db_type)
+    for i in [1, 3, 5]:
+        assert np.array_equal(compacted[i], vectors[i].astype(np.float16).astype(np.float32))
+
+def test_compact_resumes_interrupted_swap(model, db_type, monkeypatch):
+    "a crash once the compacted directory is built: the next run swaps it in"
+    dirpath, vectors = model
+    calls = []
+
+    def crash_2nd(model_dirpath: str) -> None:
+        calls.append(model_dirpath)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        finish_swap(model_dirpath)
+
+    monkeypatch.setattr(compactCache, "finish_swap", crash_2nd)
+    with pytest.raises(KeyboardInterrupt):
+        compact(str(dirpath), db_type)
+    assert os.path.isdir(f"{dirpath}.compacted")
+    assert os.path.getsize(dirpath / "embeddings.bin") == 6 * VECTOR_NBYTES
+    # ... & a crash in the middle of the swap
+    os.rename(dirpath, f"{dirpath}.old")
+    report = compact(str(dirpath), db_type)
+    assert report["dangling_rows"] == 0 and report["vectors_after"] == 3
+    assert sorted(path.name for path in dirpath.parent.iterdir()) == ["cache.lock", "model"]
+    compacted = read_model(dirpath, db_type)
+    assert {i: vector.tobytes() for i, vector in compacted.items()} == {
+            i: vectors[i].tobytes() for i in [1, 3, 5]}
+
+def test_compact_discards_incomplete_build(model, db_type):
+    dirpath, _ = model
+    os.makedirs(f"{dirpath}.compacting")
+    (dirpath.parent / "model.compacting" / "embeddings.bin").write_bytes(b"\0" * 7)
+    compact(str(dirpath), db_type)
+    assert sorted(path.name for path in dirpath.parent.iterdir()) == ["cache.lock", "model"]
+    assert sorted(read_model(dirpath, db_type)) == [1, 3, 5]
+
+@pytest.mark.parametrize("policy, kept", [("lru", [1, 5]), ("lfu", [3, 5])])
+def test_compact_evicts(model, db_type, policy, kept):
+    "by the saved access stats, only those of the rows kept are carried over"
+    dirpath, _ = model
+    stats = AccessStats(str(dirpath))
+    stats.touch([digest(1)], now=300)
+    stats.touch([digest(3)] * 3, now=100)
+    stats.touch([digest(5)] * 2, now=200)
+    stats.save()
+    report = compact(str(dirpath), db_type, policy=policy, max_vectors=2)
+    assert report["evicted_rows"] == 1 and report["vectors_after"] == 2
+    assert sorted(read_model(dirpath, db_type)) == kept
+    records = AccessStats.load(str(dirpath))
+    assert sorted(int.from_bytes(digest.tobytes(), "little") for digest in records["digest"]) \
+           == kept
+
+def test_compact_evicts_untracked_1st(model, db_type):
+    "rows without stats (cached before access was tracked) go 1st, oldest 1st"
+    dirpath, _ = model
+    stats = AccessStats(str(dirpath))
+    stats.touch([digest(1)], now=100)
+    stats.save()
+    compact(str(dirpath), db_type, max_nbytes=2 * VECTOR_NBYTES)
+    assert sorted(read_model(dirpath, db_type)) == [1, 5]
+
+# -----------------------------------------------------------------------------
+def test_evict_files_under_cap(tmp_path, cached):
+    cache, index, stats = cached
+    report, moved = evict_files(index, cache, stats, max_vectors=12)
+    assert report["retired_files"] == 0 and moved == []
+    assert cache.get_file_ids() == [0, 1, 2]
+
+def test_evict_files_lru(tmp_path, cached):
+    cache, index, stats = cached
+    worker = open_cache(tmp_path)   # as a worker's, its active file is 2
+    report, moved = evict_files(index, cache, stats, "lru", max_vectors=8)
+    # 1, 3, 4 & 5 were used least recently, 2 & 6-8 are moved to the active files
+    assert report["retired_files"] == 2
+    assert report["evicted_rows"] == 4 and report["moved_rows"] == 4
+    assert sorted(int.from_bytes(document_hash, "little") for document_hash, _ in moved) == \
+           [2, 6, 7, 8]
+    assert cache.get_file_ids() == [2, 3]
+    assert read_documents(cache, index) == {i: i for i in [2] + list(range(6, 13))}
+    assert report["nbytes_after"] == 8 * VECTOR_NBYTES
+    last_access, count = stats.lookup(np.frombuffer(digest(1) + digest(2), dtype=np.uint8
+                                                    ).reshape(-1, 32))
+    assert last_access.tolist() == [0, 200] and count.tolist() == [0, 2]
+    # a retired id is never used again: the worker moves on to a new file
+    vectors = np.zeros((1, DIMENSION), dtype=np.float32)
+    assert CacheShards.unpack_location(worker.append(0, vectors)[0]) == (4, 0)
+    assert cache.get_file_ids() == [2, 3, 4]
+
+def test_evict_files_lfu(tmp_path, cached):
+    cache, index, stats = cached
+    for i in [1, 5, 9]:
+        stats.touch([digest(i)] * 3)
+    evict_files(index, cache, stats, "lfu", max_vectors=8)
+    # the least frequently used 1st, least recently used among equals
+    assert set(read_documents(cache, index)) == {1, 2, 5, 9, 10, 11, 12, 8}
+
+def test_evict_files_max_nbytes_without_stats(tmp_path, cached):
+    cache, index, _ = cached
+    report, moved = evict_files(index, cache, None, max_nbytes=8 * VECTOR_NBYTES)
+    # no stats: the oldest are evicted 1st, all of file 0
+    assert report["retired_files"] == 1 and moved == []
+    assert cache.get_file_ids() == [1, 2]
+    assert read_documents(cache, index) == {i: i for i in range(5, 13)}
+
+def test_retired_file_reads_miss(tmp_path, cached):
+    cache, index, stats = cached
+    location = dict(index.iter_rows())[digest(1)]
+    reader = open_cache(tmp_path)
+    evict_files(index, cache, stats, max_vectors=8)
+    assert not os.path.exists(os.path.join(str(tmp_path), CacheShards.get_filename(0)))
+    assert reader.read(location) is None
+    assert reader.read_many([location]) is None
@@ -0,0 +1,65 @@
+import pytest
+
+import databaseCommitProcess
+
+from databaseCommitProcess import CLAIM_TTL_SECS, ClaimTable
+
+DIGEST = (0, b"\1" * 32)
+
+
+class Clock:
+    "stands in for monotonic, moved by hand"
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(databaseCommitProcess, "monotonic", clock)
+    return clock
+
+# -----------------------------------------------------------------------------
+def test_claim_once(clock):
+    claims = ClaimTable()
+    assert claims.claim(DIGEST, 1)
+    assert not claims.claim(DIGEST, 2)
+    assert not claims.claim(DIGEST, 1)  # its own claim too, it's still computing it
+    assert claims.claim((1, DIGEST[1]), 2)  # the same document of another model
+
+def test_release_own_claims(clock):
+    claims = ClaimTable()
+    claims.claim(DIGEST, 1)
+    claims.release([DIGEST], 2)     # not its claim
+    assert not claims.claim(DIGEST, 2)
+    claims.release([DIGEST], 1)
+    assert claims.claim(DIGEST, 2)
+
+def test_release_written(clock):
+    "the index write releases the claim, whichever worker wrote it"
+    claims = ClaimTable()
+    claims.claim(DIGEST, 1)
+    claims.release([DIGEST, (0, b"\2" * 32)])   # unclaimed digests are ignored
+    assert claims.claim(DIGEST, 2)
+
+def test_claim_expires(clock):
+    "e.g. its worker died"
+    claims = ClaimTable()
+    claims.claim(DIGEST, 1)
+    clock.now += CLAIM_TTL_SECS - 0.1
+    assert not claims.claim(DIGEST, 2)
+    clock.now += 0.1
+    assert claims.claim(DIGEST, 2)
+    claims.release([DIGEST], 1)     # the dead worker's claim was taken over
+    assert not claims.claim(DIGEST, 1)
+
+def test_purge_expired_claims(clock, monkeypatch):
+    monkeypatch.setattr(databaseCommitProcess, "CLAIMS_PURGE_CNT", 3)
+    claims = ClaimTable()
+    for i in range(3):
+        claims.claim((0, bytes([i]) * 32), 1)
+    clock.now += CLAIM_TTL_SECS
+    claims.claim((0, b"\3" * 32), 1)
+    assert list(claims.claims) == [(0, b"\3" * 32)]
@@ -0,0 +1,56 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from indexDuckDB import IndexDuckDB
+
+
+def digest(i: int) -> bytes:
+    return i.to_bytes(32, "little")
+
+# -----------------------------------------------------------------------------
+def test_add_read_delete(tmp_path):
+    index = IndexDuckDB(str(tmp_path))
+    index.add_rows([(digest(i), i * 16) for i in range(5)])
+    assert index.read_offset(digest(2)) == 32  # pending, not inserted yet
+    index.flush()
+    index.add_rows([(digest(2), 999)])  # already indexed, ignored
+    index.flush()
+    assert index.read_offsets([digest(1), digest(2), digest(9)]) == {digest(1): 16,
+                                                                     digest(2): 32}
+    index.delete_rows([digest(1)])
+    assert index.read_offset(digest(1)) is None
+    assert dict(index.iter_rows()) == {digest(i): i * 16 for i in (0, 2, 3, 4)}
+
+def test_export_import_parquet(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    parquet_filepath = str(tmp_path / "it's.parquet")   # quoted in COPY
+    index = IndexDuckDB(str(tmp_path / "a"))
+    index.add_rows([(digest(i), i * 16) for i in range(5)])
+    assert index.export_parquet(parquet_filepath) == 5  # the pending rows too
+    table = pq.read_table(parquet_filepath)
+    assert table.column_names == ["documentHash", "offset"]
+    assert dict(zip(table["documentHash"].to_pylist(), table["offset"].to_pylist())) == {
+            digest(i): i * 16 for i in range(5)}
+
+    other = IndexDuckDB(str(tmp_path / "b"))
+    other.add_rows([(digest(0), 999)])
+    assert other.import_parquet(parquet_filepath) == 4  # rows already indexed are ignored
+    assert dict(other.iter_rows()) == {digest(0): 999} | {digest(i): i * 16 for i in range(1, 5)}
+
+def test_import_parquet_duplicates(tmp_path):
+    "a digest twice in the file is imported once"
+    parquet_filepath = str(tmp_path / "rows.parquet")
+    pq.write_table(pa.table({"documentHash": pa.array([digest(1), digest(1), digest(2)],
+                                                      pa.binary(32)),
+                             "offset": pa.array([0, 16, 32], pa.int64())}), parquet_filepath)
+    index = IndexDuckDB(str(tmp_path))
+    assert index.import_parquet(parquet_filepath) == 2
+    assert index.read_offset(digest(1)) in (0, 16)
+
+def test_readonly_import(tmp_path):
+    IndexDuckDB(str(tmp_path)).add_rows([(digest(1), 0)])   # creates the index
+    parquet_filepath = str(tmp_path / "rows.parquet")
+    pq.write_table(pa.table({"documentHash": pa.array([digest(2)], pa.binary(32)),
+                             "offset": pa.array([16], pa.int64())}), parquet_filepath)
+    assert IndexDuckDB(str(tmp_path), readonly=True).import_parquet(parquet_filepath) == 0
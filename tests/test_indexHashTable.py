@@ -0,0 +1,102 @@
+import pytest
+
+from hashlib import sha256
+
+from indexHashTable import IndexHashTable, MIN_CAPACITY
+
+
+def digest(i: int) -> bytes:
+    return sha256(str(i).encode()).digest()
+
+def colliding_digest(home: int, i: int) -> bytes:
+    "digests with the same 1st 8 bytes share key[0] & mask, i.e. their home slot"
+    return home.to_bytes(8, "little") + sha256(str(i).encode()).digest()[:24]
+
+@pytest.fixture
+def writer(tmp_path) -> IndexHashTable:
+    return IndexHashTable(str(tmp_path), readonly=False)
+
+def publish_every_add(index: IndexHashTable) -> None:
+    index.REBUILD_MIN_LOG_ROWS = 1
+
+# -----------------------------------------------------------------------------
+@pytest.mark.parametrize("home", [0, 5, MIN_CAPACITY - 1])  # the last spills into overflow slots
+def test_colliding_digests(tmp_path, writer, home):
+    publish_every_add(writer)
+    rows = [(colliding_digest(home, i), i * 100) for i in range(20)]
+    writer.add_rows(rows)
+    reader = IndexHashTable(str(tmp_path))
+    assert reader.table["cnt_rows"] == len(rows)
+    for document_hash, offset in rows:
+        assert reader.read_offset(document_hash) == offset
+    assert reader.read_offsets([document_hash for document_hash, _ in rows]) == dict(rows)
+    absent = colliding_digest(home, 1000)
+    assert reader.read_offset(absent) is None
+    assert reader.read_offsets([absent]) == {}
+
+def test_lookup_after_log_append(tmp_path, writer):
+    reader = IndexHashTable(str(tmp_path))
+    assert reader.read_offset(digest(1)) is None
+    writer.add_rows([(digest(1), 10), (digest(2), 20)])   # to the log, no new generation
+    assert reader.read_offset(digest(1)) == 10
+    writer.add_rows([(digest(3), 30)])
+    assert reader.read_offsets([digest(2), digest(3), digest(4)]) == {digest(2): 20,
+                                                                      digest(3): 30}
+    assert reader.table["generation"] == 0
+
+def test_lookup_after_republish(tmp_path, writer):
+    reader = IndexHashTable(str(tmp_path))
+    writer.add_rows([(digest(1), 10)])
+    assert reader.read_offset(digest(1)) == 10
+    publish_every_add(writer)
+    writer.add_rows([(digest(2), 20)])
+    assert writer.table["generation"] == 1
+    assert reader.read_offsets([digest(1), digest(2)]) == {digest(1): 10, digest(2): 20}
+    assert reader.table["generation"] == 1
+    assert reader.table["log_rows"] == {}   # both in the new generation's table
+
+def test_reader_on_old_generation(tmp_path, writer):
+    writer.add_rows([(digest(1), 10)])
+    reader = IndexHashTable(str(tmp_path))
+    old_table = reader.table
+    writer.add_rows([(digest(2), 20)])  # in generation 0's log, which the next publish removes
+    publish_every_add(writer)
+    writer.add_rows([(digest(3), 30)])
+    writer.add_rows([(digest(4), 40)])
+    assert writer.table["generation"] == 2
+    # hits in its generation don't look for a newer 1
+    assert reader.read_offset(digest(1)) == 10
+    assert reader.table is old_table
+    assert reader.read_offset(digest(4)) == 40
+    assert reader.table["generation"] == 2
+    assert reader.read_offsets([digest(i) for i in range(1, 5)]) == {
+            digest(1): 10, digest(2): 20, digest(3): 30, digest(4): 40}
+
+def test_delete_rows(tmp_path, writer):
+    publish_every_add(writer)
+    writer.add_rows([(digest(i), i) for i in range(10)])
+    writer.REBUILD_MIN_LOG_ROWS = IndexHashTable.REBUILD_MIN_LOG_ROWS
+    writer.add_rows([(digest(10), 10)])     # stays in the log
+    reader = IndexHashTable(str(tmp_path))
+    writer.delete_rows([digest(3), digest(10), digest(99)])
+    # a reader keeps serving its generation until a miss, after which it has the new 1
+    assert reader.read_offset(digest(3)) == 3
+    assert reader.read_offset(digest(99)) is None
+    for index in (writer, reader):
+        assert index.read_offset(digest(3)) is None
+        assert index.read_offset(digest(10)) is None
+        assert index.read_offsets([digest(i) for i in range(11)]) == {
+                digest(i): i for i in range(10) if i != 3}
+    assert sorted(offset for _, offset in writer.iter_rows()) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    # the writer re-opened after the publish sees the same rows
+    del writer
+    reopened = IndexHashTable(str(tmp_path), readonly=False)
+    assert sorted(offset for _, offset in reopened.iter_rows()) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+
+def test_delete_colliding_rows(tmp_path, writer):
+    "the rows kept share the 1st 8 bytes of the removed digests"
+    rows = [(colliding_digest(7, i), i) for i in range(6)]
+    writer.add_rows(rows)
+    writer.delete_rows([colliding_digest(7, 2), colliding_digest(7, 4)])
+    assert writer.read_offsets([document_hash for document_hash, _ in rows]) == {
+            colliding_digest(7, i): i for i in (0, 1, 3, 5)}
@@ -0,0 +1,65 @@
+import sqlite3
+
+from contextlib import closing
+
+from indexSQLite import IndexSQLite
+from migrateIndex import migrate_sqlite
+
+
+def digest(i: int) -> bytes:
+    return i.to_bytes(32, "little")
+
+def create_legacy_index(dirpath, rows: list[tuple[str, int]]) -> str:
+    "a hex digest index, as created before binary digests"
+    db_filepath = str(dirpath / IndexSQLite.INDEX_DB_FILE)
+    with closing(sqlite3.connect(db_filepath)) as connection:
+        connection.execute(f"CREATE TABLE {IndexSQLite.LEGACY_TABLE} "
+                           "(documentHash TEXT PRIMARY KEY, offset INTEGER)")
+        connection.executemany(f"INSERT INTO {IndexSQLite.LEGACY_TABLE} VALUES (?, ?)", rows)
+        connection.commit()
+    return db_filepath
+
+def get_tables(db_filepath: str) -> set[str]:
+    with closing(sqlite3.connect(db_filepath)) as connection:
+        return {row[0] for row in
+                connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+# -----------------------------------------------------------------------------
+def test_migrate_sqlite(tmp_path):
+    db_filepath = create_legacy_index(tmp_path, [(digest(i).hex(), i * 16) for i in range(5)]
+                                                + [("not hex", 80)])
+    legacy = IndexSQLite(str(tmp_path), readonly=True)
+    assert legacy.legacy and legacy.read_offset(digest(3)) == 48
+    del legacy
+    assert migrate_sqlite(str(tmp_path)) == 5   # the row without a hex digest is skipped
+    assert get_tables(db_filepath) == {IndexSQLite.TABLE}
+    index = IndexSQLite(str(tmp_path), readonly=True)
+    assert not index.legacy
+    assert dict(index.iter_rows()) == {digest(i): i * 16 for i in range(5)}
+    del index
+    assert migrate_sqlite(str(tmp_path)) == 0   # already converted
+
+def test_migrate_sqlite_keep_legacy(tmp_path):
+    db_filepath = create_legacy_index(tmp_path, [(digest(1).hex(), 0)])
+    assert migrate_sqlite(str(tmp_path), keep_legacy=True) == 1
+    assert get_tables(db_filepath) == {IndexSQLite.TABLE, IndexSQLite.LEGACY_TABLE}
+    assert IndexSQLite(str(tmp_path), readonly=True).read_offset(digest(1)) == 0
+
+def test_migrate_sqlite_restarts_interrupted(tmp_path):
+    "an empty binary digest table next to the hex one: an older version's interrupted run"
+    db_filepath = create_legacy_index(tmp_path, [(digest(i).hex(), i * 16) for i in range(3)])
+    with closing(sqlite3.connect(db_filepath)) as connection:
+        connection.execute(f"CREATE TABLE {IndexSQLite.TABLE} "
+                           "(documentHash BLOB PRIMARY KEY, offset INTEGER) WITHOUT ROWID")
+        connection.commit()
+    assert migrate_sqlite(str(tmp_path)) == 3
+    assert dict(IndexSQLite(str(tmp_path), readonly=True).iter_rows()) == {
+            digest(i): i * 16 for i in range(3)}
+
+def test_migrate_sqlite_nothing_to_convert(tmp_path):
+    index = IndexSQLite(str(tmp_path), readonly=False)
+    index.add_rows([(digest(1), 0)])
+    index.flush()
+    del index
+    assert migrate_sqlite(str(tmp_path)) == 0
+    assert IndexSQLite(str(tmp_path), readonly=True).read_offset(digest(1)) == 0
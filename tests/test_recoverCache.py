@@ -0,0 +1,171 @@
+import numpy as np
+import os
+import pytest
+
+from cacheFile import CacheFile, WAL_RECORD
+from cacheShards import CacheShards
+from compactCache import open_index
+from recoverCache import drop_rows_past_eof, recover, replay_write_ahead, trim_write_ahead
+
+DIMENSION = 4
+VECTOR_NBYTES = 4 * DIMENSION   # float32
+
+
+def digest(i: int) -> bytes:
+    return i.to_bytes(32, "little")
+
+def open_cache_file(dirpath, filename: str = "embeddings.bin") -> CacheFile:
+    return CacheFile(str(dirpath / filename), DIMENSION, str(dirpath / f"{filename}.lock"), 1,
+                     write_ahead=True)
+
+def append(cache_file: CacheFile, documents: list[int]) -> int:
+    "the documents' vectors are full of their numbers"
+    vectors = np.repeat(np.array(documents, dtype=np.float32)[:, None], DIMENSION, axis=1)
+    return cache_file.append(vectors.tobytes(), document_hashes=[digest(i) for i in documents])
+
+def get_rows(db_type: str, dirpath) -> dict[bytes, int]:
+    return dict(open_index(db_type, str(dirpath), readonly=False).iter_rows())
+
+@pytest.fixture(params=["hashtable", "sqlite"])
+def db_type(request) -> str:
+    return request.param
+
+# -----------------------------------------------------------------------------
+def test_recover_replays_write_ahead(tmp_path, db_type):
+    cache_file = open_cache_file(tmp_path)
+    append(cache_file, [1, 2])
+    append(cache_file, [3])
+    index = open_index(db_type, str(tmp_path), readonly=False)
+    index.add_rows([(digest(2), VECTOR_NBYTES)])   # the others' rows were lost
+    index.flush()
+    del index
+    with open(cache_file.path, "ab") as f:
+        f.write(b"\0" * 5)  # a torn vector
+    report = recover(str(tmp_path), db_type, DIMENSION)
+    assert report == {"truncated_nbytes": 5, "replayed_rows": 2, "dropped_rows": 0}
+    assert get_rows(db_type, tmp_path) == {digest(1): 0, digest(2): VECTOR_NBYTES,
+                                           digest(3): 2 * VECTOR_NBYTES}
+    assert os.path.getsize(cache_file.wal_path) == 0
+    assert cache_file.get_write_ahead_mark() == 0
+
+def test_replay_skips_unwritten_vectors(tmp_path, db_type):
+    cache_file = open_cache_file(tmp_path)
+    append(cache_file, [1, 2, 3])
+    os.truncate(cache_file.path, 2 * VECTOR_NBYTES)     # 3's vector was never written
+    index = open_index(db_type, str(tmp_path), readonly=False)
+    assert replay_write_ahead(index, 0, cache_file) == 2
+    assert dict(index.iter_rows()) == {digest(1): 0, digest(2): VECTOR_NBYTES}
+
+def test_replay_skips_stale_records(tmp_path, db_type):
+    "a record whose offset a later record has: its append failed & wasn't undone"
+    cache_file = open_cache_file(tmp_path)
+    append(cache_file, [1, 3])
+    with open(cache_file.wal_path, "wb") as f:
+        f.write(b"".join(WAL_RECORD.pack(digest(i), offset) for i, offset in
+                         ((1, 0), (2, VECTOR_NBYTES), (3, VECTOR_NBYTES))))
+    index = open_index(db_type, str(tmp_path), readonly=False)
+    assert replay_write_ahead(index, 0, cache_file) == 2
+    assert dict(index.iter_rows()) == {digest(1): 0, digest(3): VECTOR_NBYTES}
+
+def test_replay_sharded_location(tmp_path, db_type):
+    cache_file = open_cache_file(tmp_path, CacheShards.get_filename(3))
+    append(cache_file, [1, 2])
+    index = open_index(db_type, str(tmp_path), readonly=False)
+    assert replay_write_ahead(index, 3, cache_file) == 2
+    assert dict(index.iter_rows())[digest(2)] == CacheShards.pack_location(3, VECTOR_NBYTES)
+
+# -----------------------------------------------------------------------------
+def test_failed_append_is_undone(tmp_path, db_type):
+    cache_file = open_cache_file(tmp_path)
+    append(cache_file, [1])
+    append(cache_file, [2])     # opens the append handle
+
+    class FailingFile:
+        def __init__(self, f):
+            self.f = f
+        def fileno(self):
+            return self.f.fileno()
+        def write(self, data):
+            raise OSError(28, "No space left on device")
+
+    append_file = cache_file.append_file
+    cache_file.append_file = FailingFile(append_file)
+    with pytest.raises(OSError):
+        append(cache_file, [3])
+    cache_file.append_file = append_file
+    assert os.path.getsize(cache_file.wal_path) == 2 * WAL_RECORD.size
+    assert os.path.getsize(cache_file.path) == 2 * VECTOR_NBYTES
+    assert append(cache_file, [4]) == 2 * VECTOR_NBYTES
+    assert recover(str(tmp_path), db_type, DIMENSION)["replayed_rows"] == 3
+    assert get_rows(db_type, tmp_path) == {digest(1): 0, digest(2): VECTOR_NBYTES,
+                                           digest(4): 2 * VECTOR_NBYTES}
+
+# -----------------------------------------------------------------------------
+def test_trim_write_ahead(tmp_path, db_type):
+    cache_file = open_cache_file(tmp_path)
+    append(cache_file, [1, 2, 3, 4])
+    index = open_index(db_type, str(tmp_path), readonly=False)
+    assert trim_write_ahead(index, cache_file, 1) == 0
+    index.add_rows([(digest(1), 0), (digest(2), VECTOR_NBYTES), (digest(4), 3 * VECTOR_NBYTES)])
+    assert trim_write_ahead(index, cache_file, 1) == 2   # up to 3, which isn't indexed yet
+    assert cache_file.get_write_ahead_mark() == 2 * WAL_RECORD.size
+    assert os.path.getsize(cache_file.wal_path) == 4 * WAL_RECORD.size
+    # replay looks from the mark on: only 3 is missing
+    assert replay_write_ahead(index, 0, cache_file) == 1
+    assert index.read_offset(digest(3)) == 2 * VECTOR_NBYTES
+
+def test_trim_write_ahead_empties_log(tmp_path, db_type):
+    cache_file = open_cache_file(tmp_path)
+    append(cache_file, [1, 2])
+    index = open_index(db_type, str(tmp_path), readonly=False)
+    index.add_rows([(digest(1), 0)])
+    assert trim_write_ahead(index, cache_file, 1) == 1
+    index.add_rows([(digest(2), VECTOR_NBYTES)])
+    assert trim_write_ahead(index, cache_file, 1) == 1
+    assert os.path.getsize(cache_file.wal_path) == 0
+    assert cache_file.get_write_ahead_mark() == 0
+    append(cache_file, [3])     # the log continues from its start
+    assert os.path.getsize(cache_file.wal_path) == WAL_RECORD.size
+    # the rows trimmed are committed, a new index object sees them
+    assert get_rows(db_type, tmp_path) == {digest(1): 0, digest(2): VECTOR_NBYTES}
+
+def test_trim_skips_stale_records(tmp_path, db_type):
+    cache_file = open_cache_file(tmp_path)
+    append(cache_file, [1])
+    with open(cache_file.wal_path, "ab") as f:
+        f.write(WAL_RECORD.pack(digest(2), VECTOR_NBYTES))  # never written
+    append(cache_file, [3])     # written over 2's offset
+    index = open_index(db_type, str(tmp_path), readonly=False)
+    index.add_rows([(digest(1), 0), (digest(3), VECTOR_NBYTES)])
+    assert trim_write_ahead(index, cache_file, 1) == 3
+    assert os.path.getsize(cache_file.wal_path) == 0
+
+# -----------------------------------------------------------------------------
+def test_drop_rows_past_eof(tmp_path, db_type):
+    cache_files = {0: open_cache_file(tmp_path),
+                   1: open_cache_file(tmp_path, CacheShards.get_filename(1))}
+    append(cache_files[0], [1, 2])
+    append(cache_files[1], [3])
+    index = open_index(db_type, str(tmp_path), readonly=False)
+    kept = {digest(1): 0, digest(2): VECTOR_NBYTES, digest(3): CacheShards.pack_location(1, 0)}
+    index.add_rows(list(kept.items()) + [
+            (digest(4), 2 * VECTOR_NBYTES),     # past the end
+            (digest(5), 3),     # not @ the start of a vector
+            (digest(6), CacheShards.pack_location(1, VECTOR_NBYTES)),   # past the end of file 1
+            (digest(7), CacheShards.pack_location(5, 0))])  # no such file
+    index.flush()
+    assert drop_rows_past_eof(index, cache_files) == 4
+    assert dict(index.iter_rows()) == kept
+
+def test_recover_tail_keeps_rows(tmp_path, db_type):
+    cache_file = open_cache_file(tmp_path)
+    append(cache_file, [1])
+    index = open_index(db_type, str(tmp_path), readonly=False)
+    index.add_rows([(digest(1), 0), (digest(2), VECTOR_NBYTES)])
+    index.flush()
+    del index
+    assert recover(str(tmp_path), db_type, DIMENSION, "tail")["dropped_rows"] == 0
+    assert recover(str(tmp_path), db_type, DIMENSION, "off") == {
+            "truncated_nbytes": 0, "replayed_rows": 0, "dropped_rows": 0}
+    assert recover(str(tmp_path), db_type, DIMENSION)["dropped_rows"] == 1
+    assert get_rows(db_type, tmp_path) == {digest(1): 0}
@@ -0,0 +1,73 @@
+import asyncio
+import pytest
+
+from requestCoalescer import RECLAIM, RequestCoalescer
+
+KEY = ("model", b"\1" * 32)
+
+
+def test_waiters_get_the_owners_result():
+    coalescer = RequestCoalescer()
+    future, owner = coalescer.claim(KEY)
+    waiter_future, waiter_owns = coalescer.claim(KEY)
+    assert owner and not waiter_owns and waiter_future is future
+    coalescer.resolve(KEY, "embeddings")
+    assert waiter_future.result() == "embeddings"
+    assert coalescer.claim(KEY)[1]  # released
+
+def test_waiters_get_the_owners_exception():
+    coalescer = RequestCoalescer()
+    coalescer.claim(KEY)
+    waiter_future, _ = coalescer.claim(KEY)
+    coalescer.fail(KEY, ValueError("encode failed"))
+    with pytest.raises(ValueError):
+        waiter_future.result()
+    assert coalescer.claim(KEY)[1]
+
+@pytest.mark.parametrize("cancellation", [asyncio.CancelledError(), KeyboardInterrupt()])
+def test_owner_cancelled(cancellation):
+    "waiters aren't cancelled with the owner, they claim the key again"
+    coalescer = RequestCoalescer()
+    coalescer.claim(KEY)
+    waiter_futures = [coalescer.claim(KEY)[0] for _ in range(2)]
+    coalescer.fail(KEY, cancellation)
+    assert [future.result() for future in waiter_futures] == [RECLAIM, RECLAIM]
+    future, owner = coalescer.claim(KEY)    # the 1st waiter to claim again computes
+    assert owner
+    assert coalescer.claim(KEY) == (future, False)
+
+def test_owner_task_cancelled_with_a_waiter():
+    coalescer = RequestCoalescer()
+
+    async def get(computed: asyncio.Future):
+        "as the service's requests: claim, compute or wait, claim again on RECLAIM"
+        while True:
+            future, owner = coalescer.claim(KEY)
+            if not owner:
+                result = await asyncio.wrap_future(future)
+                if result is RECLAIM:
+                    continue
+                return result
+            try:
+                result = await computed
+            except BaseException as e:
+                coalescer.fail(KEY, e)
+                raise
+            coalescer.resolve(KEY, result)
+            return result
+
+    async def main():
+        never = asyncio.get_running_loop().create_future()
+        owner = asyncio.create_task(get(never))
+        await asyncio.sleep(0)
+        done = asyncio.get_running_loop().create_future()
+        waiter = asyncio.create_task(get(done))
+        await asyncio.sleep(0)
+        owner.cancel()
+        await asyncio.sleep(0.01)
+        done.set_result("computed by the waiter")
+        assert await waiter == "computed by the waiter"
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+
+    asyncio.run(main())
@@ -0,0 +1,131 @@
+import asyncio
+import numpy as np
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+import databaseCommitProcess   # 1st, circular import with embeddingService
+
+from conftest import MODEL_NAME
+from embeddingService import EmbeddingService
+
+COMMIT_TIMEOUT = 10     # secs, for the database commit process to commit the index rows
+
+
+def read_frames(content: bytes) -> list[bytes]:
+    "a binary '/stream' response's frames"
+    frames, pos = [], 0
+    while pos < len(content):
+        nbytes = int.from_bytes(content[pos:pos + 4], "little")
+        frames.append(content[pos + 4:pos + 4 + nbytes])
+        pos += 4 + nbytes
+    return frames
+
+def wait_indexed(model, document_hashes: list[bytes]) -> dict[bytes, int]:
+    deadline = monotonic() + COMMIT_TIMEOUT
+    while len(offsets := model.read_offsets(document_hashes)) < len(document_hashes):
+        assert monotonic() < deadline, f"{len(offsets)} of {len(document_hashes)} indexed"
+        sleep(0.05)
+    return offsets
+
+# -----------------------------------------------------------------------------
+def test_stream_word_batches(server, monkeypatch):
+    "more batches than the pipeline's depth, whose token writes run concurrently"
+    server, client = server
+    monkeypatch.setattr(server, "STREAM_BATCH_CNT", 4)
+    cnt_batches = 50 * server.STREAM_PIPELINE_DEPTH
+    # 1 to 5 words each, each document once
+    documents = [" ".join(f"stream{i}word{j}" for j in range(i % 5 + 1))
+                 for i in range(cnt_batches * 4)]
+    response = client.post("/stream", params={"model_name": MODEL_NAME, "emb_type": "word"},
+                           content="\n".join(documents).encode())
+    assert response.status_code == 200
+    dimension = int(response.headers["X-Embedding-Dimension"])
+    frames = read_frames(response.content)
+    assert [len(frame) // (4 * dimension) for frame in frames] == [
+            len(document.split()) for document in documents]
+
+    es = server.es
+    document_hashes = [EmbeddingService.get_digest(document) for document in documents]
+    entry_ids = wait_indexed(es.token_models[MODEL_NAME], document_hashes)
+    assert len(set(entry_ids.values())) == len(documents)   # no entry was written twice
+    token_cache = es.token_caches[MODEL_NAME]
+    for document, document_hash in zip(documents, document_hashes):
+        matrix = token_cache.read(entry_ids[document_hash])
+        assert matrix.shape == (len(document.split()), dimension)
+
+# -----------------------------------------------------------------------------
+def test_compute_miss_owner_cancelled(server, monkeypatch):
+    "a cancelled request (e.g. its client disconnected) doesn't cancel those waiting on it"
+    server, _ = server
+    document = "cancelled owner"
+    document_hash = EmbeddingService.get_digest(document)
+    vector = np.ones(server.es.cache_files[MODEL_NAME].embedding_dimension, dtype=np.float32)
+    encodes = []
+
+    async def submit(document: str) -> np.ndarray:
+        encodes.append(document)
+        if len(encodes) == 1:   # the owner's encode never ends
+            await asyncio.sleep(3600)
+        return vector
+
+    monkeypatch.setattr(server.schedulers[MODEL_NAME], "submit", submit)
+
+    async def main():
+        owner = asyncio.create_task(server.compute_miss(document, document_hash, MODEL_NAME,
+                                                        True, True))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(server.compute_miss(document, document_hash, MODEL_NAME,
+                                                         True, True))
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        message, computed = await asyncio.wait_for(waiter, 5)
+        assert computed     # so the waiter writes it
+        assert np.array_equal(message, vector)
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+
+    asyncio.run(main())
+    assert encodes == [document, document]
+
+def test_batch_waiter_of_cancelled_owner(server):
+    "get_embeddings_batch computes (& writes) the in-flight documents whose owner was cancelled"
+    server, _ = server
+    es = server.es
+    documents = ["batch waiter 1", "batch waiter 2"]
+    document_hash = EmbeddingService.get_digest(documents[1])
+    _, owner = es.claim(document_hash, MODEL_NAME)     # a request computing documents[1]
+    assert owner
+    with ThreadPoolExecutor(1) as executor:
+        batch = executor.submit(es.get_embeddings_batch, documents, MODEL_NAME)
+        sleep(0.1)
+        assert not batch.done()     # waits on the owner
+        es.fail(document_hash, MODEL_NAME, asyncio.CancelledError())
+        embeddings, to_write = batch.result(5)
+    assert np.array_equal(embeddings,
+                          es.models[MODEL_NAME].compute_embeddings_batch(documents))
+    assert to_write[1] == [EmbeddingService.get_digest(document) for document in documents]
+    assert len(to_write[0]) == 2
+
+# -----------------------------------------------------------------------------
+def test_search_without_index(server, monkeypatch):
+    "without --search-index, a document query is rejected b4 it's computed, cached or claimed"
+    server, client = server
+    encodes = []
+
+    async def submit(document: str) -> np.ndarray:
+        encodes.append(document)
+        return np.ones(server.es.cache_files[MODEL_NAME].embedding_dimension, dtype=np.float32)
+
+    monkeypatch.setattr(server.schedulers[MODEL_NAME], "submit", submit)
+    document = "search without index"
+    response = client.post("/search", params={"model_name": MODEL_NAME},
+                           data={"document": document})
+    assert response.status_code == 409
+    assert encodes == []
+    document_hash = EmbeddingService.get_digest(document)
+    _, owner = server.es.claim(document_hash, MODEL_NAME)
+    assert owner    # not in flight
+    server.es.fail(document_hash, MODEL_NAME, RuntimeError())
+    assert server.es.get_cached_embeddings(document_hash, MODEL_NAME) is None
@@ -0,0 +1,87 @@
+import os
+import pytest
+
+from multiprocessing import get_context
+from threading import Thread
+from time import sleep
+
+from shmRingBuffer import ShmChannel, ShmRingBuffer
+
+CNT_RECORDS = 5000  # sent across processes, many times the ring's capacity
+
+
+def make_record(i: int) -> tuple:
+    return (i.to_bytes(32, "little"), i * 7, i, i % 5, i % 3)
+
+@pytest.fixture
+def name(request) -> str:
+    return f"testRing{os.getpid()}_{request.node.name}"
+
+# -----------------------------------------------------------------------------
+def test_wrap_around(name):
+    ring = ShmRingBuffer(name, 4, create=True)
+    try:
+        assert ring.push([make_record(i) for i in range(3)]) == 3
+        assert ring.pop_all() == [make_record(i) for i in range(3)]
+        # slots 3, 0, 1 & 2: wraps past the end of the records
+        assert ring.push([make_record(i) for i in range(3, 9)]) == 4
+        assert len(ring) == 4
+        assert ring.push([make_record(9)]) == 0     # full
+        assert ring.pop_all() == [make_record(i) for i in range(3, 7)]
+        assert ring.pop_all() == []
+    finally:
+        ring.close()
+
+def test_attach_sees_records(name):
+    ring = ShmRingBuffer(name, 8, create=True)
+    try:
+        attached = ShmRingBuffer(name)
+        assert attached.capacity == 8
+        ring.push([make_record(1), make_record(2)])
+        assert attached.pop_all() == [make_record(1), make_record(2)]
+        assert len(ring) == 0
+        attached.close()
+    finally:
+        ring.close()
+
+# -----------------------------------------------------------------------------
+def test_full_ring_blocks_and_resumes(name):
+    channel = ShmChannel(name, 4, create=True)
+    try:
+        records = [make_record(i) for i in range(10)]
+        sender = Thread(target=channel.send_requests, args=[records])
+        sender.start()
+        sleep(0.3)
+        assert sender.is_alive()    # blocked on the full ring
+        assert channel.backpressure_waits > 0
+        received = []
+        while len(received) < len(records):
+            assert channel.request_bell.wait(5)
+            received.extend(channel.pop_requests())     # rings the space bell
+        sender.join(5)
+        assert not sender.is_alive()
+        assert received == records
+    finally:
+        channel.close()
+
+# -----------------------------------------------------------------------------
+def produce(name: str, cnt: int) -> None:
+    channel = ShmChannel(name)
+    for start in range(0, cnt, 37):     # batches not aligned with the capacity
+        channel.send_requests([make_record(i) for i in range(start, min(start + 37, cnt))])
+    channel.close()
+
+def test_producer_consumer_processes(name):
+    channel = ShmChannel(name, 64, create=True)
+    try:
+        producer = get_context("spawn").Process(target=produce, args=[name, CNT_RECORDS])
+        producer.start()
+        received = []
+        while len(received) < CNT_RECORDS:
+            assert channel.request_bell.wait(10), f"got {len(received)} of {CNT_RECORDS} records"
+            received.extend(channel.pop_requests())
+        producer.join(10)
+        assert producer.exitcode == 0
+        assert received == [make_record(i) for i in range(CNT_RECORDS)]     # none lost or reordered
+    finally:
+        channel.close()
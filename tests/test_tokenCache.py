@@ -0,0 +1,51 @@
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tokenCache import TokenCache, join_tokens, split_tokens
+
+DIMENSION = 4
+CNT_THREADS = 4
+CNT_APPENDS = 300   # per thread
+
+
+def get_tokens(document: int) -> np.ndarray:
+    "1 to 5 token vectors, all holding the document's number"
+    return np.full((document % 5 + 1, DIMENSION), document, dtype=np.float32)
+
+def open_token_cache(tmp_path) -> TokenCache:
+    return TokenCache(str(tmp_path / "tokens"), DIMENSION, str(tmp_path / "tokens.lock"), 10)
+
+# -----------------------------------------------------------------------------
+def test_append_read(tmp_path):
+    token_cache = open_token_cache(tmp_path)
+    documents = [get_tokens(document) for document in range(5)]
+    assert token_cache.append(*join_tokens(documents[:2])) == [0, 1]
+    assert token_cache.append(*join_tokens(documents[2:])) == [2, 3, 4]
+    assert np.array_equal(token_cache.read(3), documents[3])
+    vectors, lengths = token_cache.read_many([4, 0, 2])
+    for matrix, document in zip(split_tokens(vectors, lengths), (4, 0, 2)):
+        assert np.array_equal(matrix, documents[document])
+    assert token_cache.read(5) is None
+    token_cache.close()
+
+def test_threaded_appends(tmp_path):
+    "appends of several threads of 1 process get distinct entries, each with its own vectors"
+    token_cache = open_token_cache(tmp_path)
+
+    def append(thread: int) -> dict[int, int]:
+        entry_ids = {}
+        for i in range(CNT_APPENDS):
+            document = thread * CNT_APPENDS + i
+            entry_ids[token_cache.append(*join_tokens([get_tokens(document)]))[0]] = document
+        return entry_ids
+
+    with ThreadPoolExecutor(CNT_THREADS) as executor:
+        results = list(executor.map(append, range(CNT_THREADS)))
+    entry_ids = {entry_id: document for result in results for entry_id, document in result.items()}
+    assert len(entry_ids) == CNT_THREADS * CNT_APPENDS
+    assert sorted(entry_ids) == list(range(CNT_THREADS * CNT_APPENDS))
+    vectors, lengths = token_cache.read_many(list(entry_ids))
+    for matrix, document in zip(split_tokens(vectors, lengths), entry_ids.values()):
+        assert np.array_equal(matrix, get_tokens(document))
+    token_cache.close()
@@ -0,0 +1,158 @@
+"""
+a model's token (word) embeddings cache, for emb_type=word. Documents have a variable number of
+tokens, so their vectors are stored ragged in the model's tokens/ directory:
+* tokens.bin: the token vectors of all documents, concatenated (a CacheFile: the model's storage
+  dtype, reads from its memory map)
+* tokens.offsets: 1 entry per document, (1st row in tokens.bin, number of rows), appended right
+  after the document's vectors under tokens.bin's lock
+The tokens index (the model's database type) maps a document's digest to its entry. It's written
+through the database commit process like the model's index, under the model's id with
+TOKENS_MODEL_ID set. Reads & writes of many documents are vectorized: no per-token objects
+"""
+import logging
+import mmap
+import numpy as np
+import os
+
+from filelock import Timeout
+from threading import Lock
+from time import perf_counter
+
+import metrics
+
+from cacheFile import CacheFile
+
+TOKENS_DIRNAME = "tokens"
+TOKENS_MODEL_ID = 0x8000    # model id bit (msgs carry a u16) of the models' tokens indexes
+ENTRY = np.dtype([("start", "<i8"), ("cnt", "<i8")])
+
+
+def join_tokens(documents_tokens: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    "the (n_tokens, dim) matrices of several documents -> (all their rows, number of rows of each)"
+    lengths = np.array([len(tokens) for tokens in documents_tokens], dtype=np.int64)
+    if not len(documents_tokens):
+        return np.empty((0, 0), dtype=np.float32), lengths
+    return np.concatenate(documents_tokens).astype(np.float32, copy=False), lengths
+
+def split_tokens(vectors: np.ndarray, lengths: np.ndarray) -> list[np.ndarray]:
+    "inverse of join_tokens, the documents' matrices are views of vectors"
+    return np.split(vectors, np.cumsum(lengths)[:-1])
+
+
+class TokenCache:
+    OFFSETS_FILENAME = "tokens.offsets"
+
+    def __init__(self, dirpath: str, embedding_dimension: int, lock_path: str,
+                 lock_timeout: float, storage_dtype: str = "float32"):
+        self.dirpath = dirpath
+        os.makedirs(dirpath, exist_ok=True)
+        for filename in ("tokens.bin", self.OFFSETS_FILENAME):
+            with open(os.path.join(dirpath, filename), "ab"):
+                pass
+        self.vectors = CacheFile(os.path.join(dirpath, "tokens.bin"), embedding_dimension,
+                                 lock_path, lock_timeout, storage_dtype)
+        self.embedding_dimension = embedding_dimension
+        self.offsets_path = os.path.join(dirpath, self.OFFSETS_FILENAME)
+        self.offsets_file = None    # opened on 1st append
+        # appends of this process' threads (concurrent word requests, a stream's batches): the
+        # file lock doesn't exclude threads of the process which holds it
+        self.append_lock = Lock()
+        self.mapping = (None, 0)    # (mmap of tokens.offsets, mapped length), see CacheFile
+        self.remap_lock = Lock()
+
+    # -------------------------------------------------------------------------
+    def _get_entries(self, cnt: int) -> np.ndarray | None:
+        "the 1st cnt entries (or more), None if tokens.offsets has fewer"
+        min_length = cnt * ENTRY.itemsize
+        buffer, length = self.mapping
+        if length < min_length:
+            with self.remap_lock:
+                buffer, length = self.mapping
+                if length < min_length:
+                    size = os.path.getsize(self.offsets_path)
+                    if size < min_length:
+                        return None
+                    with open(self.offsets_path, "rb") as f:
+                        self.mapping = (mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ),
+                                        size)
+                    buffer, length = self.mapping
+        return np.frombuffer(buffer, dtype=ENTRY, count=length // ENTRY.itemsize)
+
+    # -------------------------------------------------------------------------
+    def read(self, entry_id: int) -> np.ndarray | None:
+        "the document's (n_tokens, dim) float32 matrix, None if there's no such entry"
+        entries = self._get_entries(entry_id + 1)
+        if entries is None:
+            return None
+        start, cnt = entries[entry_id].tolist()
+        return self.vectors.read_rows(start, cnt)
+
+    def read_many(self, entry_ids: list[int]) -> tuple[np.ndarray, np.ndarray] | None:
+        """
+        the documents' token vectors, concatenated in entry_ids order with 1 gather (& 1
+        dequantization), & their numbers of tokens, see split_tokens. None if any of them is
+        missing
+        """
+        entry_ids = np.asarray(entry_ids, dtype=np.int64)
+        if not len(entry_ids):
+            return np.empty((0, self.embedding_dimension), dtype=np.float32), entry_ids
+        entries = self._get_entries(int(entry_ids.max()) + 1)
+        if entries is None:
+            return None
+        entries = entries[entry_ids]
+        lengths = entries["cnt"]
+        # row i of the result is row i - (1st row of its document in the result) + its start
+        bounds = np.concatenate([[0], np.cumsum(lengths)])
+        rows = np.arange(bounds[-1]) + np.repeat(entries["start"] - bounds[:-1], lengths)
+        vectors = self.vectors.read_many(rows * self.vectors.vector_nbytes)
+        return None if vectors is None else (vectors, lengths)
+
+    # -------------------------------------------------------------------------
+    def append(self, vectors: np.ndarray, lengths: np.ndarray) -> list[int] | None:
+        """
+        appends the token vectors of several documents (see join_tokens) & 1 entry per document,
+        returns the entry ids (for the tokens index) or None if the lock timed-out
+        """
+        data = self.vectors.encode(vectors).tobytes()
+        with self.append_lock:
+            return self._append(data, lengths)
+
+    def _append(self, data: bytes, lengths: np.ndarray) -> list[int] | None:
+        "append with self.append_lock held"
+        if self.offsets_file is None:
+            self.offsets_file = open(self.offsets_path, "ab", buffering=0)
+        started = perf_counter()
+        try:
+            self.vectors.lock.acquire()
+        except Timeout:
+            logging.error(f'timed-out acquiring lockfile to write to "{self.vectors.path}", '
+                          "giving up...")
+            return None
+        metrics.observe_lock_wait(self.vectors.lock.lock_file, started)
+        try:
+            # a crash can leave either file ending in a torn write, appends start after it
+            for path, nbytes in ((self.vectors.path, self.vectors.vector_nbytes),
+                                 (self.offsets_path, ENTRY.itemsize)):
+                size = os.path.getsize(path)
+                if size % nbytes:
+                    os.truncate(path, size - size % nbytes)
+            # CacheFile.append takes the lock again (it's re-entrant)
+            offset = self.vectors.append(data)
+            if offset is None:
+                return None
+            entries = np.empty(len(lengths), dtype=ENTRY)
+            entries["cnt"] = lengths
+            entries["start"] = (offset // self.vectors.vector_nbytes
+                                + np.concatenate([[0], np.cumsum(lengths)[:-1]]))
+            first_id = os.fstat(self.offsets_file.fileno()).st_size // ENTRY.itemsize
+            # written after the vectors: an entry never points to vectors which weren't
+            self.offsets_file.write(entries.tobytes())
+        finally:
+            self.vectors.lock.release()
+        return list(range(first_id, first_id + len(lengths)))
+
+    def close(self) -> None:
+        self.vectors.close()
+        if self.offsets_file is not None:
+            self.offsets_file.close()
+            self.offsets_file = None